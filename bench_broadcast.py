@@ -0,0 +1,167 @@
+"""Measure chat delivery latency and server write syscalls per broadcast window
+
+    python bench_broadcast.py --clients 50 --senders 10 --rate 20 --windows 0 5 10 20
+
+For each window a server is started with BROADCAST_WINDOW_MS set to it,
+every client joins with the framed protocol and the senders each post
+--rate messages per second on average, with Poisson arrivals so senders
+do not fire in lockstep. Messages carry their send time, so receivers
+report the delivery latency directly. The server counts its own socket
+send calls, which is one syscall each, and dumps the count on SIGUSR1
+(POSIX only).
+"""
+import argparse
+import asyncio
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from protocol import HEADER, MSG_CHAT_MESSAGE, MSG_COMMAND, PROTOCOL_VERSION, encode_frame, encode_join
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def serve(port, window_ms):
+    """Child process: run the server with the given window, counting socket sends"""
+    import server
+    sends = [0]
+    for name in ('send', 'sendmsg'):
+        original = getattr(socket.socket, name)
+
+        def counted(sock, *args, _original=original):
+            sends[0] += 1
+            return _original(sock, *args)
+        setattr(socket.socket, name, counted)
+
+    def dump(signum, frame):
+        with open("sends", "w") as f:
+            f.write(str(sends[0]))
+    signal.signal(signal.SIGUSR1, dump)
+    server.PORT = port
+    server.BROADCAST_WINDOW_MS = window_ms
+    server.start_server()
+
+def send_count(proc, directory):
+    path = os.path.join(directory, "sends")
+    if os.path.exists(path):
+        os.remove(path)
+    proc.send_signal(signal.SIGUSR1)
+    for _ in range(100):
+        try:
+            with open(path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            time.sleep(0.01)
+    raise RuntimeError("Server did not report its send count")
+
+def start_server(directory, port, window_ms):
+    os.makedirs(os.path.join(directory, "library"), exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port), str(window_ms)],
+                            cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+async def join(port, name):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(encode_join(name, f"PROTO={PROTOCOL_VERSION}"))
+    line = await reader.readline()
+    if not line.startswith(b"JOIN_SUCCESS"):
+        raise RuntimeError(f"Join failed: {line!r}")
+    return reader, writer
+
+async def receive(reader, latencies, stop):
+    """Record the latency of every bench message until stop is set"""
+    buffer = b""
+    while not stop.is_set():
+        try:
+            data = await reader.read(256 * 1024)
+        except ConnectionError:
+            return
+        if not data:
+            return
+        now_ns = time.perf_counter_ns()
+        buffer += data
+        pos = 0
+        while len(buffer) - pos >= HEADER.size:
+            version, msg_type, flags, request_id, length = HEADER.unpack_from(buffer, pos)
+            if len(buffer) - pos - HEADER.size < length:
+                break
+            payload = buffer[pos + HEADER.size:pos + HEADER.size + length]
+            pos += HEADER.size + length
+            if msg_type == MSG_CHAT_MESSAGE and b": bench " in payload:
+                latencies.append((now_ns - int(payload.rsplit(b" ", 1)[1])) / 1e6)
+        buffer = buffer[pos:]
+
+async def send(writer, rate, duration, rng):
+    deadline = time.perf_counter() + duration
+    request_id = 0
+    while time.perf_counter() < deadline:
+        request_id += 1
+        writer.write(encode_frame(MSG_COMMAND, f"CHAT bench {time.perf_counter_ns()}".encode(), request_id))
+        await asyncio.sleep(rng.expovariate(rate))
+
+async def run(port, proc, directory, args):
+    connections = [await join(port, f"bench{i}") for i in range(args.clients)]
+    await asyncio.sleep(0.5)  # let the join announcements settle
+    latencies, stop = [], asyncio.Event()
+    receivers = [asyncio.create_task(receive(r, latencies, stop)) for r, _ in connections]
+    before = send_count(proc, directory)
+    rng = random.Random(args.seed)
+    await asyncio.gather(*(send(w, args.rate, args.duration, random.Random(rng.random()))
+                           for _, w in connections[:args.senders]))
+    await asyncio.sleep(0.5)  # wait for the last batches
+    after = send_count(proc, directory)
+    stop.set()
+    for _, writer in connections:
+        writer.close()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    return latencies, after - before
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--serve":
+        serve(int(sys.argv[2]), int(sys.argv[3]))
+        return
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--senders', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=20, help="messages per second per sender")
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--windows', type=int, nargs='+', default=[0, 5, 10, 20], help="BROADCAST_WINDOW_MS values")
+    args = parser.parse_args()
+
+    print(f"{'window ms':>10}{'delivered':>11}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'sends':>9}{'sends/msg':>11}")
+    for window in args.windows:
+        with tempfile.TemporaryDirectory() as directory:
+            port = free_port()
+            proc = start_server(directory, port, window)
+            try:
+                latencies, sends = asyncio.run(run(port, proc, directory, args))
+            finally:
+                proc.kill()
+                proc.wait()
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0
+        per_message = sends / len(latencies) if latencies else 0
+        print(f"{window:>10}{len(latencies):>11}{statistics.median(latencies or [0]):>9.1f}{p99:>9.1f}"
+              f"{max(latencies or [0]):>9.1f}{sends:>9}{per_message:>11.3f}")
+
+if __name__ == '__main__':
+    main()
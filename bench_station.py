@@ -0,0 +1,76 @@
+"""Compare everyone streaming a song themselves with everyone tuned to a station
+
+    python bench_station.py radio --listeners 1 4 16 --seconds 10
+
+Speaks to a running server. For each listener count it reports the song
+bytes the server read for the listeners, from its STATS counters, and the
+peak and average rate they received in 250 ms windows, for two modes:
+    stream   every listener sends STREAM_SONG for the playlist's first song
+    station  every listener sends TUNE <playlist>
+"""
+import argparse
+import asyncio
+import time
+
+from client_core import AsyncClient, CallbackSink
+
+WINDOW = 0.25
+
+def counter(stats, name):
+    for line in stats.split('\n'):
+        if line.startswith(name + ' '):
+            return int(line.split()[1])
+    return 0
+
+async def run(args, mode, listeners):
+    control = AsyncClient(compress=False)
+    await control.connect(args.host, args.port, "station-bench")
+    song = (await control.list_playlist_songs(args.playlist))[0]
+    clients = []
+    for i in range(listeners):
+        client = AsyncClient(compress=False)
+        await client.connect(args.host, args.port, f"listener{i}")
+        clients.append(client)
+    read_counter = 'station_read_bytes_total' if mode == 'station' else 'stream_bytes_total'
+    read_before = counter(await control.request("STATS"), read_counter)
+
+    windows = {}
+    started = time.perf_counter()
+
+    def on_data(offset, data):
+        window = int((time.perf_counter() - started) / WINDOW)
+        windows[window] = windows.get(window, 0) + len(data)
+
+    if mode == 'station':
+        tasks = [asyncio.ensure_future(c.tune(args.playlist, CallbackSink(on_data))) for c in clients]
+    else:
+        tasks = [asyncio.ensure_future(c.stream_to_callback(song, on_data)) for c in clients]
+    await asyncio.sleep(args.seconds)
+    if mode == 'station':
+        for client in clients:
+            await client.untune()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    read = counter(await control.request("STATS"), read_counter) - read_before
+    for client in clients + [control]:
+        await client.close()
+
+    rates = [windows.get(w, 0) / WINDOW for w in range(int(args.seconds / WINDOW))]
+    return read, max(rates), sum(rates) / len(rates)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('playlist', help="a playlist on the server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--listeners', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'listeners':>9} {'read':>12} {'peak rate':>14} {'avg rate':>14}")
+    for listeners in args.listeners:
+        for mode in ('stream', 'station'):
+            read, peak, average = await run(args, mode, listeners)
+            print(f"{mode:<8} {listeners:>9} {read / 1e6:>9.2f} MB {peak / 1e3:>9.0f} KB/s {average / 1e3:>9.0f} KB/s")
+
+if __name__ == '__main__':
+    asyncio.run(main())
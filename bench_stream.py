@@ -0,0 +1,129 @@
+"""Benchmark the STREAM_SONG send paths against each other
+
+    python bench_stream.py --size-mb 64 --streams 1 4 16
+
+Methods compared:
+    loop      the original thread-per-stream 1024 byte read + sendall loop
+    readinto  server.copy_file_range, the fallback used without sendfile
+    sendfile  server.send_file_range, zero-copy via loop.sendfile
+
+Receivers run in a child process, so the CPU time reported here is spent
+by the sending side only.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import server
+
+def receive_all(port, streams):
+    """Child process: open the connections and read each one to EOF"""
+    socks = [socket.create_connection(('127.0.0.1', port)) for _ in range(streams)]
+
+    def drain(sock):
+        buffer = bytearray(1024 * 1024)
+        while sock.recv_into(buffer):
+            pass
+        sock.close()
+
+    threads = [threading.Thread(target=drain, args=(s,)) for s in socks]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def run_loop(path, streams):
+    """Baseline: the pre-asyncio STREAM_SONG loop, one thread per stream"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(streams)
+    port = listener.getsockname()[1]
+
+    def send(conn):
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(1024)
+                if not data:
+                    break
+                conn.sendall(data)
+        conn.close()
+
+    receiver = multiprocessing.Process(target=receive_all, args=(port, streams))
+    receiver.start()
+    conns = [listener.accept()[0] for _ in range(streams)]
+    wall, cpu = time.perf_counter(), time.process_time()
+    threads = [threading.Thread(target=send, args=(c,)) for c in conns]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    receiver.join()
+    listener.close()
+    return wall, cpu
+
+async def run_async(send_range, path, streams):
+    size = os.path.getsize(path)
+    writers = []
+    all_connected = asyncio.Event()
+
+    async def on_connect(reader, writer):
+        writers.append(writer)
+        if len(writers) == streams:
+            all_connected.set()
+
+    async def send(writer):
+        with open(path, 'rb') as f:
+            await send_range(writer, f, 0, size)
+        writer.close()
+        await writer.wait_closed()
+
+    srv = await asyncio.start_server(on_connect, '127.0.0.1', 0)
+    port = srv.sockets[0].getsockname()[1]
+    receiver = multiprocessing.Process(target=receive_all, args=(port, streams))
+    receiver.start()
+    await all_connected.wait()
+    wall, cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(send(w) for w in writers))
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    srv.close()
+    await asyncio.get_running_loop().run_in_executor(None, receiver.join)
+    return wall, cpu
+
+METHODS = {
+    'loop': run_loop,
+    'readinto': lambda path, streams: asyncio.run(run_async(server.copy_file_range, path, streams)),
+    'sendfile': lambda path, streams: asyncio.run(run_async(server.send_file_range, path, streams)),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=64, help="size of the synthetic song")
+    parser.add_argument('--streams', type=int, nargs='+', default=[1, 4, 16], help="concurrent streams")
+    parser.add_argument('--methods', nargs='+', choices=list(METHODS), default=list(METHODS))
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(block)
+        path = f.name
+
+    try:
+        print(f"{'method':<10}{'streams':>8}{'MB/s':>10}{'CPU ms/stream':>16}{'CPU s/GB':>10}")
+        for streams in args.streams:
+            for method in args.methods:
+                wall, cpu = METHODS[method](path, streams)
+                total_mb = args.size_mb * streams
+                print(f"{method:<10}{streams:>8}{total_mb / wall:>10.1f}"
+                      f"{cpu * 1000 / streams:>16.1f}{cpu / (total_mb / 1024):>10.2f}")
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Measure time-to-first-audio with and without progressive playback
+
+    python bench_ttfa.py song.mp3 --rate-kbps 4000 --prebuffer-kb 256
+
+Speaks the framed protocol to a running server and reads at a capped
+rate to stand in for a slow link. For each mode it reports the time from
+the request until clientf2.py would call pygame.mixer.music.play:
+    full         STREAM_SONG, play after STREAM_END
+    progressive  prebuffer plus the file's tail on disk, the rest still coming
+"""
+import argparse
+import socket
+import statistics
+import time
+
+from protocol import (MSG_COMMAND, MSG_STREAM_END, MSG_STREAM_START, PROTOCOL_VERSION, FrameDecoder, encode_frame,
+                      encode_join)
+
+TAIL_PREFETCH = 64 * 1024
+
+class ThrottledConnection:
+    def __init__(self, host, port, rate_kbps):
+        self.sock = socket.create_connection((host, port))
+        self.sock.sendall(encode_join("ttfa-bench", f"PROTO={PROTOCOL_VERSION}"))
+        data = b""
+        while b"\n" not in data:
+            data += self.sock.recv(1024)
+        line, _, leftover = data.partition(b"\n")
+        if not line.startswith(b"JOIN_SUCCESS"):
+            raise RuntimeError(f"Join failed: {line!r}")
+        self.decoder = FrameDecoder()
+        self.decoder.feed(leftover)
+        self.bytes_per_second = rate_kbps * 1000 / 8
+        self.next_request_id = 1
+
+    def send(self, command):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.sock.sendall(encode_frame(MSG_COMMAND, command.encode(), request_id))
+        return request_id
+
+    def frames(self):
+        """Yield frames forever, sleeping so reads average the configured rate"""
+        started, received = time.perf_counter(), 0
+        while True:
+            n = self.decoder.recv_into(self.sock)
+            if not n:
+                raise ConnectionError("Server closed the connection")
+            received += n
+            ahead = received / self.bytes_per_second - (time.perf_counter() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+            yield from self.decoder.frames()
+
+    def close(self):
+        self.sock.close()
+
+def measure_full(conn, song):
+    started = time.perf_counter()
+    request_id = conn.send(f"STREAM_SONG {song}")
+    for msg_type, flags, rid, payload in conn.frames():
+        if msg_type == MSG_STREAM_END and rid == request_id:
+            return time.perf_counter() - started
+
+def measure_progressive(conn, song, prebuffer):
+    """Mirror clientf2.py: prebuffer range first, then tail, then the middle"""
+    started = time.perf_counter()
+    first = conn.send(f"STREAM_RANGE 0 {prebuffer} {song}")
+    needed, outstanding, ready_at = {first}, {first}, None
+    for msg_type, flags, rid, payload in conn.frames():
+        if msg_type == MSG_STREAM_START and rid == first:
+            offset, length, total = (int(x) for x in bytes(payload).decode().partition('\n')[2].split()[:3])
+            tail_start = max(length, total - TAIL_PREFETCH)
+            if tail_start < total:
+                tail = conn.send(f"STREAM_RANGE {tail_start} {total - tail_start} {song}")
+                needed.add(tail)
+                outstanding.add(tail)
+            if length < tail_start:
+                outstanding.add(conn.send(f"STREAM_RANGE {length} {tail_start - length} {song}"))
+        elif msg_type == MSG_STREAM_END:
+            needed.discard(rid)
+            outstanding.discard(rid)
+            if not needed and ready_at is None:
+                ready_at = time.perf_counter() - started
+            if not outstanding:
+                return ready_at
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('song', help="a file name from the server's library/")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--rate-kbps', type=int, default=4000, help="simulated link speed")
+    parser.add_argument('--prebuffer-kb', type=int, default=256)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    results = {'full': [], 'progressive': []}
+    for _ in range(args.runs):
+        for mode in results:
+            conn = ThrottledConnection(args.host, args.port, args.rate_kbps)
+            try:
+                if mode == 'full':
+                    results[mode].append(measure_full(conn, args.song))
+                else:
+                    results[mode].append(measure_progressive(conn, args.song, args.prebuffer_kb * 1024))
+            finally:
+                conn.close()
+
+    for mode, samples in results.items():
+        print(f"{mode:<12} median {statistics.median(samples) * 1000:8.0f} ms"
+              f"   min {min(samples) * 1000:8.0f} ms   max {max(samples) * 1000:8.0f} ms")
+
+if __name__ == '__main__':
+    main()
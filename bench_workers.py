@@ -0,0 +1,89 @@
+"""Measure chat fan-out throughput as server worker processes are added
+
+    python bench_workers.py --workers 1 2 4 --clients 400 --senders 20 --rate 50
+
+For each worker count a server is started with --workers N. Clients are
+spread over several load processes so the load generator is not the
+bottleneck; all of them sit in the lobby and the senders post --rate
+messages per second each. Reports messages delivered per second and the
+delivery latency, along with the number of CPU cores available.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_broadcast import REPO_DIR, free_port, join, receive, send
+
+def start_server(directory, port, workers):
+    os.makedirs(os.path.join(directory, "library"), exist_ok=True)
+    proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "server.py"), "--workers", str(workers),
+                             "--port", str(port)], cwd=directory,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+async def load(port, clients, senders, rate, duration, seed, start_at):
+    connections = [await join(port, f"load{os.getpid()}-{i}") for i in range(clients)]
+    await asyncio.sleep(max(0, start_at - time.time()))
+    latencies, stop = [], asyncio.Event()
+    receivers = [asyncio.create_task(receive(r, latencies, stop)) for r, _ in connections]
+    rng = random.Random(seed)
+    await asyncio.gather(*(send(w, rate, duration, random.Random(rng.random()))
+                           for _, w in connections[:senders]))
+    await asyncio.sleep(1)  # let the last messages arrive
+    stop.set()
+    for _, writer in connections:
+        writer.close()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    return latencies
+
+def load_process(args):
+    return asyncio.run(load(*args))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=400)
+    parser.add_argument('--senders', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=50, help="messages per second per sender")
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--load-processes', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPU cores available")
+    print(f"{'workers':>8}{'delivered/s':>13}{'p50 ms':>9}{'p99 ms':>9}")
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as directory:
+            port = free_port()
+            proc = start_server(directory, port, workers)
+            try:
+                n = args.load_processes
+                start_at = time.time() + 2 + args.clients / 200
+                jobs = [(port, args.clients // n, args.senders // n, args.rate, args.duration, args.seed + i, start_at)
+                        for i in range(n)]
+                with multiprocessing.Pool(n) as pool:
+                    latencies = sorted(sum(pool.map(load_process, jobs), []))
+            finally:
+                proc.terminate()
+                proc.wait()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0
+        print(f"{workers:>8}{len(latencies) / args.duration:>13.0f}{statistics.median(latencies or [0]):>9.1f}"
+              f"{p99:>9.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Local pub/sub bus linking the worker processes of a multi-process server
+
+The parent process holds one end of a Unix socketpair per worker and
+relays what each worker publishes. Bus messages reuse the framing from
+protocol.py:
+
+    CHAT_MESSAGE  "<room>\n" followed by one CHAT_MESSAGE frame per message
+    COMMAND       an event name, e.g. PLAYLISTS_CHANGED
+
+The hub numbers chat messages per room and sends them to every worker,
+the publisher included, so all workers keep the same sequence numbers in
+their chat history. Events go to every worker except the publisher.
+"""
+import asyncio
+
+from protocol import HEADER, MSG_CHAT_MESSAGE, MSG_COMMAND, FrameDecoder, encode_frame
+
+def encode_chat(room, messages):
+    """Bus frame for a batch of (seq, payload) messages in one room"""
+    body = b"".join(encode_frame(MSG_CHAT_MESSAGE, payload, seq) for seq, payload in messages)
+    return encode_frame(MSG_CHAT_MESSAGE, room.encode() + b"\n" + body)
+
+def decode_chat(payload):
+    """Inverse of encode_chat; returns (room, [(seq, payload), ...])"""
+    room, _, body = payload.partition(b"\n")
+    decoder = FrameDecoder(len(body))
+    decoder.feed(body)
+    return room.decode(), [(seq, bytes(data)) for _, _, seq, data in decoder.frames()]
+
+async def read_frame(reader):
+    """Next (type, payload) from a bus connection; raises IncompleteReadError at EOF"""
+    version, msg_type, flags, request_id, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return msg_type, await reader.readexactly(length)
+
+class BusHub:
+    """Runs in the parent process and fans every worker's messages out to the rest"""
+
+    def __init__(self, socks):
+        self.socks = socks
+        self.writers = []
+        self.seqs = {}  # room -> last sequence number handed out
+
+    async def run(self):
+        """Relay until every worker has gone away"""
+        connections = [await asyncio.open_unix_connection(sock=sock) for sock in self.socks]
+        self.writers = [writer for _, writer in connections]
+        await asyncio.gather(*(self.relay(reader, writer) for reader, writer in connections))
+
+    async def relay(self, reader, source):
+        try:
+            while True:
+                msg_type, payload = await read_frame(reader)
+                if msg_type == MSG_CHAT_MESSAGE:
+                    room, messages = decode_chat(payload)
+                    seq = self.seqs.get(room, 0)
+                    numbered = [(seq + i + 1, data) for i, (_, data) in enumerate(messages)]
+                    self.seqs[room] = seq + len(messages)
+                    frame, targets = encode_chat(room, numbered), self.writers
+                else:
+                    frame, targets = encode_frame(msg_type, payload), [w for w in self.writers if w is not source]
+                for writer in targets:
+                    writer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if source in self.writers:
+                self.writers.remove(source)
+            source.close()
+
+class BusClient:
+    """A worker's connection to the hub
+
+    on_chat(room, [(seq, payload), ...]) is called for every chat batch,
+    including this worker's own once the hub has numbered it, and
+    on_event(name) for events published by other workers.
+    """
+
+    def __init__(self, sock, on_chat, on_event):
+        self.sock = sock
+        self.on_chat = on_chat
+        self.on_event = on_event
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(sock=self.sock)
+
+    def publish_chat(self, room, payloads):
+        self.writer.write(encode_chat(room, [(0, payload) for payload in payloads]))
+
+    def publish_event(self, name):
+        self.writer.write(encode_frame(MSG_COMMAND, name.encode()))
+
+    async def listen(self):
+        """Dispatch bus messages; returns when the hub goes away"""
+        try:
+            while True:
+                msg_type, payload = await read_frame(self.reader)
+                if msg_type == MSG_CHAT_MESSAGE:
+                    self.on_chat(*decode_chat(payload))
+                elif msg_type == MSG_COMMAND:
+                    self.on_event(payload.decode())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
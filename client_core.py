@@ -0,0 +1,503 @@
+"""Network client for the chat and music server, usable without any GUI
+
+AsyncClient speaks the framed protocol from protocol.py on an asyncio
+event loop. Commands are sent without waiting for earlier ones and each
+returns its reply, streams are written to a file or handed to a callback
+as their bytes arrive, and anything else the server sends (chat, the
+connection going away) is reported as an Event.
+
+ThreadedClient runs an AsyncClient on a background thread for front ends
+that own the main thread, such as the Tk GUI. Its methods can be called
+from any thread and its events land on a queue.Queue that the front end
+drains in batches.
+"""
+import asyncio
+import collections
+import os
+import queue
+import threading
+import zlib
+
+from protocol import (MSG_CHAT_MESSAGE, MSG_COMMAND, MSG_COMMAND_RESPONSE, MSG_COMPRESSED,
+                      MSG_MESSAGE_SENT, MSG_STREAM_DATA, MSG_STREAM_END, MSG_STREAM_START, PROTOCOL_VERSION,
+                      FrameDecoder, encode_frame, encode_join)
+
+DEFAULT_ROOM = "lobby"
+JOIN_TIMEOUT = 5
+RECEIVE_SIZE = 256 * 1024
+LIBRARY_PAGE_SIZE = 200
+
+# kind is one of:
+#   chat          request_id is the history sequence number, data is (sender, text)
+#   response      data is the reply text
+#   sent          a CHAT was accepted
+#   stream_start  data is a StreamInfo
+#   stream_end    data is the same StreamInfo
+#   error         a stream sink raised; data is the message
+#   disconnected  data is the error that closed the connection, or None
+# Front ends may add kinds of their own with ThreadedClient.post.
+Event = collections.namedtuple('Event', 'kind request_id command data')
+
+StreamInfo = collections.namedtuple('StreamInfo', 'song offset length total version')
+
+SearchResult = collections.namedtuple('SearchResult', 'name title artist album duration bitrate size')
+
+class StreamError(Exception):
+    """The server answered a stream request with an error instead of the song"""
+
+def parse_stream_start(payload):
+    song, _, byte_range = bytes(payload).decode().partition('\n')
+    fields = byte_range.split()
+    offset, length, total = (int(x) for x in fields[:3])
+    return StreamInfo(song, offset, length, total, fields[3] if len(fields) > 3 else None)
+
+def library_page_command(limit=LIBRARY_PAGE_SIZE, cursor=None, offset=0, prefix="", contains=""):
+    """LIST_LIBRARY_PAGE with its options, one per line since song names may hold spaces"""
+    lines = [f"LIST_LIBRARY_PAGE {limit}"]
+    if cursor is not None:
+        lines.append(f"CURSOR={cursor}")
+    elif offset:
+        lines.append(f"OFFSET={offset}")
+    if prefix:
+        lines.append(f"PREFIX={prefix}")
+    if contains:
+        lines.append(f"CONTAINS={contains}")
+    return '\n'.join(lines)
+
+def parse_library_page(text):
+    """(total matches, offset of the first name, names) from a LIST_LIBRARY_PAGE reply"""
+    header, *names = text.split('\n')
+    word, total, start = header.split()
+    if word != "PAGE":
+        raise ValueError(text)
+    return int(total), int(start), names
+
+def parse_search_results(text):
+    """SearchResults from a SEARCH reply, best match first"""
+    results = []
+    for line in text.split('\n'):
+        fields = line.split('\t')
+        if len(fields) != len(SearchResult._fields):
+            continue
+        name, title, artist, album, duration, bitrate, size = fields
+        results.append(SearchResult(name, title or None, artist or None, album or None,
+                                    int(duration) if duration else None, int(bitrate) if bitrate else None, int(size)))
+    return results
+
+class StreamSink:
+    """Receives one stream; called on the client's event loop as frames arrive"""
+
+    def start(self, info):
+        pass
+
+    def data(self, offset, data):
+        """data is a view into the receive buffer, only valid until this returns"""
+
+    def end(self, info):
+        pass
+
+    def abort(self):
+        """The connection closed before the stream ended"""
+
+class FileSink(StreamSink):
+    """Writes each byte at its offset in the song, so ranges can fill in an existing file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def start(self, info):
+        self.file = open(self.path, "r+b" if os.path.exists(self.path) else "wb")
+
+    def data(self, offset, data):
+        self.file.seek(offset)
+        self.file.write(data)
+
+    def end(self, info):
+        self.abort()
+
+    def abort(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class CallbackSink(StreamSink):
+    def __init__(self, on_data):
+        self.on_data = on_data
+
+    def data(self, offset, data):
+        self.on_data(offset, data)
+
+class Receiver(asyncio.BufferedProtocol):
+    """The receiving end of an AsyncClient's connection
+
+    The transport reads straight into a FrameDecoder's buffer, and frames
+    are dispatched as they complete, their payloads still views into it.
+    Nothing is dispatched before start(), so the client can look at the
+    JOIN reply line before the frames behind it are read.
+    """
+
+    def __init__(self, client):
+        loop = asyncio.get_running_loop()
+        self.client = client
+        self.decoder = FrameDecoder(RECEIVE_SIZE)
+        self.inflated = FrameDecoder()  # frames unpacked from COMPRESSED envelopes
+        self.transport = None
+        self.join_reply = loop.create_future()
+        self.lost = loop.create_future()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.started = False
+        self.error = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        try:
+            if not self.join_reply.done():
+                line = self.decoder.readline()
+                if line is not None:
+                    self.join_reply.set_result(line)
+            elif self.started:
+                self.dispatch_frames()
+        except Exception as e:
+            self.error = str(e)
+            self.transport.close()
+
+    def start(self):
+        self.started = True
+        self.buffer_updated(0)  # dispatch what arrived behind the JOIN reply
+
+    def dispatch_frames(self):
+        client = self.client
+        for msg_type, flags, request_id, payload in self.decoder.frames():
+            if msg_type == MSG_COMPRESSED:
+                self.inflated.feed(client.decompressor.decompress(payload))
+                for frame in self.inflated.frames():
+                    client.dispatch_safely(*frame)
+            else:
+                client.dispatch_safely(msg_type, flags, request_id, payload)
+
+    def eof_received(self):
+        if self.error is None:
+            self.error = "Connection closed by server"
+
+    def connection_lost(self, exc):
+        if exc is not None and self.error is None:
+            self.error = str(exc)
+        self.writable.set()
+        if not self.join_reply.done():
+            self.join_reply.set_exception(ConnectionError(self.error or "Connection closed"))
+        if self.started:
+            self.client.connection_lost(self.error)
+        self.lost.set_result(None)
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    async def drain(self):
+        """Wait while the transport's write buffer is over its high-water mark"""
+        await self.writable.wait()
+
+class Request:
+    def __init__(self, command, future, sink):
+        self.command = command
+        self.future = future
+        self.sink = sink
+        self.info = None  # StreamInfo once the stream starts
+        self.position = 0  # song offset of the next STREAM_DATA byte
+
+    def resolve(self, result):
+        if not self.future.done():
+            self.future.set_result(result)
+
+class AsyncClient:
+    """One connection to the server
+
+    on_event(Event) is called on the event loop for every chat message,
+    every reply and every stream start and end, so a front end can follow
+    along without awaiting each request itself. With compress the server
+    is asked to deflate replies and chat; song data is never compressed.
+    """
+
+    def __init__(self, on_event=None, compress=True):
+        self.on_event = on_event or (lambda event: None)
+        self.compress = compress
+        self.decompressor = None  # zlib stream once the server agrees to compress
+        self.transport = None
+        self.receiver = None  # the connection's Receiver protocol
+        self.connected = False
+        self.username = None
+        self.room = DEFAULT_ROOM
+        self.last_chat_seq = 0  # so a reconnect only replays the chat we missed
+        self.next_request_id = 1
+        self.pending = {}  # request id -> Request
+
+    async def connect(self, host, port, username, timeout=JOIN_TIMEOUT):
+        """Join the chat, back in the room and at the chat position of any earlier connection"""
+        loop = asyncio.get_running_loop()
+        transport, receiver = await asyncio.wait_for(
+            loop.create_connection(lambda: Receiver(self), host, port), timeout)
+        options = f"PROTO={PROTOCOL_VERSION}"
+        if self.room != DEFAULT_ROOM:
+            options += f" ROOM={self.room}"
+        if self.last_chat_seq:
+            options += f" SINCE={self.last_chat_seq}"
+        if self.compress:
+            options += " COMPRESS=zlib"
+        try:
+            transport.write(encode_join(username, options))
+            response = (await asyncio.wait_for(receiver.join_reply, timeout)).decode().strip()
+        except:
+            transport.close()
+            raise
+        words = response.split()
+        if words[:2] != ["JOIN_SUCCESS", f"PROTO={PROTOCOL_VERSION}"]:
+            transport.close()
+            raise ConnectionError(f"Failed to join: {response}")
+        self.decompressor = zlib.decompressobj() if "COMPRESS=zlib" in words[2:] else None
+        self.transport, self.receiver = transport, receiver
+        self.username = username
+        self.connected = True
+        receiver.start()
+
+    async def close(self):
+        """Leave the chat and close the connection"""
+        if not self.connected:
+            return
+        try:
+            self.transport.write(encode_frame(MSG_COMMAND, b"LEAVE_CHAT", self.new_request_id()))
+        except:
+            pass
+        self.transport.close()
+        await self.receiver.lost
+
+    def new_request_id(self):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        return request_id
+
+    async def request(self, command, sink=None, flags=0):
+        """Send a command and wait for its reply
+
+        Returns the reply text, None for an accepted CHAT, or the StreamInfo
+        of a stream once it has ended. The command is written before the
+        first await, so requests go out in the order they are made.
+        """
+        if not self.connected:
+            raise ConnectionError("Not connected")
+        request_id = self.new_request_id()
+        request = Request(command, asyncio.get_running_loop().create_future(), sink)
+        self.pending[request_id] = request
+        self.transport.write(encode_frame(MSG_COMMAND, command.encode(), request_id, flags))
+        await self.receiver.drain()
+        return await request.future
+
+    async def chat(self, message):
+        await self.request(f"CHAT {message}")
+
+    async def list_library(self):
+        return (await self.request("LIST_LIBRARY_SONGS")).strip().split('\n')
+
+    async def list_library_page(self, limit=LIBRARY_PAGE_SIZE, cursor=None, offset=0, prefix="", contains=""):
+        """One page of the library; pass the last name of a page as cursor to get the next"""
+        return parse_library_page(await self.request(library_page_command(limit, cursor, offset, prefix, contains)))
+
+    async def search(self, query):
+        return parse_search_results(await self.request(f"SEARCH {query}"))
+
+    async def list_playlists(self):
+        return (await self.request("LIST_PLAYLISTS")).strip().split('\n')
+
+    async def list_playlist_songs(self, playlist):
+        return (await self.request(f"LIST_SONGS_IN_PLAYLIST {playlist}")).strip().split('\n')
+
+    async def create_playlist(self, playlist):
+        return await self.request(f"CREATE_PLAYLIST {playlist}")
+
+    async def delete_playlist(self, playlist):
+        return await self.request(f"DELETE_PLAYLIST {playlist}")
+
+    async def add_song(self, playlist, song):
+        return await self.request(f"ADD_SONG_TO_PLAYLIST {playlist} {song}")
+
+    async def remove_song(self, playlist, song):
+        return await self.request(f"REMOVE_SONG_FROM_PLAYLIST {playlist} {song}")
+
+    async def merge_playlists(self, source, target):
+        return await self.request(f"MERGE_PLAYLISTS {source} {target}")
+
+    async def combine_playlists(self, first, second, new_name):
+        return await self.request(f"COMBINE_PLAYLISTS {first} {second} {new_name}")
+
+    async def join_room(self, room):
+        return await self.request(f"JOIN {room}")
+
+    async def part_room(self):
+        return await self.request("PART")
+
+    async def stream(self, song, sink, offset=0, length=0):
+        """Stream a song, or length bytes of it from offset (0 means to the end), into sink"""
+        if offset or length:
+            command = f"STREAM_RANGE {offset} {length} {song}"
+        else:
+            command = f"STREAM_SONG {song}"
+        result = await self.request(command, sink)
+        if not isinstance(result, StreamInfo):
+            raise StreamError(result)
+        return result
+
+    async def tune(self, playlist, sink):
+        """Listen to a playlist's station until untune; sink.start is called again for every song"""
+        result = await self.request(f"TUNE {playlist}", sink)
+        if isinstance(result, str):
+            raise StreamError(result)
+        return result
+
+    async def untune(self):
+        return await self.request("UNTUNE")
+
+    async def list_stations(self):
+        """(playlist, listeners, song playing) for every station on the air"""
+        text = await self.request("STATIONS")
+        return [(name, int(count), song) for name, count, song in
+                (line.split('\t') for line in text.split('\n') if line)]
+
+    async def stream_to_file(self, song, path, offset=0, length=0):
+        return await self.stream(song, FileSink(path), offset, length)
+
+    async def stream_to_callback(self, song, on_data, offset=0, length=0):
+        """on_data(offset, data) is called for every chunk as it arrives"""
+        return await self.stream(song, CallbackSink(on_data), offset, length)
+
+    def dispatch_safely(self, msg_type, flags, request_id, payload):
+        """Dispatch one frame, reporting a failure as an error event instead of dropping the connection"""
+        try:
+            self.dispatch(msg_type, request_id, payload)
+        except Exception as e:
+            request = self.pending.get(request_id)
+            self.on_event(Event("error", request_id, request and request.command, str(e)))
+
+    def dispatch(self, msg_type, request_id, payload):
+        if msg_type == MSG_STREAM_DATA:
+            request = self.pending.get(request_id)
+            if request is not None:
+                if request.sink:
+                    request.sink.data(request.position, payload)
+                request.position += len(payload)
+        elif msg_type == MSG_CHAT_MESSAGE:
+            if request_id:
+                self.last_chat_seq = request_id
+            sender, _, text = bytes(payload).decode().partition(":")
+            self.on_event(Event("chat", request_id, None, (sender.strip(), text.strip())))
+        elif msg_type == MSG_COMMAND_RESPONSE:
+            request = self.pending.pop(request_id, None)
+            text = bytes(payload).decode()
+            if text.startswith("Joined room "):
+                # History of the new room follows; its sequence numbers start over
+                self.room = text[len("Joined room "):]
+                self.last_chat_seq = 0
+            self.on_event(Event("response", request_id, request.command if request else "", text))
+            if request:
+                request.resolve(text)
+        elif msg_type == MSG_MESSAGE_SENT:
+            request = self.pending.pop(request_id, None)
+            self.on_event(Event("sent", request_id, request.command if request else "", None))
+            if request:
+                request.resolve(None)
+        elif msg_type == MSG_STREAM_START:
+            request = self.pending.get(request_id)
+            info = parse_stream_start(payload)
+            if request is not None:
+                request.info = info
+                request.position = info.offset
+                if request.sink:
+                    request.sink.start(info)
+            self.on_event(Event("stream_start", request_id, request.command if request else "", info))
+        elif msg_type == MSG_STREAM_END:
+            request = self.pending.pop(request_id, None)
+            if request is None:
+                return
+            if request.sink:
+                request.sink.end(request.info)
+            self.on_event(Event("stream_end", request_id, request.command, request.info))
+            request.resolve(request.info)
+
+    def connection_lost(self, error):
+        self.connected = False
+        pending, self.pending = self.pending, {}
+        for request in pending.values():
+            if request.sink:
+                request.sink.abort()
+            if not request.future.done():
+                request.future.set_exception(ConnectionError(error or "Connection closed"))
+        if self.transport:
+            self.transport.close()
+        self.on_event(Event("disconnected", 0, None, error))
+
+class ThreadedClient:
+    """An AsyncClient on its own thread, for front ends with their own main loop
+
+    Stream sinks run on the network thread, so song data never passes
+    through the front end. Everything else arrives on `events`.
+    """
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self.client = AsyncClient(on_event=self.events.put)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def connected(self):
+        return self.client.connected
+
+    @property
+    def room(self):
+        return self.client.room
+
+    def call(self, coro):
+        """Schedule a coroutine on the network thread; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def connect(self, host, port, username, timeout=JOIN_TIMEOUT):
+        """Block until joined; raises on refusal or timeout"""
+        self.call(self.client.connect(host, port, username, timeout)).result()
+
+    def send(self, command, sink=None, flags=0):
+        """Send a command without waiting; commands go out in the order they are sent"""
+        if not self.client.connected:
+            raise ConnectionError("Not connected")
+        return self.call(self.client.request(command, sink, flags))
+
+    def close(self):
+        self.call(self.client.close()).result(JOIN_TIMEOUT)
+
+    def post(self, event):
+        """Queue an event from any thread, to be handled in order with the network's"""
+        self.events.put(event)
+
+    def drain_events(self, limit):
+        """Up to limit queued events, without blocking"""
+        events = []
+        try:
+            while len(events) < limit:
+                events.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+    def shutdown(self):
+        if self.client.connected:
+            self.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
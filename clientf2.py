@@ -1,13 +1,275 @@
+import collections
+import json
 import os
-import socket
 import threading
+import time
 import pygame
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 
+from client_core import (LIBRARY_PAGE_SIZE, Event, StreamSink, ThreadedClient, library_page_command,
+                         parse_library_page, parse_search_results)
+from download_cache import DownloadCache
+from protocol import FLAG_QUIET
+from virtual_list import ListModel, PagedListModel, VirtualListView
+
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 12345
 
+PREBUFFER_KB = 256  # audio buffered before progressive playback starts
+DOWNLOAD_SAVE_INTERVAL = 1.0  # seconds between rewrites of a download's progress sidecar
+TAIL_PREFETCH = 64 * 1024  # decoders look for tags at the end of the file before playing
+DOWNLOAD_CACHE_MB = 1024  # finished songs kept for replay and offline listening
+EVENT_POLL_MS = 50  # how often the Tk loop drains network events
+EVENT_BATCH = 500  # most events handled per tick, so a flood cannot starve redraws
+CHAT_RENDER_MS = 33  # chat redraws at most about 30 times a second
+CHAT_SCROLLBACK_LINES = 1000  # lines kept in the chat display
+CHAT_ARCHIVE_LINES = 20000  # trimmed lines still available under "Older Messages"
+LIBRARY_FILTER_DELAY_MS = 250  # typing pause before the library search is sent
+PREFETCH_TRACKS = 2  # upcoming play queue songs fetched while the current one plays
+PREFETCH_KBPS = 4000  # average rate prefetching may use, so it never crowds out what is playing
+PREFETCH_CHUNK_KB = 256  # prefetching asks for one range of this size at a time
+PREFETCH_DISK_MB = 128  # most bytes of upcoming songs downloaded ahead of the one playing
+MUSIC_END = pygame.USEREVENT + 1  # posted by pygame whenever a song ends, queued or not
+STREAM_COMMANDS = ("STREAM_SONG", "STREAM_RANGE", "STREAM_IF_CHANGED")
+
+class PartialDownload:
+    """A song being fetched into downloads/<name>.part
+
+    Which byte ranges are already on disk is kept in a small JSON sidecar,
+    so an interrupted download resumes with STREAM_RANGE and a seek only
+    asks for bytes that are still missing. Once complete the file moves
+    into the DownloadCache.
+    """
+
+    def __init__(self, directory, song):
+        self.song = song
+        self.part_path = os.path.join(directory, song + ".part")
+        self.state_path = self.part_path + ".json"
+        self.total = None
+        self.version = None
+        self.ranges = []  # sorted, non-overlapping [start, end) pairs
+        self.file = None
+        self.cond = threading.Condition()  # signalled whenever bytes land or the download stops
+        self.aborted = False
+        if os.path.exists(self.part_path) and os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+                self.total = state["total"]
+                self.version = state.get("version")
+                self.ranges = [tuple(r) for r in state["ranges"]]
+            except (OSError, ValueError, KeyError):
+                self.total, self.ranges = None, []
+
+    def begin(self, total, version):
+        """Called on STREAM_START; a changed size or version means the song changed, so start over"""
+        if self.total != total or self.version != version:
+            self.total = total
+            self.version = version
+            self.ranges = []
+            if self.file:
+                self.file.close()
+                self.file = None
+            open(self.part_path, "wb").close()
+        if self.file is None:
+            mode = "r+b" if os.path.exists(self.part_path) else "w+b"
+            self.file = open(self.part_path, mode)
+
+    def write_at(self, offset, data):
+        self.file.seek(offset)
+        self.file.write(data)
+        self.file.flush()
+        with self.cond:
+            self.add_range(offset, offset + len(data))
+            self.cond.notify_all()
+
+    def has(self, start, end):
+        return any(s <= start and end <= e for s, e in self.ranges)
+
+    def downloaded(self):
+        """Bytes of the song on disk so far"""
+        return sum(e - s for s, e in self.ranges)
+
+    def contiguous_end(self, pos):
+        """End of the downloaded run containing pos, or pos if it is missing"""
+        for s, e in self.ranges:
+            if s <= pos < e:
+                return e
+        return pos
+
+    def abort(self):
+        with self.cond:
+            self.aborted = True
+            self.cond.notify_all()
+
+    def add_range(self, start, end):
+        merged = []
+        for s, e in self.ranges:
+            if e < start or s > end:
+                merged.append((s, e))
+            else:
+                start, end = min(s, start), max(e, end)
+        merged.append((start, end))
+        self.ranges = sorted(merged)
+
+    def missing(self, start=0):
+        """Missing (offset, length) ranges, beginning at `start` and wrapping around"""
+        if self.total is None:
+            return [(0, 0)]
+        gaps, pos = [], 0
+        for s, e in self.ranges:
+            if s > pos:
+                gaps.append((pos, s - pos))
+            pos = max(pos, e)
+        if pos < self.total:
+            gaps.append((pos, self.total - pos))
+        # Split the gap containing `start` so the seek target comes first
+        ordered = []
+        for offset, length in gaps:
+            if offset < start < offset + length:
+                ordered.append((offset, start - offset))
+                ordered.append((start, offset + length - start))
+            else:
+                ordered.append((offset, length))
+        return [g for g in ordered if g[0] >= start] + [g for g in ordered if g[0] < start]
+
+    def complete(self):
+        return self.total is not None and not self.missing()
+
+    def save(self):
+        if self.file:
+            self.file.flush()
+        with open(self.state_path, "w") as f:
+            json.dump({"total": self.total, "version": self.version, "ranges": self.ranges}, f)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def finish(self, cache):
+        """Move the completed .part into the download cache and drop the sidecar"""
+        self.close()
+        cache.add(self.song, self.version, self.part_path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+def progressive_ready(download, prebuffer):
+    """Whether the prebuffer and the file's tail are on disk, so playback can start"""
+    total = download.total
+    return total is not None and download.has(0, min(prebuffer, total)) and \
+        download.has(max(0, total - TAIL_PREFETCH), total)
+
+def stream_command_song(command):
+    """The song a STREAM_SONG, STREAM_RANGE or STREAM_IF_CHANGED command asks for"""
+    if command.startswith("STREAM_RANGE"):
+        return command.split(maxsplit=3)[3]
+    if command.startswith("STREAM_IF_CHANGED"):
+        return command.split(maxsplit=2)[2]
+    return command.split(maxsplit=1)[1]
+
+def tail_first(ranges, tail_start):
+    """Reorder (offset, length) ranges so anything at or after tail_start is fetched first"""
+    head, tail = [], []
+    for offset, length in ranges:
+        end = offset + length
+        if end <= tail_start:
+            head.append((offset, length))
+        elif offset >= tail_start:
+            tail.append((offset, length))
+        else:
+            head.append((offset, tail_start - offset))
+            tail.append((tail_start, end - tail_start))
+    return tail + head
+
+class ProgressiveReader:
+    """Read-only file object over a PartialDownload, handed to pygame.mixer.music.load
+
+    Reads block until the bytes they need have been downloaded; each wait is
+    an underrun and is reported through on_underrun.
+    """
+
+    def __init__(self, download, on_underrun=None):
+        self.download = download
+        self.on_underrun = on_underrun
+        self.file = open(download.part_path, "rb")
+        self.pos = 0
+        self.underruns = 0
+
+    def read(self, size=-1):
+        download = self.download
+        if size is None or size < 0:
+            size = download.total - self.pos
+        end = min(self.pos + size, download.total)
+        if end <= self.pos:
+            return b""
+        with download.cond:
+            if not download.has(self.pos, end) and not download.aborted:
+                self.underruns += 1
+                if self.on_underrun:
+                    self.on_underrun(self.underruns)
+                while not download.has(self.pos, end) and not download.aborted:
+                    download.cond.wait()
+            if not download.has(self.pos, end):
+                end = download.contiguous_end(self.pos)
+        self.file.seek(self.pos)
+        data = self.file.read(end - self.pos)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.download.total
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.file.close()
+
+class DownloadSink(StreamSink):
+    """Writes a stream into a PartialDownload; runs on the network thread
+
+    The GUI's own state is only touched on the Tk thread, so all the sink
+    does besides writing is post a "playable" event once `prebuffer` bytes
+    and the file's tail are on disk.
+    """
+
+    def __init__(self, client, download, prebuffer=None):
+        self.client = client
+        self.download = download
+        self.prebuffer = prebuffer
+        self.saved_at = 0.0
+
+    def start(self, info):
+        self.download.begin(info.total, info.version)
+        self.saved_at = time.monotonic()
+
+    def data(self, offset, data):
+        self.download.write_at(offset, data)
+        # Persist progress now and then; a dropped connection saves it in close_partial_downloads
+        now = time.monotonic()
+        if now - self.saved_at >= DOWNLOAD_SAVE_INTERVAL:
+            self.download.save()
+            self.saved_at = now
+        if self.prebuffer is not None and progressive_ready(self.download, self.prebuffer):
+            self.prebuffer = None
+            self.client.post(Event("playable", 0, None, self.download))
+
+    def end(self, info):
+        self.download.save()
+
 class MusicChatClientGUI:
     def __init__(self, root):
         self.root = root
@@ -16,30 +278,57 @@ class MusicChatClientGUI:
         self.root.minsize(800, 500)
 
         # Networking and playback
-        self.socket = None
+        self.client = ThreadedClient()
         self.connected = False
         self.username = None
-        self.receive_thread = None
-        self.streaming_mode = False
-        self.current_download = None
-        self.download_file = None
-        self.last_stream_request = ""
-        self.last_command = ""
+        self.partial_downloads = {}  # song -> PartialDownload
+        self.progressive_songs = {}  # song -> progressive playback state
+        self.stream_requested_at = {}  # song -> perf_counter() when the user pressed play
         self.current_song = None
+        self.paused = False
+        # Play queue: a playlist played in order, its next songs fetched while the current one plays
+        self.play_queue = []
+        self.play_queue_index = 0
+        self.play_queue_started = False  # the current queue song has begun playing
+        self.queued_song = None  # handed to pygame.mixer.music.queue, starts when the current one ends
+        self.prefetch_songs = set()  # downloading ahead of their turn, so they must not play when done
+        self.prefetched = {}  # song -> bytes it added to disk, for songs ready to play
+        self.prefetch_skipped = set()  # songs the server could not send
+        self.prefetch_command = None  # the request prefetching is waiting on
+        self.prefetch_sent_at = 0.0
+        self.prefetch_bytes = 0
+        self.prefetch_resume_at = 0.0  # no new prefetch request before this perf_counter()
+        self.chat_pending = []  # lines waiting for the next render tick
+        self.chat_render_scheduled = False
+        self.chat_archive = collections.deque(maxlen=CHAT_ARCHIVE_LINES)
+        # List contents, shared by every view that shows them
+        self.library_model = PagedListModel(self.fetch_library_page, LIBRARY_PAGE_SIZE)
+        self.library_filter_job = None
+        self.library_search = None  # the SEARCH whose results the library pane should show
+        self.playlists_model = ListModel()
+        self.playlist_songs_model = ListModel()
+        self.shown_playlist = None  # whose songs playlist_songs_model holds
 
         # Audio
         pygame.init()
         pygame.mixer.init()
+        pygame.mixer.music.set_endevent(MUSIC_END)
+        # pygame only posts events with a video subsystem; without one, songs are not queued
+        self.music_end_events = pygame.display.get_init()
         self.download_dir = "downloads"
         os.makedirs(self.download_dir, exist_ok=True)
+        self.download_cache = DownloadCache(os.path.join(self.download_dir, "cache"),
+                                            DOWNLOAD_CACHE_MB * 1024 * 1024)
 
         # UI
         self.status_var = tk.StringVar(value="Not connected")
+        self.room_var = tk.StringVar(value="Room: lobby")
         self.now_playing_var = tk.StringVar(value="No song playing")
 
         self.build_ui()
         self.set_ui_state(False)
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(EVENT_POLL_MS, self.poll_events)
 
     def build_ui(self):
         self.main_frame = ttk.Frame(self.root)
@@ -61,6 +350,17 @@ class MusicChatClientGUI:
         # Chat section
         self.chat_frame = ttk.LabelFrame(self.paned_window, text="Chat")
         self.paned_window.add(self.chat_frame, weight=1)
+        self.room_frame = ttk.Frame(self.chat_frame)
+        self.room_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(self.room_frame, textvariable=self.room_var).pack(side=tk.LEFT, padx=5)
+        self.room_entry = ttk.Entry(self.room_frame, width=16)
+        self.room_entry.pack(side=tk.LEFT, padx=5)
+        self.room_entry.bind("<Return>", self.join_room)
+        self.join_room_button = ttk.Button(self.room_frame, text="Join Room", command=self.join_room)
+        self.join_room_button.pack(side=tk.LEFT, padx=2)
+        self.leave_room_button = ttk.Button(self.room_frame, text="Leave Room", command=self.leave_room)
+        self.leave_room_button.pack(side=tk.LEFT, padx=2)
+        ttk.Button(self.room_frame, text="Older Messages", command=self.show_older_messages).pack(side=tk.RIGHT, padx=2)
         self.chat_display = scrolledtext.ScrolledText(self.chat_frame, wrap=tk.WORD, state=tk.DISABLED, height=16)
         self.chat_display.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         self.chat_input_frame = ttk.Frame(self.chat_frame)
@@ -80,7 +380,20 @@ class MusicChatClientGUI:
         # Library tab
         self.library_frame = ttk.Frame(self.notebook)
         self.notebook.add(self.library_frame, text="Library")
-        self.library_list = tk.Listbox(self.library_frame)
+        self.library_search_frame = ttk.Frame(self.library_frame)
+        self.library_search_frame.pack(fill=tk.X, padx=5, pady=2)
+        ttk.Label(self.library_search_frame, text="Search:").pack(side=tk.LEFT, padx=2)
+        self.library_filter_var = tk.StringVar()
+        self.library_filter_var.trace_add("write", self.on_library_filter_changed)
+        ttk.Entry(self.library_search_frame, textvariable=self.library_filter_var).pack(
+            side=tk.LEFT, fill=tk.X, expand=True, padx=2)
+        self.library_match_anywhere_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.library_search_frame, text="Match anywhere", variable=self.library_match_anywhere_var,
+                        command=self.on_library_filter_changed).pack(side=tk.LEFT, padx=2)
+        self.library_search_tags_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.library_search_frame, text="Search tags", variable=self.library_search_tags_var,
+                        command=self.on_library_filter_changed).pack(side=tk.LEFT, padx=2)
+        self.library_list = VirtualListView(self.library_frame, self.library_model)
         self.library_list.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         self.library_list.bind("<Double-1>", self.play_selected_song)
         self.library_button_frame = ttk.Frame(self.library_frame)
@@ -98,7 +411,7 @@ class MusicChatClientGUI:
         self.playlists_list_frame = ttk.Frame(self.playlists_pane)
         self.playlists_pane.add(self.playlists_list_frame, weight=1)
         ttk.Label(self.playlists_list_frame, text="Playlists:").pack(anchor=tk.W, padx=5, pady=2)
-        self.playlists_list = tk.Listbox(self.playlists_list_frame, selectmode=tk.SINGLE)
+        self.playlists_list = VirtualListView(self.playlists_list_frame, self.playlists_model)
         self.playlists_list.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         self.playlists_list.bind("<<ListboxSelect>>", self.load_playlist_songs)
         self.playlist_button_frame = ttk.Frame(self.playlists_list_frame)
@@ -120,13 +433,15 @@ class MusicChatClientGUI:
         self.playlists_pane.add(self.playlist_songs_frame, weight=1)
         self.playlist_name_var = tk.StringVar(value="No playlist selected")
         ttk.Label(self.playlist_songs_frame, textvariable=self.playlist_name_var).pack(anchor=tk.W, padx=5, pady=2)
-        self.playlist_songs_list = tk.Listbox(self.playlist_songs_frame)
+        self.playlist_songs_list = VirtualListView(self.playlist_songs_frame, self.playlist_songs_model)
         self.playlist_songs_list.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         self.playlist_songs_list.bind("<Double-1>", self.play_selected_playlist_song)
         self.playlist_songs_button_frame = ttk.Frame(self.playlist_songs_frame)
         self.playlist_songs_button_frame.pack(fill=tk.X, padx=5, pady=5)
         self.play_playlist_song_button = ttk.Button(self.playlist_songs_button_frame, text="Play", command=self.play_selected_playlist_song)
         self.play_playlist_song_button.pack(side=tk.LEFT, padx=2)
+        self.play_all_button = ttk.Button(self.playlist_songs_button_frame, text="Play All", command=self.play_playlist)
+        self.play_all_button.pack(side=tk.LEFT, padx=2)
         self.add_to_playlist_button = ttk.Button(self.playlist_songs_button_frame, text="Add Song", command=self.add_song_to_playlist)
         self.add_to_playlist_button.pack(side=tk.LEFT, padx=2)
         self.remove_from_playlist_button = ttk.Button(self.playlist_songs_button_frame, text="Remove", command=self.remove_song_from_playlist)
@@ -137,12 +452,16 @@ class MusicChatClientGUI:
         self.notebook.add(self.player_frame, text="Player")
         ttk.Label(self.player_frame, text="Now Playing:").pack(anchor=tk.W, padx=10, pady=5)
         ttk.Label(self.player_frame, textvariable=self.now_playing_var, font=("Arial", 12, "bold")).pack(anchor=tk.W, padx=10, pady=5)
+        self.up_next_var = tk.StringVar(value="")
+        ttk.Label(self.player_frame, textvariable=self.up_next_var).pack(anchor=tk.W, padx=10)
         self.player_controls_frame = ttk.Frame(self.player_frame)
         self.player_controls_frame.pack(fill=tk.X, padx=10, pady=10)
         self.play_pause_button = ttk.Button(self.player_controls_frame, text="Play/Pause", command=self.toggle_play_pause)
         self.play_pause_button.pack(side=tk.LEFT, padx=5)
         self.stop_button = ttk.Button(self.player_controls_frame, text="Stop", command=self.stop_playback)
         self.stop_button.pack(side=tk.LEFT, padx=5)
+        self.next_button = ttk.Button(self.player_controls_frame, text="Next", command=self.play_next)
+        self.next_button.pack(side=tk.LEFT, padx=5)
         self.volume_frame = ttk.Frame(self.player_frame)
         self.volume_frame.pack(fill=tk.X, padx=10, pady=10)
         ttk.Label(self.volume_frame, text="Volume:").pack(side=tk.LEFT, padx=5)
@@ -151,25 +470,44 @@ class MusicChatClientGUI:
                                        variable=self.volume_var, command=self.set_volume)
         self.volume_slider.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         pygame.mixer.music.set_volume(0.7)
+        self.buffering_frame = ttk.Frame(self.player_frame)
+        self.buffering_frame.pack(fill=tk.X, padx=10, pady=10)
+        self.progressive_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(self.buffering_frame, text="Start playback while downloading",
+                        variable=self.progressive_var).pack(side=tk.LEFT, padx=5)
+        ttk.Label(self.buffering_frame, text="Prebuffer (KB):").pack(side=tk.LEFT, padx=5)
+        self.prebuffer_kb_var = tk.IntVar(value=PREBUFFER_KB)
+        ttk.Spinbox(self.buffering_frame, from_=16, to=8192, increment=16, width=6,
+                    textvariable=self.prebuffer_kb_var).pack(side=tk.LEFT, padx=5)
 
     def set_ui_state(self, enabled):
         state = tk.NORMAL if enabled else tk.DISABLED
         self.chat_input.config(state=state)
         self.send_button.config(state=state)
+        self.room_entry.config(state=state)
+        self.join_room_button.config(state=state)
+        self.leave_room_button.config(state=state)
         self.refresh_library_button.config(state=state)
-        self.play_library_button.config(state=state)
         self.refresh_playlists_button.config(state=state)
         self.create_playlist_button.config(state=state)
         self.delete_playlist_button.config(state=state)
         self.merge_playlist_button.config(state=state)
         self.combine_playlist_button.config(state=state)
         self.view_playlist_button.config(state=state)
-        self.play_playlist_song_button.config(state=state)
         self.add_to_playlist_button.config(state=state)
         self.remove_from_playlist_button.config(state=state)
-        self.play_pause_button.config(state=state)
-        self.stop_button.config(state=state)
-        self.volume_slider.config(state=state)
+        # Cached songs stay playable while disconnected
+        cached = self.download_cache.names()
+        playback_state = tk.NORMAL if enabled or cached else tk.DISABLED
+        self.play_library_button.config(state=playback_state)
+        self.play_playlist_song_button.config(state=playback_state)
+        self.play_all_button.config(state=playback_state)
+        self.play_pause_button.config(state=playback_state)
+        self.stop_button.config(state=playback_state)
+        self.next_button.config(state=playback_state)
+        self.volume_slider.config(state=playback_state)
+        if not enabled:
+            self.update_library_list(cached)
 
     def connect_to_server(self):
         username = self.username_var.get().strip()
@@ -177,40 +515,24 @@ class MusicChatClientGUI:
             messagebox.showerror("Error", "Please enter a username")
             return
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((SERVER_HOST, SERVER_PORT))
-            self.username = username
-            self.socket.sendall(f"JOIN_CHAT {username}".encode())
-            response = self.socket.recv(1024).decode().strip()
-            if response == "JOIN_SUCCESS":
-                self.connected = True
-                self.status_var.set(f"Connected as {username}")
-                self.connect_button.config(text="Disconnect", command=self.disconnect_from_server)
-                self.set_ui_state(True)
-                self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
-                self.receive_thread.start()
-                self.refresh_library()
-                self.refresh_playlists()
-                self.add_chat_message("SERVER", f"Welcome, {username}!")
-            else:
-                messagebox.showerror("Connection Error", f"Failed to join: {response}")
-                self.socket.close()
+            self.client.connect(SERVER_HOST, SERVER_PORT, username)
         except Exception as e:
             messagebox.showerror("Connection Error", f"Error connecting to server: {e}")
-            try:
-                self.socket.close()
-            except:
-                pass
+            return
+        self.username = username
+        self.connected = True
+        self.status_var.set(f"Connected as {username}")
+        self.connect_button.config(text="Disconnect", command=self.disconnect_from_server)
+        self.set_ui_state(True)
+        self.refresh_library()
+        self.refresh_playlists()
+        self.add_chat_message("SERVER", f"Welcome, {username}!")
 
     def disconnect_from_server(self):
         if self.connected:
-            try:
-                self.socket.sendall("LEAVE_CHAT".encode())
-            except:
-                pass
             self.connected = False
             try:
-                self.socket.close()
+                self.client.close()
             except:
                 pass
             self.status_var.set("Not connected")
@@ -219,10 +541,40 @@ class MusicChatClientGUI:
             self.add_chat_message("CLIENT", "Disconnected from server")
 
     def add_chat_message(self, sender, message):
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, f"{sender}: {message}\n")
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state=tk.DISABLED)
+        """Queue a line for the next render tick"""
+        self.chat_pending.append(f"{sender}: {message}\n")
+        if not self.chat_render_scheduled:
+            self.chat_render_scheduled = True
+            self.root.after(CHAT_RENDER_MS, self.render_chat)
+
+    def render_chat(self):
+        """Insert everything queued since the last tick at once, then trim to the scrollback"""
+        self.chat_render_scheduled = False
+        text = "".join(self.chat_pending)
+        self.chat_pending.clear()
+        display = self.chat_display
+        # Only follow new messages if the user has not scrolled up to read older ones
+        at_bottom = display.yview()[1] >= 1.0
+        display.config(state=tk.NORMAL)
+        display.insert(tk.END, text)
+        excess = int(display.index("end-1c").split(".")[0]) - 1 - CHAT_SCROLLBACK_LINES
+        if excess > 0:
+            self.chat_archive.extend(display.get("1.0", f"{excess + 1}.0").splitlines())
+            display.delete("1.0", f"{excess + 1}.0")
+        display.config(state=tk.DISABLED)
+        if at_bottom:
+            display.see(tk.END)
+
+    def show_older_messages(self):
+        """Open the lines trimmed from the chat display in a window of their own"""
+        window = tk.Toplevel(self.root)
+        window.title("Older Messages")
+        window.geometry("500x400")
+        archive = scrolledtext.ScrolledText(window, wrap=tk.WORD)
+        archive.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        archive.insert(tk.END, "\n".join(self.chat_archive) or "No older messages")
+        archive.config(state=tk.DISABLED)
+        archive.see(tk.END)
 
     def send_chat_message(self, event=None):
         if not self.connected:
@@ -231,7 +583,7 @@ class MusicChatClientGUI:
         message = self.chat_input.get().strip()
         if message:
             try:
-                self.socket.sendall(f"CHAT {message}".encode())
+                self.send_command(f"CHAT {message}")
                 self.chat_input.delete(0, tk.END)
             except Exception as e:
                 messagebox.showerror("Error", f"Error sending message: {e}")
@@ -239,115 +591,455 @@ class MusicChatClientGUI:
                 self.status_var.set("Connection lost")
                 self.set_ui_state(False)
 
-    def receive_messages(self):
-        while self.connected:
+    def join_room(self, event=None):
+        if not self.connected:
+            messagebox.showinfo("Not Connected", "You must connect to the server first")
+            return
+        room = self.room_entry.get().strip()
+        if not room:
+            messagebox.showinfo("No Room", "Please enter a room name")
+            return
+        try:
+            self.send_command(f"JOIN {room}")
+            self.room_entry.delete(0, tk.END)
+        except Exception as e:
+            messagebox.showerror("Error", f"Error: {e}")
+
+    def leave_room(self):
+        if not self.connected:
+            messagebox.showinfo("Not Connected", "You must connect to the server first")
+            return
+        try:
+            self.send_command("PART")
+        except Exception as e:
+            messagebox.showerror("Error", f"Error: {e}")
+
+    def send_command(self, command, sink=None, flags=0):
+        """Send a framed command; its reply comes back through poll_events"""
+        return self.client.send(command, sink, flags)
+
+    def poll_events(self):
+        """Handle what the network thread queued since the last tick, a batch at a time"""
+        for event in self.client.drain_events(EVENT_BATCH):
             try:
-                data = self.socket.recv(1024)
-                if not data:
-                    break
-                if self.streaming_mode:
-                    if b"STREAM_END\n" in data:
-                        streaming_parts = data.split(b"STREAM_END\n", 1)
-                        if streaming_parts[0]:
-                            self.download_file.write(streaming_parts[0])
-                        self.download_file.close()
-                        try:
-                            full_path = os.path.join(self.download_dir, self.current_download)
-                            pygame.mixer.music.load(full_path)
-                            pygame.mixer.music.play()
-                            self.current_song = self.current_download
-                            self.now_playing_var.set(self.current_song)
-                            self.add_chat_message("CLIENT", f"Now playing: {self.current_song}")
-                        except Exception as e:
-                            self.add_chat_message("ERROR", f"Error playing music: {e}")
-                        self.streaming_mode = False
-                        if len(streaming_parts) > 1 and streaming_parts[1]:
-                            self.process_message(streaming_parts[1])
-                    else:
-                        self.download_file.write(data)
-                else:
-                    self.process_message(data)
+                self.handle_event(event)
             except Exception as e:
-                if self.connected:
-                    self.root.after(0, lambda: messagebox.showerror("Connection Error", f"Error receiving data: {e}"))
-                    self.connected = False
-                    self.root.after(0, lambda: self.status_var.set("Connection lost"))
-                    self.root.after(0, lambda: self.set_ui_state(False))
-                break
-
-    def process_message(self, data):
+                self.add_chat_message("ERROR", f"Error processing message: {e}")
+        self.update_play_queue()
+        self.root.after(EVENT_POLL_MS, self.poll_events)
+
+    def handle_event(self, event):
+        kind, command, data = event.kind, event.command, event.data
+        if command and command == self.prefetch_command:
+            self.handle_prefetch_event(event)
+        elif kind == "response" and command.startswith("LIST_LIBRARY_PAGE"):
+            # Pages arrive as the list scrolls; they are not worth a chat line each
+            self.library_model.add_page(command, *parse_library_page(data))
+        elif kind == "response" and command.startswith("SEARCH"):
+            if command == self.library_search:
+                self.library_model.set(result.name for result in parse_search_results(data))
+        elif kind == "chat":
+            self.add_chat_message(*data)
+        elif kind == "response":
+            self.add_chat_message("SERVER", data)
+            if command == "LIST_PLAYLISTS":
+                self.update_playlists_list(data.strip().split('\n'))
+            elif command.startswith("LIST_SONGS_IN_PLAYLIST") and command.split(maxsplit=1)[1] == self.shown_playlist:
+                self.update_playlist_songs_list(data.strip().split('\n'))
+            elif command.startswith(("CREATE_PLAYLIST", "DELETE_PLAYLIST", "ADD_SONG_TO_PLAYLIST",
+                                     "REMOVE_SONG_FROM_PLAYLIST")):
+                self.apply_playlist_change(command, data)
+            elif data.startswith("Joined room "):
+                self.room_var.set(f"Room: {self.client.room}")
+            elif command.startswith("STREAM_IF_CHANGED") and data == "NOT_MODIFIED":
+                song_name = stream_command_song(command)
+                self.drop_unstarted_download(song_name)
+                self.play_downloaded_song(song_name, "cached")
+            elif command.startswith(STREAM_COMMANDS) and data.startswith("Error"):
+                song_name = stream_command_song(command)
+                self.drop_unstarted_download(song_name)
+                if self.play_queue and song_name == self.play_queue[self.play_queue_index]:
+                    # Skip queue songs that cannot be played rather than stopping there
+                    self.play_next()
+        elif kind == "stream_start":
+            self.request_rest(data)
+            if data.offset == 0:
+                self.add_chat_message("CLIENT", f"Receiving song: {data.song}")
+            elif data.song not in self.progressive_songs and data.song in self.partial_downloads:
+                # (a song that finished within this batch has already left both)
+                self.add_chat_message("CLIENT", f"Resuming {data.song} at {data.offset}/{data.total} bytes")
+        elif kind == "stream_end":
+            self.finish_download(data.song)
+            if data.song in self.partial_downloads:
+                self.check_progressive_start(self.partial_downloads[data.song])
+        elif kind == "playable":
+            self.check_progressive_start(data)
+        elif kind == "underrun":
+            self.add_chat_message("CLIENT", f"Buffering {data[0]}: underrun #{data[1]}")
+        elif kind == "error":
+            self.add_chat_message("ERROR", f"Error processing message: {data}")
+        elif kind == "disconnected":
+            if self.connected:
+                self.connected = False
+                messagebox.showerror("Connection Error", f"Error receiving data: {data}")
+                self.status_var.set("Connection lost")
+                self.set_ui_state(False)
+            self.close_partial_downloads()
+
+    def request_rest(self, info):
+        """Once a progressive song's size is known, queue the tail (for tag lookups) and then the rest"""
+        progressive = self.progressive_songs.get(info.song)
+        if progressive is None or progressive["rest_requested"]:
+            return
+        progressive["rest_requested"] = True
+        prefix_end = info.offset + info.length
+        tail_start = max(prefix_end, info.total - TAIL_PREFETCH)
+        if tail_start < info.total:
+            self.stream_range(info.song, tail_start, info.total - tail_start)
+        if prefix_end < tail_start:
+            self.stream_range(info.song, prefix_end, tail_start - prefix_end)
+
+    def stream_range(self, song_name, offset, length):
+        self.send_command(f"STREAM_RANGE {offset} {length} {song_name}", self.download_sink(song_name))
+
+    def download_sink(self, song_name):
+        """A sink for a stream of the song, created here so the network thread never touches our dicts"""
+        progressive = self.progressive_songs.get(song_name)
+        return DownloadSink(self.client, self.get_partial_download(song_name),
+                            progressive["prebuffer"] if progressive else None)
+
+    def finish_download(self, song_name):
+        """A stream ended; once every range is on disk, move the song into the cache and play it"""
+        download = self.partial_downloads.get(song_name)
+        if download is None or not download.complete():
+            return
+        progressive = self.progressive_songs.pop(song_name, None)
         try:
-            if data.startswith(b"CHAT_MESSAGE\n"):
-                message = data[len(b"CHAT_MESSAGE\n"):].decode()
-                sender, content = message.split(":", 1)
-                self.root.after(0, lambda: self.add_chat_message(sender.strip(), content.strip()))
-            elif data.startswith(b"COMMAND_RESPONSE\n"):
-                response = data[len(b"COMMAND_RESPONSE\n"):].decode()
-                self.root.after(0, lambda: self.add_chat_message("SERVER", response))
-                if "LIST_LIBRARY_SONGS" in self.last_command:
-                    songs = response.strip().split('\n')
-                    self.root.after(0, lambda: self.update_library_list(songs))
-                elif "LIST_PLAYLISTS" in self.last_command:
-                    playlists = response.strip().split('\n')
-                    self.root.after(0, lambda: self.update_playlists_list(playlists))
-                elif "LIST_SONGS_IN_PLAYLIST" in self.last_command:
-                    songs = response.strip().split('\n')
-                    self.root.after(0, lambda: self.update_playlist_songs_list(songs))
-            elif data.startswith(b"STREAM_START\n"):
-                song_name = self.last_stream_request.split()[-1]
-                self.root.after(0, lambda: self.add_chat_message("CLIENT", f"Receiving song: {song_name}"))
-                self.current_download = song_name
-                download_path = os.path.join(self.download_dir, self.current_download)
-                self.download_file = open(download_path, "wb")
-                self.streaming_mode = True
-                stream_parts = data.split(b"STREAM_START\n", 1)
-                if len(stream_parts) > 1 and stream_parts[1]:
-                    if b"STREAM_END\n" in stream_parts[1]:
-                        end_parts = stream_parts[1].split(b"STREAM_END\n", 1)
-                        self.download_file.write(end_parts[0])
-                        self.download_file.close()
-                        try:
-                            full_path = os.path.join(self.download_dir, self.current_download)
-                            pygame.mixer.music.load(full_path)
-                            pygame.mixer.music.play()
-                            self.current_song = self.current_download
-                            self.root.after(0, lambda: self.now_playing_var.set(self.current_song))
-                            self.root.after(0, lambda: self.add_chat_message("CLIENT", f"Now playing: {self.current_song}"))
-                        except Exception as e:
-                            self.root.after(0, lambda: self.add_chat_message("ERROR", f"Error playing music: {e}"))
-                        self.streaming_mode = False
-                        if len(end_parts) > 1 and end_parts[1]:
-                            self.process_message(end_parts[1])
-                    else:
-                        self.download_file.write(stream_parts[1])
+            download.finish(self.download_cache)
+        except OSError:
+            # The player still holds the .part open (Windows); stream_song finishes it later
+            pass
+        del self.partial_downloads[song_name]
+        if song_name in self.prefetch_songs:
+            # Fetched ahead for the play queue; it plays when its turn comes
+            self.prefetch_songs.discard(song_name)
+            self.prefetched[song_name] = download.total
+        elif progressive is None or not progressive["started"]:
+            self.play_downloaded_song(song_name)
+
+    def close_partial_downloads(self):
+        """Flush unfinished downloads so they can be resumed on the next connect"""
+        for download in list(self.partial_downloads.values()):
+            download.abort()
+            try:
+                if download.total is not None:
+                    download.save()
+                download.close()
+            except OSError:
+                pass
+        self.partial_downloads.clear()
+        self.progressive_songs.clear()
+        self.prefetch_songs.clear()
+        self.prefetch_command = None
+
+    def check_progressive_start(self, download):
+        """Start playback once the prebuffer and the file's tail are on disk"""
+        progressive = self.progressive_songs.get(download.song)
+        if progressive is None or progressive["started"] or self.partial_downloads.get(download.song) is not download:
+            return
+        if progressive_ready(download, progressive["prebuffer"]):
+            progressive["started"] = True
+            self.play_progressive(download)
+
+    def play_progressive(self, download):
+        song_name = download.song
+
+        def on_underrun(count):
+            # Called on pygame's decoding thread
+            self.client.post(Event("underrun", 0, None, (song_name, count)))
+
+        try:
+            reader = ProgressiveReader(download, on_underrun=on_underrun)
+            pygame.mixer.music.load(reader, song_name)
+            pygame.mixer.music.play()
+            self.music_started(song_name)
+            self.current_song = song_name
+            self.now_playing_var.set(self.current_song)
+            self.add_chat_message("CLIENT", f"Now playing: {self.current_song} (still downloading)")
+            self.report_time_to_first_audio(song_name, "progressive")
         except Exception as e:
-            self.root.after(0, lambda: self.add_chat_message("ERROR", f"Error processing message: {e}"))
+            self.add_chat_message("ERROR", f"Error playing music: {e}")
+
+    def report_time_to_first_audio(self, song_name, mode):
+        requested_at = self.stream_requested_at.pop(song_name, None)
+        if requested_at is not None:
+            elapsed = (time.perf_counter() - requested_at) * 1000
+            self.add_chat_message("CLIENT", f"Time to first audio for {song_name}: {elapsed:.0f} ms ({mode})")
+
+    def get_partial_download(self, song_name):
+        download = self.partial_downloads.get(song_name)
+        if download is None:
+            download = PartialDownload(self.download_dir, song_name)
+            self.partial_downloads[song_name] = download
+        return download
+
+    def drop_unstarted_download(self, song_name):
+        """Forget a download nothing was fetched for, e.g. when the cached copy is still current"""
+        download = self.partial_downloads.get(song_name)
+        if download is not None and download.total is None:
+            del self.partial_downloads[song_name]
+
+    def play_downloaded_song(self, song_name, mode="full download"):
+        try:
+            full_path = self.download_cache.touch(song_name)
+            if full_path is None:
+                raise FileNotFoundError(f"{song_name} is not in the download cache")
+            pygame.mixer.music.load(full_path)
+            pygame.mixer.music.play()
+            self.music_started(song_name)
+            self.current_song = song_name
+            self.now_playing_var.set(self.current_song)
+            self.add_chat_message("CLIENT", f"Now playing: {self.current_song}")
+            self.report_time_to_first_audio(song_name, mode)
+        except Exception as e:
+            self.add_chat_message("ERROR", f"Error playing music: {e}")
+
+    def music_started(self, song_name):
+        # Loading a song drops whatever was queued behind the old one, and may report the old one ending
+        if self.music_end_events:
+            pygame.event.clear(MUSIC_END)
+        self.queued_song = None
+        self.paused = False
+        if self.play_queue and song_name == self.play_queue[self.play_queue_index]:
+            self.play_queue_started = True
+
+    def play_playlist(self):
+        """Play the shown playlist in order, from the selected song or the top"""
+        songs = list(self.playlist_songs_model)
+        if not songs:
+            messagebox.showinfo("Empty Playlist", "Please select a playlist with songs in it")
+            return
+        selection = self.playlist_songs_list.curselection()
+        self.play_queue = songs
+        self.play_queue_index = selection[0] if selection else 0
+        self.prefetched.clear()
+        self.prefetch_skipped.clear()
+        self.add_chat_message("CLIENT", f"Playing playlist {self.shown_playlist} ({len(songs)} songs)")
+        self.start_queue_song()
+
+    def start_queue_song(self):
+        song_name = self.play_queue[self.play_queue_index]
+        self.play_queue_started = False
+        self.update_up_next()
+        if song_name in self.prefetched:
+            self.play_downloaded_song(song_name, "prefetched")
+        else:
+            self.stream_song(song_name)
+
+    def play_next(self):
+        """Skip to the next song of the play queue"""
+        if not self.play_queue:
+            return
+        index = self.next_queue_index()
+        if index >= len(self.play_queue):
+            self.add_chat_message("CLIENT", "End of playlist")
+            self.stop_play_queue()
+            return
+        self.play_queue_index = index
+        self.start_queue_song()
+
+    def next_queue_index(self):
+        """Index of the song after the current one, passing over songs the server could not send"""
+        index = self.play_queue_index + 1
+        while index < len(self.play_queue) and self.play_queue[index] in self.prefetch_skipped:
+            index += 1
+        return index
+
+    def stop_play_queue(self):
+        self.play_queue = []
+        self.queued_song = None
+        self.prefetched.clear()
+        self.update_up_next()
+
+    def update_up_next(self):
+        index = self.next_queue_index()
+        if self.play_queue and index < len(self.play_queue):
+            self.up_next_var.set(f"Up next: {self.play_queue[index]}")
+        else:
+            self.up_next_var.set("")
+
+    def update_play_queue(self):
+        """Follow pygame through the play queue and keep the next songs coming"""
+        if not self.play_queue:
+            return
+        for event in pygame.event.get(MUSIC_END) if self.music_end_events else ():
+            if self.queued_song is not None:
+                # pygame went straight on to the queued song
+                self.play_queue_index = self.next_queue_index()
+                song_name, self.queued_song = self.queued_song, None
+                self.current_song = song_name
+                self.now_playing_var.set(song_name)
+                self.add_chat_message("CLIENT", f"Now playing: {song_name} (gapless)")
+                self.update_up_next()
+        if self.play_queue_started and not self.paused and not pygame.mixer.music.get_busy():
+            # Ended with nothing queued behind it, e.g. the next song was not downloaded in time
+            self.play_next()
+            return
+        self.prefetch_next()
+        self.queue_next()
+
+    def prefetch_next(self):
+        """Fetch upcoming songs one range at a time, within the rate and disk budgets"""
+        if not self.connected or self.prefetch_command is not None or \
+                time.perf_counter() < self.prefetch_resume_at:
+            return
+        if self.play_queue[self.play_queue_index] in self.partial_downloads:
+            # The song that is playing gets the connection to itself
+            return
+        # Unfinished downloads hold disk space too, whether or not they are still upcoming
+        budget = PREFETCH_DISK_MB * 1024 * 1024 - \
+            sum(download.downloaded() for download in self.partial_downloads.values())
+        start = self.play_queue_index + 1
+        for song_name in self.play_queue[start:start + PREFETCH_TRACKS]:
+            if song_name in self.prefetched:
+                budget -= self.prefetched[song_name]
+                continue
+            if song_name in self.prefetch_skipped:
+                continue
+            cached_version = self.download_cache.lookup(song_name)
+            if cached_version is not None and song_name not in self.partial_downloads:
+                command, length = f"STREAM_IF_CHANGED {cached_version} {song_name}", 0
+            else:
+                download = self.get_partial_download(song_name)
+                missing = download.missing()
+                if not missing:
+                    continue
+                if download.total is not None and download.total - download.downloaded() > budget:
+                    # Wait for the queue to move on and free some of the budget
+                    return
+                offset, length = missing[0]
+                length = min(length or PREFETCH_CHUNK_KB * 1024, PREFETCH_CHUNK_KB * 1024)
+                command = f"STREAM_RANGE {offset} {length} {song_name}"
+            self.prefetch_songs.add(song_name)
+            self.prefetch_command = command
+            self.prefetch_sent_at = time.perf_counter()
+            self.prefetch_bytes = length
+            # Quiet, so fetching ahead does not tell the room we are playing it
+            self.send_command(command, self.download_sink(song_name), FLAG_QUIET)
+            return
+
+    def handle_prefetch_event(self, event):
+        """Replies to prefetch requests; they stay out of the chat"""
+        song_name = stream_command_song(event.command)
+        if event.kind == "stream_end":
+            self.finish_download(song_name)
+        elif event.kind == "response":
+            self.drop_unstarted_download(song_name)
+            if event.data == "NOT_MODIFIED":
+                self.prefetch_songs.discard(song_name)
+                self.prefetched[song_name] = 0  # the cached copy is still current
+            else:
+                self.prefetch_songs.discard(song_name)
+                self.prefetch_skipped.add(song_name)
+        elif event.kind == "error":
+            self.add_chat_message("ERROR", f"Error prefetching {song_name}: {event.data}")
+        else:
+            return
+        # Space requests out so prefetching averages at most PREFETCH_KBPS
+        self.prefetch_command = None
+        self.prefetch_resume_at = self.prefetch_sent_at + self.prefetch_bytes * 8 / (PREFETCH_KBPS * 1000)
+
+    def queue_next(self):
+        """Hand the next song to pygame once it is on disk, so it follows without a gap"""
+        index = self.next_queue_index()
+        if not self.music_end_events or self.queued_song is not None or not self.play_queue_started or \
+                index >= len(self.play_queue) or self.play_queue[index] not in self.prefetched:
+            return
+        song_name = self.play_queue[index]
+        path = self.download_cache.touch(song_name)
+        if path is None:
+            self.prefetched.pop(song_name)
+            return
+        try:
+            pygame.mixer.music.queue(path)
+            self.queued_song = song_name
+        except Exception as e:
+            self.prefetched.pop(song_name)
+            self.add_chat_message("ERROR", f"Error queueing {song_name}: {e}")
 
     def update_library_list(self, songs):
-        self.library_list.delete(0, tk.END)
-        for song in songs:
-            if song and not song.startswith("Error:"):
-                self.library_list.insert(tk.END, song)
+        self.library_model.set(song for song in songs if song and not song.startswith("Error:"))
+
+    def fetch_library_page(self, offset, limit):
+        """Ask for one page of the library under the current search; returns the command as its token"""
+        if not self.connected:
+            return None
+        term = self.library_filter_var.get().strip()
+        if self.library_match_anywhere_var.get():
+            command = library_page_command(limit, offset=offset, contains=term)
+        else:
+            command = library_page_command(limit, offset=offset, prefix=term)
+        self.send_command(command)
+        return command
+
+    def on_library_filter_changed(self, *args):
+        """Search once the user stops typing rather than on every key"""
+        if self.library_filter_job is not None:
+            self.root.after_cancel(self.library_filter_job)
+        self.library_filter_job = self.root.after(LIBRARY_FILTER_DELAY_MS, self.apply_library_filter)
+
+    def apply_library_filter(self):
+        self.library_filter_job = None
+        if not self.connected:
+            return
+        term = self.library_filter_var.get().strip()
+        if term and self.library_search_tags_var.get():
+            # Ranked matches on title, artist and album instead of file names
+            self.library_search = f"SEARCH {term}"
+            self.send_command(self.library_search)
+        else:
+            self.library_search = None
+            self.library_model.reset()
 
     def update_playlists_list(self, playlists):
-        self.playlists_list.delete(0, tk.END)
-        for playlist in playlists:
-            if playlist and not playlist.startswith("Error:"):
-                self.playlists_list.insert(tk.END, playlist)
+        self.playlists_model.set(p for p in playlists if p and not p.startswith("Error:"))
 
     def update_playlist_songs_list(self, songs):
-        self.playlist_songs_list.delete(0, tk.END)
-        for song in songs:
-            if song and not song.startswith("Error:"):
-                self.playlist_songs_list.insert(tk.END, song)
+        self.playlist_songs_model.set(song for song in songs if song and not song.startswith("Error:"))
+
+    def apply_playlist_change(self, command, response):
+        """Patch the lists after our own playlist edits instead of fetching them again"""
+        if command.startswith("CREATE_PLAYLIST") and response == "Playlist created":
+            self.playlists_model.append(command.split(maxsplit=1)[1])
+        elif command.startswith("DELETE_PLAYLIST") and response == "Playlist deleted":
+            name = command.split(maxsplit=1)[1]
+            self.playlists_model.remove_all(name)
+            if name == self.shown_playlist:
+                self.show_playlist(None)
+        elif command.startswith("ADD_SONG_TO_PLAYLIST") and response == "Song added":
+            _, name, song = command.split(maxsplit=2)
+            if name == self.shown_playlist:
+                self.playlist_songs_model.append(song)
+        elif command.startswith("REMOVE_SONG_FROM_PLAYLIST") and response == "Song removed":
+            _, name, song = command.split(maxsplit=2)
+            if name == self.shown_playlist:
+                self.playlist_songs_model.remove_all(song)
+
+    def show_playlist(self, playlist_name):
+        """Point the songs pane at a playlist (None to clear it); its songs arrive with the reply"""
+        self.shown_playlist = playlist_name
+        self.playlist_songs_model.set([])
+        if playlist_name is None:
+            self.playlist_name_var.set("No playlist selected")
+        else:
+            self.playlist_name_var.set(f"Playlist: {playlist_name}")
 
     def refresh_library(self):
         if not self.connected:
             messagebox.showinfo("Not Connected", "You must connect to the server first")
             return
         try:
-            self.last_command = "LIST_LIBRARY_SONGS"
-            self.socket.sendall(self.last_command.encode())
+            self.apply_library_filter()
         except Exception as e:
             messagebox.showerror("Error", f"Error: {e}")
             self.connected = False
@@ -359,10 +1051,8 @@ class MusicChatClientGUI:
             messagebox.showinfo("Not Connected", "You must connect to the server first")
             return
         try:
-            self.last_command = "LIST_PLAYLISTS"
-            self.socket.sendall(self.last_command.encode())
-            self.playlist_songs_list.delete(0, tk.END)
-            self.playlist_name_var.set("No playlist selected")
+            self.send_command("LIST_PLAYLISTS")
+            self.show_playlist(None)
         except Exception as e:
             messagebox.showerror("Error", f"Error: {e}")
             self.connected = False
@@ -376,10 +1066,9 @@ class MusicChatClientGUI:
         if not selection:
             return
         playlist_name = self.playlists_list.get(selection[0])
-        self.playlist_name_var.set(f"Playlist: {playlist_name}")
+        self.show_playlist(playlist_name)
         try:
-            self.last_command = f"LIST_SONGS_IN_PLAYLIST {playlist_name}"
-            self.socket.sendall(self.last_command.encode())
+            self.send_command(f"LIST_SONGS_IN_PLAYLIST {playlist_name}")
         except Exception as e:
             messagebox.showerror("Error", f"Error: {e}")
             self.connected = False
@@ -393,8 +1082,7 @@ class MusicChatClientGUI:
         playlist_name = simpledialog.askstring("Create Playlist", "Enter playlist name:")
         if playlist_name:
             try:
-                self.last_command = f"CREATE_PLAYLIST {playlist_name}"
-                self.socket.sendall(self.last_command.encode())
+                self.send_command(f"CREATE_PLAYLIST {playlist_name}")
             except Exception as e:
                 messagebox.showerror("Error", f"Error: {e}")
                 self.connected = False
@@ -412,8 +1100,7 @@ class MusicChatClientGUI:
         playlist_name = self.playlists_list.get(selection[0])
         if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete playlist '{playlist_name}'?"):
             try:
-                self.last_command = f"DELETE_PLAYLIST {playlist_name}"
-                self.socket.sendall(self.last_command.encode())
+                self.send_command(f"DELETE_PLAYLIST {playlist_name}")
             except Exception as e:
                 messagebox.showerror("Error", f"Error: {e}")
                 self.connected = False
@@ -435,10 +1122,8 @@ class MusicChatClientGUI:
         song_dialog.transient(self.root)
         song_dialog.grab_set()
         ttk.Label(song_dialog, text="Select a song to add:").pack(padx=10, pady=5, anchor=tk.W)
-        song_listbox = tk.Listbox(song_dialog)
+        song_listbox = VirtualListView(song_dialog, self.library_model)
         song_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
-        for i in range(self.library_list.size()):
-            song_listbox.insert(tk.END, self.library_list.get(i))
         def add_selected_song():
             song_selection = song_listbox.curselection()
             if not song_selection:
@@ -446,8 +1131,7 @@ class MusicChatClientGUI:
                 return
             song_name = song_listbox.get(song_selection[0])
             try:
-                self.last_command = f"ADD_SONG_TO_PLAYLIST {playlist_name} {song_name}"
-                self.socket.sendall(self.last_command.encode())
+                self.send_command(f"ADD_SONG_TO_PLAYLIST {playlist_name} {song_name}")
                 song_dialog.destroy()
             except Exception as e:
                 messagebox.showerror("Error", f"Error: {e}")
@@ -469,8 +1153,7 @@ class MusicChatClientGUI:
         playlist_name = self.playlists_list.get(playlist_selection[0])
         song_name = self.playlist_songs_list.get(song_selection[0])
         try:
-            self.last_command = f"REMOVE_SONG_FROM_PLAYLIST {playlist_name} {song_name}"
-            self.socket.sendall(self.last_command.encode())
+            self.send_command(f"REMOVE_SONG_FROM_PLAYLIST {playlist_name} {song_name}")
         except Exception as e:
             messagebox.showerror("Error", f"Error: {e}")
             self.connected = False
@@ -478,46 +1161,81 @@ class MusicChatClientGUI:
             self.set_ui_state(False)
 
     def play_selected_song(self, event=None):
-        if not self.connected:
-            messagebox.showinfo("Not Connected", "You must connect to the server first")
-            return
         selection = self.library_list.curselection()
         if not selection:
             messagebox.showinfo("No Selection", "Please select a song to play")
             return
         song_name = self.library_list.get(selection[0])
+        self.stop_play_queue()
         self.stream_song(song_name)
 
     def play_selected_playlist_song(self, event=None):
-        if not self.connected:
-            messagebox.showinfo("Not Connected", "You must connect to the server first")
-            return
         selection = self.playlist_songs_list.curselection()
         if not selection:
             messagebox.showinfo("No Selection", "Please select a song to play")
             return
         song_name = self.playlist_songs_list.get(selection[0])
+        self.stop_play_queue()
         self.stream_song(song_name)
 
-    def stream_song(self, song_name):
+    def stream_song(self, song_name, seek_offset=0):
+        """Play a song from the download cache, or fetch only the byte ranges not already on disk"""
+        # Once asked for, a song being prefetched plays as soon as it is complete
+        self.prefetch_songs.discard(song_name)
+        cached_version = self.download_cache.lookup(song_name)
         if not self.connected:
-            messagebox.showinfo("Not Connected", "You must connect to the server first")
+            if cached_version is not None:
+                self.play_downloaded_song(song_name, "offline")
+            else:
+                messagebox.showinfo("Not Connected", "You must connect to the server first")
             return
         try:
-            self.last_stream_request = f"STREAM_SONG {song_name}"
-            self.socket.sendall(self.last_stream_request.encode())
+            self.stream_requested_at[song_name] = time.perf_counter()
+            if cached_version is not None and song_name not in self.partial_downloads:
+                # One round trip: NOT_MODIFIED plays the cached copy, otherwise the new version streams
+                self.send_command(f"STREAM_IF_CHANGED {cached_version} {song_name}", self.download_sink(song_name))
+                return
+            download = self.get_partial_download(song_name)
+            if self.progressive_var.get() and not download.complete():
+                prebuffer = max(1, self.prebuffer_kb_var.get()) * 1024
+                self.progressive_songs[song_name] = {
+                    "prebuffer": prebuffer,
+                    "rest_requested": download.total is not None,
+                    "started": False,
+                }
+                if download.total is None:
+                    # Fetch just the prebuffer first; the rest is queued once the size is known
+                    self.stream_range(song_name, 0, prebuffer)
+                    return
+            if download.total is None:
+                self.send_command(f"STREAM_SONG {song_name}", self.download_sink(song_name))
+                return
+            if download.complete():
+                download.finish(self.download_cache)
+                del self.partial_downloads[song_name]
+                self.play_downloaded_song(song_name)
+                return
+            ranges = download.missing(seek_offset)
+            if song_name in self.progressive_songs:
+                ranges = tail_first(ranges, download.total - TAIL_PREFETCH)
+            for offset, length in ranges:
+                self.stream_range(song_name, offset, length)
+            self.check_progressive_start(download)
         except Exception as e:
             messagebox.showerror("Error", f"Error: {e}")
 
     def toggle_play_pause(self):
         if pygame.mixer.music.get_busy():
             pygame.mixer.music.pause()
+            self.paused = True
             self.add_chat_message("CLIENT", "Playback paused")
         else:
             pygame.mixer.music.unpause()
+            self.paused = False
             self.add_chat_message("CLIENT", "Playback resumed")
 
     def stop_playback(self):
+        self.stop_play_queue()
         pygame.mixer.music.stop()
         self.now_playing_var.set("No song playing")
         self.add_chat_message("CLIENT", "Playback stopped")
@@ -544,7 +1262,7 @@ class MusicChatClientGUI:
         ttk.Label(merge_win, text=f"Source playlist: {source_playlist}", font=("Arial", 10, "bold")).pack(pady=5)
         ttk.Label(merge_win, text="Select target playlist to merge into:").pack(pady=5)
         target_var = tk.StringVar()
-        playlists = [self.playlists_list.get(i) for i in range(self.playlists_list.size()) if self.playlists_list.get(i) != source_playlist]
+        playlists = [pl for pl in self.playlists_model if pl != source_playlist]
         if not playlists:
             messagebox.showinfo("No Target", "No other playlists available to merge into")
             merge_win.destroy()
@@ -557,8 +1275,7 @@ class MusicChatClientGUI:
                 messagebox.showinfo("Selection", "Please select a target playlist")
                 return
             try:
-                self.last_command = f"MERGE_PLAYLISTS {source_playlist} {target}"
-                self.socket.sendall(self.last_command.encode())
+                self.send_command(f"MERGE_PLAYLISTS {source_playlist} {target}")
                 merge_win.destroy()
             except Exception as e:
                 messagebox.showerror("Error", f"Error: {e}")
@@ -585,7 +1302,7 @@ class MusicChatClientGUI:
         ttk.Label(combine_win, text=f"First playlist: {playlist1}", font=("Arial", 10, "bold")).pack(pady=5)
         ttk.Label(combine_win, text="Select second playlist to combine with:").pack(pady=5)
         second_var = tk.StringVar()
-        playlists = [self.playlists_list.get(i) for i in range(self.playlists_list.size()) if self.playlists_list.get(i) != playlist1]
+        playlists = [pl for pl in self.playlists_model if pl != playlist1]
         if not playlists:
             messagebox.showinfo("No Target", "No other playlists available to combine with")
             combine_win.destroy()
@@ -606,8 +1323,7 @@ class MusicChatClientGUI:
                 messagebox.showinfo("Input Needed", "Please enter a name for the combined playlist")
                 return
             try:
-                self.last_command = f"COMBINE_PLAYLISTS {playlist1} {playlist2} {new_name}"
-                self.socket.sendall(self.last_command.encode())
+                self.send_command(f"COMBINE_PLAYLISTS {playlist1} {playlist2} {new_name}")
                 combine_win.destroy()
             except Exception as e:
                 messagebox.showerror("Error", f"Error: {e}")
@@ -625,9 +1341,8 @@ class MusicChatClientGUI:
         if not playlist_name:
             return
         try:
-            self.last_command = f"LIST_SONGS_IN_PLAYLIST {playlist_name}"
-            self.socket.sendall(self.last_command.encode())
-            self.playlist_name_var.set(f"Playlist: {playlist_name}")
+            self.show_playlist(playlist_name)
+            self.send_command(f"LIST_SONGS_IN_PLAYLIST {playlist_name}")
         except Exception as e:
             messagebox.showerror("Error", f"Error: {e}")
             self.connected = False
@@ -638,6 +1353,7 @@ class MusicChatClientGUI:
         if messagebox.askokcancel("Quit", "Do you want to quit?"):
             if self.connected:
                 self.disconnect_from_server()
+            self.client.shutdown()
             pygame.quit()
             self.root.destroy()
 
@@ -0,0 +1,104 @@
+"""Cache of fully downloaded songs on the client, keyed by version
+
+Each file is stored once under its server-assigned version (derived from
+the file's size, mtime and inode), so a song that comes back unchanged,
+or shows up again under a hard-linked name, is never kept or fetched
+twice. The file keeps the song's extension so the player can tell its
+format from the name. index.json maps song names to
+versions and records when each file was last played; once the cache
+grows past its quota the least recently played files are removed.
+"""
+import json
+import os
+import threading
+import time
+
+class DownloadCache:
+    """Downloaded songs by version; safe to call from any thread"""
+
+    def __init__(self, directory, quota_bytes):
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock = threading.Lock()
+        self.songs = {}  # song -> version
+        self.files = {}  # version -> [size, last played, file name suffix]
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.songs = index["songs"]
+            self.files = index["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+        for info in self.files.values():
+            if len(info) == 2:
+                # Cached before files kept their suffix
+                info.append("")
+        # Forget anything whose file was removed behind our back
+        self.files = {v: info for v, info in self.files.items() if os.path.exists(self.path(v))}
+        self.songs = {s: v for s, v in self.songs.items() if v in self.files}
+
+    def path(self, version):
+        return os.path.join(self.directory, version + self.files[version][2])
+
+    def lookup(self, song):
+        """Version of the cached copy of song, or None"""
+        with self.lock:
+            return self.songs.get(song)
+
+    def names(self):
+        with self.lock:
+            return sorted(self.songs)
+
+    def size(self):
+        with self.lock:
+            return sum(info[0] for info in self.files.values())
+
+    def touch(self, song):
+        """Mark song as just played; returns the path to play, or None if it is not cached"""
+        with self.lock:
+            version = self.songs.get(song)
+            if version is None:
+                return None
+            self.files[version][1] = time.time()
+            self._save()
+            return self.path(version)
+
+    def add(self, song, version, source_path):
+        """Move a finished download into the cache under its version"""
+        with self.lock:
+            if version in self.files:
+                # Same bytes already cached, possibly under another name
+                os.remove(source_path)
+            else:
+                suffix = os.path.splitext(song)[1]
+                path = os.path.join(self.directory, version + suffix)
+                os.replace(source_path, path)
+                self.files[version] = [os.path.getsize(path), time.time(), suffix]
+            self.songs[song] = version
+            self.files[version][1] = time.time()
+            self._evict(keep=version)
+            self._save()
+            return self.path(version)
+
+    def _evict(self, keep):
+        total = sum(info[0] for info in self.files.values())
+        for version in sorted(self.files, key=lambda v: self.files[v][1]):
+            if total <= self.quota_bytes:
+                break
+            if version == keep:
+                continue
+            try:
+                os.remove(self.path(version))
+            except OSError:
+                # Still open in the player on Windows; try again next time
+                continue
+            total -= self.files.pop(version)[0]
+            self.songs = {s: v for s, v in self.songs.items() if v != version}
+
+    def _save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"songs": self.songs, "files": self.files}, f)
+        os.replace(tmp_path, self.index_path)
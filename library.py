@@ -0,0 +1,214 @@
+"""In-memory directory index behind the library listings and the metadata index
+
+The directory is scanned once with os.scandir and then kept current with
+inotify on Linux, or by polling the directory's mtime elsewhere. The
+encoded listing is cached, so answering LIST_LIBRARY_SONGS again costs
+nothing until something in the directory changes. Paged and filtered
+listings come from a list of names sorted case-insensitively, built once
+per change: a page or a prefix is found by bisection, and the matches for
+the latest substring filter are kept so paging through them does not
+rescan the library.
+"""
+import asyncio
+import bisect
+import ctypes
+import ctypes.util
+import os
+import stat
+import struct
+import sys
+
+POLL_INTERVAL = 2.0
+
+# inotify(7) constants
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+def _load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_inotify()
+
+def scan_directory(directory):
+    """Return {name: (size, mtime_ns)} for the regular files in a directory"""
+    entries = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                if entry.is_file():
+                    st = entry.stat()
+                    entries[entry.name] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                pass
+    return entries
+
+def stat_entries(directory, names):
+    """Stat a batch of names; missing or non-regular files map to None"""
+    result = {}
+    for name in names:
+        try:
+            st = os.stat(os.path.join(directory, name))
+            result[name] = (st.st_size, st.st_mtime_ns) if stat.S_ISREG(st.st_mode) else None
+        except OSError:
+            result[name] = None
+    return result
+
+class LibraryIndex:
+    """Names, sizes and mtimes of the files in one directory
+
+    Only the event loop thread mutates the index; disk access happens on
+    the executor passed in.
+    """
+
+    def __init__(self, directory, executor=None):
+        self.directory = directory
+        self.executor = executor
+        self.entries = {}
+        self._listing = None
+        self._sorted = None  # [(casefolded name, name)], sorted
+        self._filtered = None  # (needle, matching entries of _sorted)
+        self.on_change = None  # called on the event loop whenever entries change
+        self._inotify_fd = None
+        self._poll_task = None
+        self._dir_mtime = None
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def names(self):
+        return sorted(self.entries)
+
+    def listing(self):
+        """Newline separated, sorted names as bytes; cached until the next change"""
+        if self._listing is None:
+            self._listing = '\n'.join(self.names()).encode()
+        return self._listing
+
+    def page(self, limit, cursor=None, offset=0, prefix="", contains=""):
+        """Up to limit names in case-insensitive order, after the name `cursor` or from
+        position `offset` among the matches; returns (names, total matches, position of the first)"""
+        if self._sorted is None:
+            self._sorted = sorted((name.casefold(), name) for name in self.entries)
+        matches, lo, hi = self._sorted, 0, len(self._sorted)
+        if contains:
+            needle = contains.casefold()
+            if self._filtered is None or self._filtered[0] != needle:
+                self._filtered = (needle, [key for key in self._sorted if needle in key[0]])
+            matches, hi = self._filtered[1], len(self._filtered[1])
+        if prefix:
+            folded = prefix.casefold()
+            lo = bisect.bisect_left(matches, (folded,), lo, hi)
+            hi = bisect.bisect_left(matches, (folded + '\U0010ffff',), lo, hi)
+        if cursor is not None:
+            start = bisect.bisect_right(matches, (cursor.casefold(), cursor), lo, hi)
+        else:
+            start = min(lo + max(0, offset), hi)
+        names = [name for _, name in matches[start:min(hi, start + limit)]]
+        return names, hi - lo, start - lo
+
+    def _invalidate(self):
+        self._listing = None
+        self._sorted = None
+        self._filtered = None
+        if self.on_change:
+            self.on_change()
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def replace(self, entries):
+        if entries != self.entries:
+            self.entries = entries
+            self._invalidate()
+
+    def apply(self, changes):
+        """Apply {name: (size, mtime_ns) or None} from stat_entries"""
+        changed = False
+        for name, info in changes.items():
+            if info is None:
+                changed |= self.entries.pop(name, None) is not None
+            elif self.entries.get(name) != info:
+                self.entries[name] = info
+                changed = True
+        if changed:
+            self._invalidate()
+
+    async def refresh(self):
+        self.replace(await self._run(scan_directory, self.directory))
+
+    async def start(self):
+        """Scan the directory and keep watching it"""
+        await self.refresh()
+        if _libc is not None and self._start_inotify():
+            return
+        self._poll_task = asyncio.create_task(self._poll())
+
+    def _start_inotify(self):
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return False
+        if _libc.inotify_add_watch(fd, os.fsencode(self.directory), WATCH_MASK) < 0:
+            os.close(fd)
+            return False
+        self._inotify_fd = fd
+        asyncio.get_running_loop().add_reader(fd, self._on_inotify)
+        return True
+
+    def _on_inotify(self):
+        changed, rescan = set(), False
+        while True:
+            try:
+                data = os.read(self._inotify_fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                    rescan = True
+                elif name:
+                    changed.add(os.fsdecode(name))
+        if rescan:
+            asyncio.create_task(self.refresh())
+        elif changed:
+            asyncio.create_task(self._apply_changes(changed))
+
+    async def _apply_changes(self, names):
+        self.apply(await self._run(stat_entries, self.directory, names))
+
+    async def _poll(self):
+        """Fallback watcher: rescan whenever the directory's mtime moves"""
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            try:
+                mtime = (await self._run(os.stat, self.directory)).st_mtime_ns
+            except OSError:
+                continue
+            if mtime != self._dir_mtime:
+                self._dir_mtime = mtime
+                await self.refresh()
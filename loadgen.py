@@ -0,0 +1,363 @@
+"""Headless load generator speaking the framed protocol
+
+    python loadgen.py --spawn --users 1000 --rooms 20 --duration 30 --seed 7
+    python loadgen.py --port 12345 --server-pid 4242 --users 200
+
+Simulated users join, chat, browse the library and playlists, edit their
+own playlist and stream songs, each at a configurable Poisson rate. Users
+are spread over --processes load processes so the generator itself is not
+the bottleneck. With --spawn a server is started in a temporary directory
+with a synthetic library; otherwise point it at a running server, and give
+--server-pid to have its CPU and RSS reported.
+
+Every user's actions, song choices and pacing come from --seed, so runs
+with the same arguments issue the same commands. The report covers
+throughput, p50/p95/p99 latency per command, chat delivery lag (sender
+and receivers share a clock, so load and server must be on one host) and
+the server's CPU time and peak RSS.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from protocol import (HEADER, MSG_CHAT_MESSAGE, MSG_COMMAND, MSG_COMMAND_RESPONSE, MSG_MESSAGE_SENT,
+                      MSG_STREAM_DATA, MSG_STREAM_END, PROTOCOL_VERSION, encode_frame, encode_join)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+CHAT_MARKER = b" load@"
+
+class Results:
+    """What one load process measured; merged in the parent"""
+
+    def __init__(self):
+        self.latencies = {}  # command -> [seconds]
+        self.chat_lag = []
+        self.stream_bytes = 0
+        self.errors = 0
+        self.users = 0
+
+    def merge(self, other):
+        for command, values in other.latencies.items():
+            self.latencies.setdefault(command, []).extend(values)
+        self.chat_lag.extend(other.chat_lag)
+        self.stream_bytes += other.stream_bytes
+        self.errors += other.errors
+        self.users += other.users
+
+class User:
+    def __init__(self, index, args, songs, results):
+        self.index = index
+        self.name = f"user{index}"
+        self.args = args
+        self.songs = songs
+        self.results = results
+        self.rng = random.Random(f"{args.seed}-{index}")
+        self.pending = {}  # request id -> (command, sent at)
+        self.next_request_id = 1
+        self.playlist = f"load-{args.seed}-{index}"
+        self.playlist_songs = []
+        self.playlist_created = False
+        self.streaming = False
+        self.writer = None
+        self.joined_ns = None
+
+    async def run(self, deadline):
+        reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        options = f"PROTO={PROTOCOL_VERSION}"
+        if self.args.rooms > 1:
+            options += f" ROOM=room{self.index % self.args.rooms}"
+        self.writer.write(encode_join(self.name, options))
+        if not (await reader.readline()).startswith(b"JOIN_SUCCESS"):
+            self.results.errors += 1
+            self.writer.close()
+            return
+        self.results.users += 1
+        self.joined_ns = time.perf_counter_ns()
+        receiving = asyncio.create_task(self.receive(reader))
+        actions = [(self.chat, self.args.chat_rate), (self.browse, self.args.browse_rate),
+                   (self.edit_playlist, self.args.playlist_rate), (self.stream, self.args.stream_rate)]
+        actions = [(action, rate) for action, rate in actions if rate > 0]
+        total_rate = sum(rate for _, rate in actions)
+        try:
+            while actions:
+                delay = self.rng.expovariate(total_rate)
+                if time.monotonic() + delay >= deadline:
+                    break
+                await asyncio.sleep(delay)
+                action = self.rng.choices([a for a, _ in actions], [r for _, r in actions])[0]
+                action()
+            # Give outstanding requests a moment to finish
+            wait_until = time.monotonic() + 2
+            while self.pending and time.monotonic() < wait_until:
+                await asyncio.sleep(0.05)
+        finally:
+            receiving.cancel()
+            self.writer.close()
+
+    def send(self, command):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.pending[request_id] = (command.split(maxsplit=1)[0], time.perf_counter())
+        self.writer.write(encode_frame(MSG_COMMAND, command.encode(), request_id))
+
+    def chat(self):
+        self.send(f"CHAT hello from {self.name}{CHAT_MARKER.decode()}{time.perf_counter_ns()}")
+
+    def browse(self):
+        choice = self.rng.randrange(3)
+        if choice == 0:
+            self.send("LIST_LIBRARY_SONGS")
+        elif choice == 1 or not self.playlist_created:
+            self.send("LIST_PLAYLISTS")
+        else:
+            self.send(f"LIST_SONGS_IN_PLAYLIST {self.playlist}")
+
+    def edit_playlist(self):
+        if not self.playlist_created:
+            self.playlist_created = True
+            self.send(f"CREATE_PLAYLIST {self.playlist}")
+        elif self.playlist_songs and self.rng.random() < 0.3:
+            song = self.playlist_songs.pop(self.rng.randrange(len(self.playlist_songs)))
+            self.send(f"REMOVE_SONG_FROM_PLAYLIST {self.playlist} {song}")
+        elif self.songs:
+            song = self.rng.choice(self.songs)
+            self.playlist_songs.append(song)
+            self.send(f"ADD_SONG_TO_PLAYLIST {self.playlist} {song}")
+
+    def stream(self):
+        # One stream at a time per user, like the GUI
+        if self.songs and not self.streaming:
+            self.streaming = True
+            self.send(f"STREAM_SONG {self.rng.choice(self.songs)}")
+
+    def finish(self, request_id):
+        request = self.pending.pop(request_id, None)
+        if request is not None:
+            command, sent_at = request
+            self.results.latencies.setdefault(command, []).append(time.perf_counter() - sent_at)
+            if command == "STREAM_SONG":
+                self.streaming = False
+
+    async def receive(self, reader):
+        buffer = b""
+        while True:
+            data = await reader.read(256 * 1024)
+            if not data:
+                return
+            now_ns = time.perf_counter_ns()
+            buffer += data
+            pos = 0
+            while len(buffer) - pos >= HEADER.size:
+                version, msg_type, flags, request_id, length = HEADER.unpack_from(buffer, pos)
+                if len(buffer) - pos - HEADER.size < length:
+                    break
+                start = pos + HEADER.size
+                pos = start + length
+                if msg_type == MSG_STREAM_DATA:
+                    self.results.stream_bytes += length
+                elif msg_type == MSG_CHAT_MESSAGE:
+                    marker = buffer.find(CHAT_MARKER, start, pos)
+                    if marker >= 0:
+                        sent_ns = int(buffer[marker + len(CHAT_MARKER):pos])
+                        # Older messages are history replayed on join, not live delivery
+                        if sent_ns >= self.joined_ns:
+                            self.results.chat_lag.append((now_ns - sent_ns) / 1e9)
+                elif msg_type in (MSG_COMMAND_RESPONSE, MSG_MESSAGE_SENT, MSG_STREAM_END):
+                    if msg_type == MSG_COMMAND_RESPONSE and buffer.startswith(b"Error", start):
+                        self.results.errors += 1
+                    self.finish(request_id)
+            buffer = buffer[pos:]
+
+def fetch_songs(host, port):
+    """Library listing, fetched once so every user picks from the same songs"""
+    sock = socket.create_connection((host, port))
+    try:
+        sock.sendall(encode_join("loadgen-probe", f"PROTO={PROTOCOL_VERSION}"))
+        data = b""
+        while b"\n" not in data:
+            data += sock.recv(4096)
+        data = data.partition(b"\n")[2]
+        sock.sendall(encode_frame(MSG_COMMAND, b"LIST_LIBRARY_SONGS", 1))
+        while True:
+            while len(data) >= HEADER.size:
+                version, msg_type, flags, request_id, length = HEADER.unpack_from(data)
+                if len(data) < HEADER.size + length:
+                    break
+                payload, data = data[HEADER.size:HEADER.size + length], data[HEADER.size + length:]
+                if msg_type == MSG_COMMAND_RESPONSE and request_id == 1:
+                    return [s for s in payload.decode().split('\n') if s]
+            chunk = sock.recv(65536)
+            if not chunk:
+                return []
+            data += chunk
+    finally:
+        sock.close()
+
+async def run_users(indexes, args, songs, start_at):
+    results = Results()
+    await asyncio.sleep(max(0, start_at - time.time()))
+    deadline = time.monotonic() + args.duration
+    users = []
+    for index in indexes:
+        users.append(asyncio.create_task(User(index, args, songs, results).run(deadline)))
+        # Stagger joins a little so the server is not hit by every JOIN_CHAT at once
+        await asyncio.sleep(args.ramp / max(1, len(indexes)))
+    for outcome in await asyncio.gather(*users, return_exceptions=True):
+        if isinstance(outcome, Exception):
+            results.errors += 1
+    return results
+
+def load_process(job):
+    indexes, args, songs, start_at = job
+    return asyncio.run(run_users(indexes, args, songs, start_at))
+
+# --- Server side ---
+
+def make_library(directory, count, size_kb, seed):
+    library = os.path.join(directory, "library")
+    os.makedirs(library, exist_ok=True)
+    rng = random.Random(seed)
+    for i in range(count):
+        with open(os.path.join(library, f"song{i:04d}.mp3"), "wb") as f:
+            f.write(rng.randbytes(size_kb * 1024))
+
+def spawn_server(directory, port, workers):
+    proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "server.py"), "--port", str(port),
+                             "--workers", str(workers)], cwd=directory,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+def process_tree(pid):
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+def cpu_and_rss(pids):
+    """Total CPU seconds and RSS bytes of the given processes, from /proc (Linux only)"""
+    ticks, rss = 0, 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])
+            rss += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            pass
+    return ticks / os.sysconf('SC_CLK_TCK'), rss
+
+class ServerSampler(threading.Thread):
+    """Samples the server's RSS while the load runs and its CPU time at both ends"""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.stop = threading.Event()
+        self.peak_rss = 0
+        self.cpu_start = self.cpu_end = 0.0
+
+    def run(self):
+        self.cpu_start, self.peak_rss = cpu_and_rss(process_tree(self.pid))
+        while not self.stop.wait(0.5):
+            self.peak_rss = max(self.peak_rss, cpu_and_rss(process_tree(self.pid))[1])
+        self.cpu_end, rss = cpu_and_rss(process_tree(self.pid))
+        self.peak_rss = max(self.peak_rss, rss)
+
+# --- Report ---
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+def report(results, elapsed, sampler):
+    total = sum(len(v) for v in results.latencies.values())
+    print(f"users joined {results.users}, errors {results.errors}, elapsed {elapsed:.1f} s")
+    print(f"throughput {total / elapsed:.0f} commands/s, streamed {results.stream_bytes / elapsed / 1e6:.1f} MB/s")
+    print(f"{'command':<28}{'count':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for command, values in sorted(results.latencies.items()):
+        values.sort()
+        print(f"{command:<28}{len(values):>8}{percentile(values, 0.5) * 1000:>9.1f}"
+              f"{percentile(values, 0.95) * 1000:>9.1f}{percentile(values, 0.99) * 1000:>9.1f}")
+    lag = sorted(results.chat_lag)
+    print(f"{'chat delivery lag':<28}{len(lag):>8}{percentile(lag, 0.5) * 1000:>9.1f}"
+          f"{percentile(lag, 0.95) * 1000:>9.1f}{percentile(lag, 0.99) * 1000:>9.1f}")
+    if sampler is not None:
+        cpu = sampler.cpu_end - sampler.cpu_start
+        print(f"server CPU {cpu:.1f} s ({cpu / elapsed * 100:.0f}% of one core), "
+              f"peak RSS {sampler.peak_rss / 2 ** 20:.1f} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--server-pid', type=int, help="report CPU and RSS of this running server")
+    parser.add_argument('--spawn', action='store_true', help="start a server with a synthetic library")
+    parser.add_argument('--workers', type=int, default=1, help="server worker processes with --spawn")
+    parser.add_argument('--songs', type=int, default=50, help="synthetic library size with --spawn")
+    parser.add_argument('--song-kb', type=int, default=512)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=1, help="spread users over this many rooms")
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--ramp', type=float, default=2, help="seconds over which users join")
+    parser.add_argument('--chat-rate', type=float, default=0.2, help="messages per second per user")
+    parser.add_argument('--browse-rate', type=float, default=0.1)
+    parser.add_argument('--playlist-rate', type=float, default=0.05)
+    parser.add_argument('--stream-rate', type=float, default=0.02)
+    parser.add_argument('--processes', type=int, default=max(1, min(4, os.cpu_count() or 1)))
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    directory, proc = None, None
+    if args.spawn:
+        directory = tempfile.TemporaryDirectory()
+        make_library(directory.name, args.songs, args.song_kb, args.seed)
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            args.port = s.getsockname()[1]
+        args.host = '127.0.0.1'
+        proc = spawn_server(directory.name, args.port, args.workers)
+        args.server_pid = proc.pid
+    try:
+        songs = fetch_songs(args.host, args.port)
+        sampler = ServerSampler(args.server_pid) if args.server_pid and os.path.exists("/proc") else None
+        start_at = time.time() + 1
+        jobs = [(range(i, args.users, args.processes), args, songs, start_at) for i in range(args.processes)]
+        if sampler is not None:
+            sampler.start()
+        with multiprocessing.Pool(args.processes) as pool:
+            results = Results()
+            for partial in pool.map(load_process, jobs):
+                results.merge(partial)
+        elapsed = time.time() - start_at
+        if sampler is not None:
+            sampler.stop.set()
+            sampler.join()
+        report(results, elapsed, sampler)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        if directory is not None:
+            directory.cleanup()
+
+if __name__ == '__main__':
+    main()
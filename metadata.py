@@ -0,0 +1,389 @@
+"""Song metadata, read once per file version and searchable from memory
+
+Title, artist, album, duration, bitrate and size are read in a process
+pool and stored in SQLite next to the size and mtime they were read at.
+On start the stored rows are loaded, so only files that are new or have
+changed since are read again. Tags come from mutagen when it is
+installed; otherwise a small reader handles ID3v1/ID3v2 tags and MPEG
+audio frame headers, which covers mp3 libraries.
+
+SEARCH is answered from an inverted index from words to songs. Every
+query word has to match a word of the song's title, artist, album or
+file name, and the last one may be a prefix so results keep up with
+typing. A match in the title ranks highest, then artist, album and file
+name.
+
+    python metadata.py library    # index a directory and print what was found
+"""
+import asyncio
+import bisect
+import collections
+import heapq
+import multiprocessing
+import os
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+METADATA_DB = "metadata.db"
+METADATA_WORKERS = os.cpu_count() or 1
+SYNC_BATCH = 64  # files read and committed together
+FIELD_WEIGHTS = (('title', 8), ('artist', 4), ('album', 2), ('name', 1))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    duration REAL,
+    bitrate INTEGER
+);
+"""
+
+SongMetadata = collections.namedtuple('SongMetadata', 'name size mtime_ns title artist album duration bitrate')
+
+# MPEG audio layer III: kbps by bitrate index, sample rates by index, per version
+MPEG1_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+MPEG2_BITRATES = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+ID3_TEXT_FRAMES = {b'TIT2': 'title', b'TPE1': 'artist', b'TALB': 'album',
+                   b'TT2': 'title', b'TP1': 'artist', b'TAL': 'album'}
+ID3_TAG_LIMIT = 256 * 1024  # text frames come first; embedded cover art after them is skipped
+
+def words(text):
+    return re.findall(r"\w+", text.casefold()) if text else []
+
+# --- Reading one file (runs in the process pool) ---
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+def _decode_text(data):
+    encoding, text = data[0], data[1:]
+    if encoding == 1:
+        text = text.decode('utf-16', 'replace')
+    elif encoding == 2:
+        text = text.decode('utf-16-be', 'replace')
+    elif encoding == 3:
+        text = text.decode('utf-8', 'replace')
+    else:
+        text = text.decode('latin-1')
+    return text.split('\0')[0].strip() or None
+
+def _read_id3v2(f, tags):
+    """Parse text frames from an ID3v2 tag at the start of the file; returns the audio offset"""
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    major, size = header[3], _syncsafe(header[6:10])
+    data = f.read(min(size, ID3_TAG_LIMIT))
+    id_size = 3 if major == 2 else 4
+    frame_header = id_size * 2 if major == 2 else 10
+    pos = 0
+    while pos + frame_header <= len(data):
+        frame_id = data[pos:pos + id_size]
+        if not frame_id.strip(b'\0'):
+            break
+        if major == 2:
+            length = int.from_bytes(data[pos + 3:pos + 6], 'big')
+        elif major == 4:
+            length = _syncsafe(data[pos + 4:pos + 8])
+        else:
+            length = int.from_bytes(data[pos + 4:pos + 8], 'big')
+        body = data[pos + frame_header:pos + frame_header + length]
+        field = ID3_TEXT_FRAMES.get(frame_id)
+        if field and body and not tags.get(field):
+            tags[field] = _decode_text(body)
+        pos += frame_header + length
+    return 10 + size
+
+def _read_id3v1(f, tags):
+    f.seek(-128, os.SEEK_END)
+    data = f.read(128)
+    if data[:3] != b'TAG':
+        return
+    for field, start in (('title', 3), ('artist', 33), ('album', 63)):
+        if not tags.get(field):
+            tags[field] = data[start:start + 30].split(b'\0')[0].decode('latin-1').strip() or None
+
+def _read_mpeg(f, offset, size, tags):
+    """Bitrate and duration from the first layer III frame, using a Xing/Info header if present"""
+    f.seek(offset)
+    data = f.read(64 * 1024)
+    for pos in range(len(data) - 4):
+        if data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+            continue
+        header = struct.unpack('>I', data[pos:pos + 4])[0]
+        version, layer = (header >> 19) & 3, (header >> 17) & 3
+        bitrate_index, rate_index = (header >> 12) & 15, (header >> 10) & 3
+        if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            continue
+        bitrate = (MPEG1_BITRATES if version == 3 else MPEG2_BITRATES)[bitrate_index]
+        sample_rate = SAMPLE_RATES[version][rate_index]
+        samples = 1152 if version == 3 else 576
+        mono = (header >> 6) & 3 == 3
+        side_info = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+        xing = pos + 4 + side_info
+        if len(data) >= xing + 12 and data[xing:xing + 4] in (b'Xing', b'Info') and \
+                struct.unpack('>I', data[xing + 4:xing + 8])[0] & 1:
+            frames = struct.unpack('>I', data[xing + 8:xing + 12])[0]
+            tags['duration'] = frames * samples / sample_rate
+            tags['bitrate'] = int((size - offset - pos) * 8 / tags['duration'] / 1000) if frames else bitrate
+        else:
+            tags['bitrate'] = bitrate
+            tags['duration'] = (size - offset - pos) * 8 / (bitrate * 1000)
+        return
+
+def _read_with_mutagen(path, tags):
+    audio = mutagen.File(path, easy=True)
+    if audio is None:
+        return False
+    for field in ('title', 'artist', 'album'):
+        values = audio.tags.get(field) if audio.tags else None
+        tags[field] = values[0] if values else None
+    info = getattr(audio, 'info', None)
+    tags['duration'] = getattr(info, 'length', None)
+    bitrate = getattr(info, 'bitrate', None)
+    tags['bitrate'] = bitrate // 1000 if bitrate else None
+    return True
+
+def read_metadata(path):
+    """Tags and audio properties of one file as a dict; missing values are None"""
+    tags = dict.fromkeys(('title', 'artist', 'album', 'duration', 'bitrate'))
+    tags['size'] = os.path.getsize(path)
+    if mutagen is not None:
+        try:
+            if _read_with_mutagen(path, tags):
+                return tags
+        except Exception:
+            pass
+    with open(path, 'rb') as f:
+        offset = _read_id3v2(f, tags)
+        if tags['size'] >= 128:
+            _read_id3v1(f, tags)
+        _read_mpeg(f, offset, tags['size'], tags)
+    return tags
+
+def _exit_with_parent(parent_pid):
+    """Pool initializer: a reader quits once the server is gone, however it ended"""
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+def read_metadata_safe(path):
+    try:
+        return read_metadata(path)
+    except (OSError, ValueError, IndexError, struct.error, ZeroDivisionError):
+        return None
+
+# --- Storage (runs on the disk executor) ---
+
+def _connect(path):
+    db = sqlite3.connect(path, timeout=5.0)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+def load_rows(path):
+    db = _connect(path)
+    try:
+        return [SongMetadata(*row) for row in db.execute(f"SELECT {', '.join(SongMetadata._fields)} FROM songs")]
+    finally:
+        db.close()
+
+def save_rows(path, rows, removed):
+    db = _connect(path)
+    try:
+        with db:
+            db.executemany(f"INSERT OR REPLACE INTO songs VALUES ({', '.join('?' * len(SongMetadata._fields))})", rows)
+            db.executemany("DELETE FROM songs WHERE name = ?", [(name,) for name in removed])
+    finally:
+        db.close()
+
+class MetadataIndex:
+    """Metadata for every file in a LibraryIndex, plus the word index SEARCH uses
+
+    Only the event loop thread touches the in-memory index; files are read
+    in a process pool and rows are written on the executor passed in.
+    """
+
+    def __init__(self, db_path, library, executor=None, workers=METADATA_WORKERS):
+        self.db_path = db_path
+        self.library = library
+        self.executor = executor
+        self.workers = workers
+        self.pool = None
+        self.records = {}  # name -> SongMetadata
+        self.postings = collections.defaultdict(dict)  # word -> {name: weight}
+        self._vocabulary = None  # sorted words, for prefix lookups
+        self._sync_task = None
+        self._sync_again = False
+        self.on_change = None  # called after each batch of changes has been stored
+
+    def __len__(self):
+        return len(self.records)
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def load(self):
+        """Replace the in-memory index with what is stored"""
+        rows = await self._run(load_rows, self.db_path)
+        self.records = {}
+        self.postings = collections.defaultdict(dict)
+        for row in rows:
+            self._add(row)
+        self._vocabulary = None
+
+    def _add(self, record):
+        self.records[record.name] = record
+        fields = record._asdict()
+        fields['name'] = os.path.splitext(record.name)[0]
+        for field, weight in FIELD_WEIGHTS:
+            for word in words(fields[field]):
+                names = self.postings[word]
+                if names.get(record.name, 0) < weight:
+                    names[record.name] = weight
+
+    def _remove(self, name):
+        record = self.records.pop(name, None)
+        if record is None:
+            return
+        for field in ('title', 'artist', 'album'):
+            for word in words(getattr(record, field)):
+                self._drop_posting(word, name)
+        for word in words(os.path.splitext(name)[0]):
+            self._drop_posting(word, name)
+
+    def _drop_posting(self, word, name):
+        names = self.postings.get(word)
+        if names is not None:
+            names.pop(name, None)
+            if not names:
+                del self.postings[word]
+
+    def request_sync(self):
+        """Bring the index up to date with the library; calls made while a sync runs are coalesced"""
+        if self._sync_task is not None and not self._sync_task.done():
+            self._sync_again = True
+            return
+        self._sync_task = asyncio.ensure_future(self._sync_loop())
+
+    async def _sync_loop(self):
+        while True:
+            self._sync_again = False
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"Metadata sync failed: {e}")
+            if not self._sync_again:
+                return
+
+    async def sync(self):
+        """Read new and changed files, forget removed ones; returns how many rows changed"""
+        entries = dict(self.library.entries)
+        stale = [name for name, (size, mtime_ns) in entries.items()
+                 if (record := self.records.get(name)) is None or (record.size, record.mtime_ns) != (size, mtime_ns)]
+        removed = [name for name in self.records if name not in entries]
+        if removed:
+            await self._run(save_rows, self.db_path, [], removed)
+            for name in removed:
+                self._remove(name)
+            self._changed()
+        if stale and self.pool is None:
+            # Spawned rather than forked so readers do not inherit the server's sockets
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_exit_with_parent, initargs=(os.getpid(),))
+        loop = asyncio.get_running_loop()
+        for start in range(0, len(stale), SYNC_BATCH):
+            batch = stale[start:start + SYNC_BATCH]
+            results = await asyncio.gather(*(
+                loop.run_in_executor(self.pool, read_metadata_safe, os.path.join(self.library.directory, name))
+                for name in batch))
+            rows = []
+            for name, tags in zip(batch, results):
+                size, mtime_ns = entries[name]
+                tags = tags or {}
+                rows.append(SongMetadata(name, size, mtime_ns, tags.get('title'), tags.get('artist'),
+                                         tags.get('album'), tags.get('duration'), tags.get('bitrate')))
+            await self._run(save_rows, self.db_path, rows, [])
+            for row in rows:
+                self._remove(row.name)
+                self._add(row)
+            self._changed()
+        return len(stale) + len(removed)
+
+    def _changed(self):
+        self._vocabulary = None
+        if self.on_change:
+            self.on_change()
+
+    def _matches(self, word, prefix):
+        if not prefix:
+            return self.postings.get(word, {})
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        merged = {}
+        i = bisect.bisect_left(self._vocabulary, word)
+        while i < len(self._vocabulary) and self._vocabulary[i].startswith(word):
+            for name, weight in self.postings[self._vocabulary[i]].items():
+                if merged.get(name, 0) < weight:
+                    merged[name] = weight
+            i += 1
+        return merged
+
+    def search(self, query, limit):
+        """Best matching records, highest score first, then by name"""
+        query_words = words(query)
+        if not query_words:
+            return []
+        # The last word may still be being typed, so it matches as a prefix
+        matches = [self._matches(word, i == len(query_words) - 1) for i, word in enumerate(query_words)]
+        matches.sort(key=len)
+        scores = dict(matches[0])
+        for names in matches[1:]:
+            scores = {name: score + names[name] for name, score in scores.items() if name in names}
+            if not scores:
+                return []
+        best = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [self.records[name] for name, _ in best]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+def format_record(record):
+    """One SEARCH result line: name, title, artist, album, seconds, kbps, bytes, tab separated"""
+    duration = f"{record.duration:.0f}" if record.duration else ""
+    return '\t'.join([record.name, record.title or "", record.artist or "", record.album or "",
+                      duration, str(record.bitrate or ""), str(record.size)])
+
+if __name__ == '__main__':
+    from library import LibraryIndex
+
+    async def main(directory):
+        library = LibraryIndex(directory)
+        await library.refresh()
+        index = MetadataIndex(METADATA_DB, library)
+        await index.load()
+        print(f"Read {await index.sync()} files")
+        index.close()
+        for record in index.records.values():
+            print(format_record(record))
+
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "library"))
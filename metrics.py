@@ -0,0 +1,125 @@
+"""Counters, gauges and latency histograms for the server
+
+Recording is a dict lookup plus, for histograms, a bisect over a fixed
+list of bucket bounds, so instrumenting a request costs the same however
+long the server has been running. Everything renders either as the plain
+text the STATS command returns or in the Prometheus text format.
+"""
+import bisect
+import collections
+
+# Upper bounds in seconds, from 100 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+class Metrics:
+    """Named counters and histograms, each optionally split by one label, plus gauges read on demand"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.counters = collections.defaultdict(int)  # (name, label) -> value
+        self.histograms = {}  # (name, label) -> Histogram
+        self.gauges = {}  # name -> callable returning a number
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, label=None):
+        self.counters[name, label] += value
+
+    def observe(self, name, value, label=None):
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            histogram = self.histograms[name, label] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def render_text(self):
+        """Human readable summary for the STATS command"""
+        lines = []
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"{name} {_number(func())}")
+        for (name, label), value in sorted(self.counters.items(), key=_sort_key):
+            lines.append(f"{name}{_label_text(label)} {value}")
+        for (name, label), h in sorted(self.histograms.items(), key=_sort_key):
+            average = h.sum / h.count if h.count else 0.0
+            lines.append(f"{name}{_label_text(label)} count={h.count} avg={average * 1000:.2f}ms "
+                         f"p50<={h.quantile(0.5) * 1000:g}ms p99<={h.quantile(0.99) * 1000:g}ms")
+        return '\n'.join(lines)
+
+    def render_prometheus(self, label_name="command"):
+        """Prometheus text exposition format, version 0.0.4"""
+        lines = []
+        for name, func in sorted(self.gauges.items()):
+            full = self.prefix + name
+            lines += self._header(name, full, "gauge")
+            lines.append(f"{full} {_number(func())}")
+        described = set()
+        for (name, label), value in sorted(self.counters.items(), key=_sort_key):
+            full = self.prefix + name
+            if name not in described:
+                described.add(name)
+                lines += self._header(name, full, "counter")
+            lines.append(f"{full}{_prom_labels(label_name, label)} {value}")
+        for (name, label), h in sorted(self.histograms.items(), key=_sort_key):
+            full = self.prefix + name
+            if name not in described:
+                described.add(name)
+                lines += self._header(name, full, "histogram")
+            cumulative = 0
+            for bound, n in zip(list(h.bounds) + ['+Inf'], h.counts):
+                cumulative += n
+                le = bound if bound == '+Inf' else f"{bound:g}"
+                lines.append(f"{full}_bucket{_prom_labels(label_name, label, le=le)} {cumulative}")
+            lines.append(f"{full}_sum{_prom_labels(label_name, label)} {h.sum:.6f}")
+            lines.append(f"{full}_count{_prom_labels(label_name, label)} {h.count}")
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name, full, kind):
+        lines = [f"# HELP {full} {self.help[name]}"] if name in self.help else []
+        return lines + [f"# TYPE {full} {kind}"]
+
+def _sort_key(item):
+    name, label = item[0]
+    return name, label or ""
+
+def _number(value):
+    """A gauge value in full; byte counts do not fit in the 6 digits of :g"""
+    return str(int(value)) if isinstance(value, int) else repr(float(value))
+
+def _label_text(label):
+    return f"[{label}]" if label else ""
+
+def _prom_labels(label_name, label, le=None):
+    pairs = []
+    if label:
+        pairs.append(f'{label_name}="{label}"')
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
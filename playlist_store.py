@@ -0,0 +1,232 @@
+"""SQLite-backed playlist storage
+
+Replaces the one-text-file-per-playlist layout under playlist/. The
+database runs in WAL mode so listings never wait for writers, song
+membership is indexed, and commands touching several playlists run in a
+single transaction.
+
+The old directory format can still be moved in and out:
+
+    python playlist_store.py import playlist
+    python playlist_store.py export playlist
+"""
+import contextlib
+import os
+import sqlite3
+import sys
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS playlist_songs (
+    playlist_id INTEGER NOT NULL REFERENCES playlists(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    song TEXT NOT NULL,
+    PRIMARY KEY (playlist_id, position)
+);
+CREATE INDEX IF NOT EXISTS playlist_songs_by_song ON playlist_songs (playlist_id, song);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+class PlaylistStore:
+    """Playlists and their songs; safe to call from any thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._listing = None
+        self._listing_lock = threading.Lock()
+        self.on_change = None  # called from any thread after playlists are created or deleted
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        # SQLite connections must not be used across fork(), so a forked worker opens its own
+        if db is None or self._local.pid != os.getpid():
+            # Autocommit mode; transactions are opened explicitly below
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA foreign_keys=ON")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE so read-then-write commands cannot lose each other's updates"""
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _playlist_id(self, db, name):
+        row = db.execute("SELECT id FROM playlists WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _append(self, db, playlist_id, songs):
+        row = db.execute("SELECT MAX(position) FROM playlist_songs WHERE playlist_id = ?",
+                         (playlist_id,)).fetchone()
+        start = (row[0] if row[0] is not None else -1) + 1
+        db.executemany("INSERT INTO playlist_songs (playlist_id, position, song) VALUES (?, ?, ?)",
+                       ((playlist_id, start + i, song) for i, song in enumerate(songs)))
+
+    def _songs(self, db, playlist_id):
+        rows = db.execute("SELECT song FROM playlist_songs WHERE playlist_id = ? ORDER BY position",
+                          (playlist_id,))
+        return [row[0] for row in rows]
+
+    def _changed(self):
+        self.invalidate()
+        if self.on_change is not None:
+            self.on_change()
+
+    def invalidate(self):
+        """Drop the cached listing, e.g. after another process changed the database"""
+        with self._listing_lock:
+            self._listing = None
+
+    # --- Queries ---
+
+    def names(self):
+        return [row[0] for row in self._connection().execute("SELECT name FROM playlists ORDER BY name")]
+
+    def listing(self):
+        """Newline separated playlist names as bytes; cached until a playlist is created or deleted"""
+        with self._listing_lock:
+            if self._listing is None:
+                self._listing = '\n'.join(self.names()).encode()
+            return self._listing
+
+    def songs(self, name):
+        """Songs in order, or None if the playlist does not exist"""
+        db = self._connection()
+        playlist_id = self._playlist_id(db, name)
+        if playlist_id is None:
+            return None
+        return self._songs(db, playlist_id)
+
+    # --- Commands ---
+
+    def create(self, name):
+        with self.transaction() as db:
+            if self._playlist_id(db, name) is not None:
+                return False
+            db.execute("INSERT INTO playlists (name) VALUES (?)", (name,))
+        self._changed()
+        return True
+
+    def delete(self, name):
+        with self.transaction() as db:
+            deleted = db.execute("DELETE FROM playlists WHERE name = ?", (name,)).rowcount
+        if deleted:
+            self._changed()
+        return bool(deleted)
+
+    def add_song(self, name, song):
+        with self.transaction() as db:
+            playlist_id = self._playlist_id(db, name)
+            if playlist_id is None:
+                return False
+            self._append(db, playlist_id, [song])
+        return True
+
+    def remove_song(self, name, song):
+        """Remove every occurrence of song; False if the playlist does not exist"""
+        with self.transaction() as db:
+            playlist_id = self._playlist_id(db, name)
+            if playlist_id is None:
+                return False
+            db.execute("DELETE FROM playlist_songs WHERE playlist_id = ? AND song = ?", (playlist_id, song))
+        return True
+
+    def merge(self, source, target):
+        """Append source's songs to target"""
+        with self.transaction() as db:
+            source_id = self._playlist_id(db, source)
+            target_id = self._playlist_id(db, target)
+            if source_id is None or target_id is None:
+                return False
+            self._append(db, target_id, self._songs(db, source_id))
+        return True
+
+    def combine(self, p1, p2, combined_name):
+        """Replace combined_name with the distinct songs of p1 followed by p2"""
+        with self.transaction() as db:
+            p1_id = self._playlist_id(db, p1)
+            p2_id = self._playlist_id(db, p2)
+            if p1_id is None or p2_id is None:
+                return False
+            songs = list(dict.fromkeys(self._songs(db, p1_id) + self._songs(db, p2_id)))
+            combined_id = self._playlist_id(db, combined_name)
+            if combined_id is None:
+                combined_id = db.execute("INSERT INTO playlists (name) VALUES (?)", (combined_name,)).lastrowid
+            else:
+                db.execute("DELETE FROM playlist_songs WHERE playlist_id = ?", (combined_id,))
+            self._append(db, combined_id, songs)
+        self._changed()
+        return True
+
+    # --- Import / export of the old directory layout ---
+
+    def import_directory(self, directory):
+        """Load every file in directory as a playlist, replacing same-named ones"""
+        count = 0
+        with self.transaction() as db:
+            for entry in sorted(os.listdir(directory)):
+                path = os.path.join(directory, entry)
+                if not os.path.isfile(path):
+                    continue
+                with open(path) as f:
+                    songs = [line.strip() for line in f if line.strip()]
+                db.execute("DELETE FROM playlists WHERE name = ?", (entry,))
+                playlist_id = db.execute("INSERT INTO playlists (name) VALUES (?)", (entry,)).lastrowid
+                self._append(db, playlist_id, songs)
+                count += 1
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_from', ?)", (directory,))
+        self._changed()
+        return count
+
+    def import_directory_once(self, directory):
+        """Migrate the old directory on first start only, so deleted playlists stay deleted"""
+        db = self._connection()
+        if db.execute("SELECT 1 FROM meta WHERE key = 'imported_from'").fetchone():
+            return 0
+        if not os.path.isdir(directory):
+            return 0
+        return self.import_directory(directory)
+
+    def export_directory(self, directory):
+        """Write each playlist back out as a text file, one song per line"""
+        os.makedirs(directory, exist_ok=True)
+        count = 0
+        for name in self.names():
+            with open(os.path.join(directory, name), 'w') as f:
+                for song in self.songs(name) or []:
+                    f.write(song + '\n')
+            count += 1
+        return count
+
+def main():
+    if len(sys.argv) not in (3, 4) or sys.argv[1] not in ('import', 'export'):
+        print("Usage: python playlist_store.py import|export <directory> [database]")
+        sys.exit(1)
+    command, directory = sys.argv[1], sys.argv[2]
+    store = PlaylistStore(sys.argv[3] if len(sys.argv) == 4 else "playlists.db")
+    if command == 'import':
+        print(f"Imported {store.import_directory(directory)} playlists from {directory}")
+    else:
+        print(f"Exported {store.export_directory(directory)} playlists to {directory}")
+
+if __name__ == '__main__':
+    main()
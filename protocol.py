@@ -0,0 +1,181 @@
+"""Framed wire protocol shared by server.py and clientf2.py
+
+Every message is a fixed 12 byte header followed by the payload:
+
+    version (u8) | type (u8) | flags (u16) | request id (u32) | length (u32)
+
+STREAM_START carries "<song>\n<offset> <length> <total size> <version>" so
+a client can tell which part of which version of the file the following
+STREAM_DATA frames hold. CHAT_MESSAGE frames are not replies to anything;
+their request id field holds the message's chat history sequence number.
+
+Clients opt in by following the JOIN_CHAT line with a newline-terminated
+options line holding "PROTO=<version>", optionally with "ROOM=<name>" to
+start in a room other than the lobby and "SINCE=<seq>" to have only newer
+chat history replayed. Clients that do not ask for it keep getting the
+old prefix-based byte stream.
+
+A stream COMMAND with FLAG_QUIET set is not announced to the room; clients
+set it when fetching ahead of playback.
+
+A framed client may also offer "COMPRESS=zlib"; the server confirms by
+echoing it on the JOIN_SUCCESS line. From then on it may wrap runs of
+frames in a COMPRESSED frame whose payload inflates to one or more
+complete frames. All COMPRESSED payloads on a connection belong to one
+zlib stream, sync-flushed after each frame, so names repeated across
+replies compress against each other. Small runs and all song data
+(STREAM_DATA) are sent as they are.
+"""
+import struct
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBHII')
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+# Message types
+MSG_COMMAND = 1
+MSG_COMMAND_RESPONSE = 2
+MSG_CHAT_MESSAGE = 3
+MSG_MESSAGE_SENT = 4
+MSG_STREAM_START = 5
+MSG_STREAM_DATA = 6
+MSG_STREAM_END = 7
+MSG_COMPRESSED = 8
+
+# COMMAND flags
+FLAG_QUIET = 0x1
+
+# How each message type looked before framing existed
+LEGACY_PREFIXES = {
+    MSG_COMMAND: b"",
+    MSG_COMMAND_RESPONSE: b"COMMAND_RESPONSE\n",
+    MSG_CHAT_MESSAGE: b"CHAT_MESSAGE\n",
+    MSG_MESSAGE_SENT: b"MESSAGE_SENT",
+    MSG_STREAM_START: b"STREAM_START\n",
+    MSG_STREAM_DATA: b"",
+    MSG_STREAM_END: b"STREAM_END\n",
+}
+
+class ProtocolError(Exception):
+    pass
+
+def encode_header(msg_type, length, request_id=0, flags=0):
+    """Header for a payload that is sent separately, e.g. straight from a file"""
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, request_id, length)
+
+def encode_frame(msg_type, payload=b"", request_id=0, flags=0):
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, request_id, len(payload)) + payload
+
+def encode_legacy(msg_type, payload=b"", request_id=0, flags=0):
+    # Stream start/end markers never carried a payload in the old protocol
+    if msg_type in (MSG_STREAM_START, MSG_STREAM_END, MSG_MESSAGE_SENT):
+        return LEGACY_PREFIXES[msg_type]
+    return LEGACY_PREFIXES[msg_type] + payload
+
+def encode_join(username, options):
+    """JOIN_CHAT and the options line; both end in a newline, so the server never guesses where they stop"""
+    return f"JOIN_CHAT {username}\n{options}\n".encode()
+
+def parse_join_options(text):
+    """Parse the KEY=VALUE tokens that may follow the JOIN_CHAT line"""
+    options = {}
+    for token in text.split():
+        key, sep, value = token.partition('=')
+        if sep:
+            options[key.upper()] = value
+    return options
+
+def negotiate_version(options):
+    try:
+        offered = int(options.get('PROTO', 0))
+    except ValueError:
+        return 0
+    return max(0, min(offered, PROTOCOL_VERSION))
+
+class FrameDecoder:
+    """Incremental frame parser over one reusable receive buffer
+
+    Bytes are received straight into the buffer, with recv_into or through
+    get_buffer and buffer_updated, and every byte is looked at once: a
+    header is unpacked a single time and kept until its payload has fully
+    arrived. Payloads are memoryviews into the buffer, valid until the next
+    bytes are received; copy them to keep them longer.
+    """
+
+    def __init__(self, size=64 * 1024):
+        self.buffer = bytearray(size)
+        self.start = 0  # first unconsumed byte
+        self.end = 0    # one past the last received byte
+        self._pending = None  # header of a frame whose payload is incomplete
+
+    def _reserve(self, needed):
+        """Make room for at least `needed` more bytes after self.end"""
+        if len(self.buffer) - self.end >= needed:
+            return
+        unread = self.end - self.start
+        if len(self.buffer) - unread >= needed:
+            self.buffer[:unread] = self.buffer[self.start:self.end]
+        else:
+            # A new buffer rather than a resize, which payload views still held would forbid
+            buffer = bytearray(unread + needed)
+            buffer[:unread] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+        self.start, self.end = 0, unread
+
+    def get_buffer(self, sizehint=-1):
+        """Free space after the received bytes, big enough for the rest of a pending frame"""
+        wanted = max(4096, sizehint)
+        if self._pending:
+            wanted = max(wanted, HEADER.size + self._pending[3] - (self.end - self.start))
+        self._reserve(wanted)
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """Account for nbytes written to the start of the last get_buffer()"""
+        self.end += nbytes
+
+    def recv_into(self, sock):
+        """Receive from a socket into the buffer; returns the byte count (0 on EOF)"""
+        with self.get_buffer() as view:
+            n = sock.recv_into(view)
+        self.buffer_updated(n)
+        return n
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def readline(self):
+        """Take the bytes up to and including the next newline, for the unframed JOIN reply; None if incomplete"""
+        newline = self.buffer.find(b"\n", self.start, self.end)
+        if newline < 0:
+            return None
+        line = bytes(self.buffer[self.start:newline + 1])
+        self.start = newline + 1
+        if self.start == self.end:
+            self.start = self.end = 0
+        return line
+
+    def frames(self):
+        """Yield (type, flags, request_id, payload) for every complete frame"""
+        while True:
+            if self._pending is None:
+                if self.end - self.start < HEADER.size:
+                    break
+                version, msg_type, flags, request_id, length = HEADER.unpack_from(self.buffer, self.start)
+                if version != PROTOCOL_VERSION:
+                    raise ProtocolError(f"Unsupported protocol version {version}")
+                if length > MAX_PAYLOAD:
+                    raise ProtocolError(f"Frame too large: {length} bytes")
+                self._pending = (msg_type, flags, request_id, length)
+            msg_type, flags, request_id, length = self._pending
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                break
+            payload = memoryview(self.buffer)[self.start + HEADER.size:frame_end]
+            self._pending = None
+            self.start = frame_end
+            if self.start == self.end:
+                self.start = self.end = 0
+            yield msg_type, flags, request_id, payload
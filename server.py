@@ -1,209 +1,1288 @@
+import argparse
+import asyncio
+import collections
 import os
+import signal
 import socket
-import threading
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from bus import BusClient, BusHub
+from library import LibraryIndex
+from metadata import MetadataIndex, format_record
+from metrics import Metrics
+from playlist_store import PlaylistStore
+from song_cache import SongCache
+from protocol import (FLAG_QUIET, HEADER, LEGACY_PREFIXES, MAX_PAYLOAD, MSG_CHAT_MESSAGE, MSG_COMMAND,
+                      MSG_COMMAND_RESPONSE, MSG_COMPRESSED, MSG_MESSAGE_SENT, MSG_STREAM_DATA, MSG_STREAM_END,
+                      MSG_STREAM_START, PROTOCOL_VERSION, ProtocolError, encode_frame, encode_header, encode_legacy,
+                      negotiate_version, parse_join_options)
 
 LIBRARY_DIR = "library"
-PLAYLIST_DIR = "playlist"
+PLAYLIST_DIR = "playlist"  # old one-file-per-playlist layout, imported on first start
+PLAYLIST_DB = "playlists.db"
+METADATA_DB = "metadata.db"
 
 HOST = '127.0.0.1'
 PORT = 12345
+SERVER_WORKERS = 1  # >1 forks worker processes sharing the port (POSIX only)
+METRICS_PORT = None  # serve Prometheus metrics on 127.0.0.1:<port>, plus the worker index
+
+# Bytes per STREAM_DATA frame for framed clients. Chat and replies can only
+# overtake song data between frames, so this bounds how long they wait.
+SENDFILE_CHUNK_SIZE = 256 * 1024
+MAX_CLIENT_STREAMS = 4  # streams one client may have running while it keeps sending commands
+# The kernel sends whatever it has been handed in order, so a send buffer left to grow
+# to megabytes would put that much song data ahead of any chat. None keeps the OS default.
+SOCKET_SEND_BUFFER = 256 * 1024
+FALLBACK_BUFFER_SIZE = 256 * 1024  # readinto buffer when sendfile is unavailable
+DISK_WORKERS = 8
+
+# Outbound queues: broadcasts beyond this many queued messages trigger the
+# slow-consumer policy, one of 'drop-oldest', 'coalesce' or 'disconnect'
+OUTBOUND_QUEUE_LIMIT = 256
+SLOW_CLIENT_POLICY = 'drop-oldest'
+
+# Clients that offer COMPRESS=zlib get runs of frames of at least this many bytes deflated
+COMPRESS_MIN_BYTES = 512
+COMPRESS_LEVEL = 6
+
+# Chat broadcasts are gathered for a short window and sent to each client in one write.
+# The window restarts with every message but a message never waits longer than the cap.
+BROADCAST_WINDOW_MS = 10  # 0 sends every broadcast immediately
+BROADCAST_MAX_DELAY_MS = 25
+BROADCAST_MAX_BATCH = 64
+
+# Everyone starts in the lobby; JOIN <room> moves a client, PART brings them back
+DEFAULT_ROOM = "lobby"
+MAX_ROOM_NAME = 64
+
+# Framed clients end both join lines with a newline. Legacy clients send a bare
+# "JOIN_CHAT <name>" and wait, so a first line missing for this long is taken as that.
+JOIN_LINE_TIMEOUT = 0.5
+MAX_JOIN_LINE = 4096
+
+# Recent broadcasts per room, replayed to framed clients when they join
+CHAT_HISTORY_MESSAGES = 200
+CHAT_HISTORY_BYTES = 64 * 1024
+
+# Popular songs are served from memory within this budget
+SONG_CACHE_BYTES = 256 * 1024 * 1024
+SONG_CACHE_MAX_FILE = 32 * 1024 * 1024
+LIBRARY_PAGE_MAX = 1000  # most names one LIST_LIBRARY_PAGE reply may hold
+SEARCH_LIMIT = 50  # results per SEARCH
+METADATA_RELOAD_DELAY = 2.0  # workers that do not index reload the stored tags at most this often
+
+# Stations play a playlist in real time to everyone tuned in, reading each song once
+STATION_TICK = 0.25  # seconds of audio per STREAM_DATA frame
+STATION_LEAD_SECONDS = 2.0  # how far ahead of real time listeners are sent audio
+STATION_READ_SIZE = 256 * 1024  # bytes read from disk at a time
+STATION_DEFAULT_BITRATE = 128  # kbps, for songs whose tags give no rate
+STATION_MAX_BACKLOG = 32  # listeners with more slices queued miss frames instead of falling behind
+
+clients = {}  # StreamWriter -> ClientConnection, only touched from the event loop thread
+rooms = {}  # name -> Room; empty rooms other than the lobby are dropped
+stations = {}  # playlist name -> Station, while anyone is tuned in
+bus = None  # BusClient when running as one of several worker processes
+
+STREAM_COMMANDS = ('STREAM_SONG', 'STREAM_RANGE', 'STREAM_IF_CHANGED')
+
+# STATS and QUEUE_STATS show every user and room, so only clients connecting from these may run them
+ADMIN_HOSTS = frozenset({'127.0.0.1', '::1'})
+ADMIN_COMMANDS = frozenset({'STATS', 'QUEUE_STATS'})
+
+# Commands get their own metrics label; anything else is counted as OTHER
+KNOWN_COMMANDS = frozenset({
+    'CHAT', 'LIST_LIBRARY_SONGS', 'LIST_LIBRARY_PAGE', 'SEARCH', 'LIST_PLAYLISTS', 'LIST_SONGS_IN_PLAYLIST', 'CREATE_PLAYLIST',
+    'ADD_SONG_TO_PLAYLIST', 'REMOVE_SONG_FROM_PLAYLIST', 'DELETE_PLAYLIST', 'MERGE_PLAYLISTS',
+    'COMBINE_PLAYLISTS', 'STREAM_SONG', 'STREAM_RANGE', 'STREAM_IF_CHANGED', 'HISTORY_SINCE',
+    'JOIN', 'PART', 'ROOMS', 'TUNE', 'UNTUNE', 'STATIONS', 'CACHE_STATS',
+})
+
+metrics = Metrics("musicchat_")
+metrics.describe('commands_total', "Commands handled, by command")
+metrics.describe('command_seconds', "Time to handle a command, by command")
+metrics.describe('connections_total', "Clients that have joined")
+metrics.describe('stream_bytes_total', "Song bytes queued for clients")
+metrics.describe('broadcast_messages_total', "Chat messages delivered to rooms")
+metrics.describe('broadcast_deliveries_total', "Chat messages queued for individual clients")
+metrics.describe('broadcast_fanout_seconds', "Time to queue one broadcast batch for a room")
+metrics.describe('compress_in_bytes_total', "Frame bytes deflated for clients that negotiated compression")
+metrics.describe('compress_out_bytes_total', "Compressed bytes those frames were sent as")
+metrics.describe('station_read_bytes_total', "Song bytes stations read from disk")
+metrics.describe('station_bytes_total', "Station audio queued for listeners")
+metrics.describe('station_skipped_bytes_total', "Station audio slow listeners missed")
+metrics.gauge('active_connections', lambda: len(clients))
+metrics.gauge('rooms', lambda: len(rooms))
+metrics.gauge('outbound_queue_depth', lambda: sum(len(c.queue) for c in clients.values()))
+metrics.gauge('outbound_queue_depth_max', lambda: max((len(c.queue) for c in clients.values()), default=0))
+metrics.gauge('outbound_dropped', lambda: sum(c.dropped for c in clients.values()))
+metrics.gauge('stations', lambda: len(stations))
+metrics.gauge('station_listeners', lambda: sum(len(s.listeners) for s in stations.values()))
+
+# Created by setup() in each serving process rather than on import, since the
+# metadata pool's spawned processes import this module as well
+disk_executor = None  # blocking filesystem work, so one slow disk call never stalls the loop
+library_index = None  # the library listing, served from memory and kept current by a watcher
+playlist_store = None
+metadata_index = None  # tags for SEARCH, read in a process pool whenever the library changes
+metadata_reload = None  # pending reload task in workers that do not index
+song_cache = None
+
+metrics.gauge('song_cache_hits', lambda: song_cache.hits)
+metrics.gauge('song_cache_misses', lambda: song_cache.misses)
+metrics.gauge('song_cache_evictions', lambda: song_cache.evictions)
+metrics.gauge('song_cache_bytes', lambda: song_cache.size)
+metrics.gauge('metadata_songs', lambda: len(metadata_index))
+
+def run_blocking(func, *args):
+    """Run a blocking function on the disk executor and return an awaitable"""
+    return asyncio.get_running_loop().run_in_executor(disk_executor, func, *args)
+
+# --- Networking ---
+
+class FileChunk:
+    """A file range queued for the writer task, sent with sendfile when its turn comes"""
+
+    def __init__(self, f, offset, count, header=b""):
+        self.f = f
+        self.offset = offset
+        self.count = count
+        self.header = header
+        self.done = asyncio.get_running_loop().create_future()
+
+class BufferChunk:
+    """Buffers making up one stream frame, written together when the channel's turn comes"""
+
+    def __init__(self, buffers, wait=False):
+        self.buffers = buffers
+        self.done = asyncio.get_running_loop().create_future() if wait else None
+
+def is_chunk(item):
+    return isinstance(item, (FileChunk, BufferChunk))
+
+class ClientConnection:
+    """A joined client, the wire format it negotiated and its outbound queues
+
+    Everything sent to the client goes through queues drained by the
+    client's own writer task, so a peer that stops reading only ever
+    delays itself. Chat, replies and stream starts and ends go in the
+    bounded control queue, which always goes first. Song data goes in a
+    queue per stream, its channel, and channels take turns a frame at a
+    time, so several streams share the connection and a download never
+    holds up the conversation. Legacy clients cannot tell chat from song
+    bytes, so their stream data goes through the control queue in order
+    and broadcasts wait until the song's STREAM_END.
+    """
+
+    def __init__(self, writer, name, framed=False):
+        self.writer = writer
+        self.name = name
+        self.framed = framed
+        peer = writer.get_extra_info('peername')
+        self.admin = bool(peer) and peer[0] in ADMIN_HOSTS
+        self.encode = encode_frame if framed else encode_legacy
+        self.queue = collections.deque()  # (data, droppable, compressible)
+        self.held = None  # broadcasts for a legacy client that is mid-song
+        self.channels = {}  # request id -> deque of FileChunk or BufferChunk, in turn order
+        self.compressor = None  # zlib stream once COMPRESS=zlib has been agreed
+        self.wakeup = asyncio.Event()
+        self.empty = asyncio.Event()
+        self.empty.set()
+        self.closed = False
+        self.room = None
+        self.station = None
+        self.streams = set()  # tasks running this client's stream commands
+        self.quiet_songs = set()  # fetched from the start with FLAG_QUIET, not announced yet
+        self.stream_slots = asyncio.Semaphore(MAX_CLIENT_STREAMS)
+        self.peak_depth = 0
+        self.dropped = 0
+        self.writer_task = asyncio.create_task(self.run_writer())
+
+    def enqueue(self, item, droppable=False, compressible=True):
+        if self.closed:
+            return
+        if droppable and self.held is not None:
+            if len(self.held) >= OUTBOUND_QUEUE_LIMIT:
+                self.held.popleft()
+                self.dropped += 1
+            self.held.append((item, droppable, compressible))
+            return
+        if droppable and len(self.queue) >= OUTBOUND_QUEUE_LIMIT:
+            if not self.handle_overflow():
+                return
+        self.queue.append((item, droppable, compressible))
+        self.peak_depth = max(self.peak_depth, len(self.queue))
+        self.empty.clear()
+        self.wakeup.set()
+
+    def handle_overflow(self):
+        """Apply SLOW_CLIENT_POLICY; returns False if the new message should be discarded"""
+        if SLOW_CLIENT_POLICY == 'disconnect':
+            print(f"Disconnecting slow client {self.name}: {len(self.queue)} messages queued")
+            self.close()
+            self.writer.close()
+            return False
+        droppable = [item for item in self.queue if item[1]]
+        if SLOW_CLIENT_POLICY == 'coalesce':
+            # Replace the backlog of broadcasts with a single notice
+            self.queue = collections.deque(item for item in self.queue if not item[1])
+            self.dropped += len(droppable)
+            notice = f"SERVER: {len(droppable)} messages skipped, your connection is too slow"
+            self.queue.append((self.encode(MSG_CHAT_MESSAGE, notice.encode()), True, True))
+            return True
+        # drop-oldest
+        if droppable:
+            self.queue.remove(droppable[0])
+            self.dropped += 1
+            return True
+        self.dropped += 1
+        return False
+
+    def write(self, data, droppable=False, compressible=True):
+        """Queue encoded control output; anything that is not whole frames passes compressible=False"""
+        self.enqueue(data, droppable, compressible)
+
+    def send(self, msg_type, payload=b"", request_id=0):
+        self.enqueue(self.encode(msg_type, payload, request_id))
+        if self.framed:
+            return
+        # A legacy client reads everything up to STREAM_END as the song
+        if msg_type == MSG_STREAM_START:
+            self.held = collections.deque()
+        elif msg_type == MSG_STREAM_END and self.held is not None:
+            held, self.held = self.held, None
+            for item in held:
+                self.enqueue(*item)
+
+    def send_shared(self, msg_type, payload, request_id=0):
+        """Send a cached payload without copying it into a new buffer"""
+        if self.framed:
+            self.enqueue(encode_header(msg_type, len(payload), request_id))
+        else:
+            self.enqueue(LEGACY_PREFIXES[msg_type])
+        self.enqueue(payload)
+
+    def enqueue_chunk(self, channel, chunk):
+        """Queue stream data behind the channel's earlier chunks"""
+        if self.closed:
+            return
+        if not self.framed:
+            # Unframed data must not be interleaved with anything else
+            self.enqueue(chunk, compressible=False)
+            return
+        self.channels.setdefault(channel, collections.deque()).append(chunk)
+        self.wakeup.set()
+
+    async def send_file_chunk(self, channel, f, offset, count, header=b""):
+        """Queue a file range on a channel and wait until it has been sent"""
+        chunk = FileChunk(f, offset, count, header)
+        self.enqueue_chunk(channel, chunk)
+        if self.closed:
+            raise ConnectionError("Client connection closed")
+        return await chunk.done
+
+    async def send_buffers(self, channel, buffers):
+        """Queue buffers on a channel and wait until they have been sent"""
+        chunk = BufferChunk(buffers, wait=True)
+        self.enqueue_chunk(channel, chunk)
+        if self.closed:
+            raise ConnectionError("Client connection closed")
+        await chunk.done
+
+    def channel_depth(self, channel):
+        return len(self.channels.get(channel, ()))
+
+    def drop_channel(self, channel):
+        """Forget stream data not yet sent on a channel, e.g. live audio for someone who tuned out"""
+        self.channels.pop(channel, None)
+
+    async def drain(self):
+        """Wait until the control queue has been handed to the socket; song data may still be queued"""
+        await self.empty.wait()
+
+    async def run_writer(self):
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self.empty.set()
+                    if not self.channels:
+                        self.wakeup.clear()
+                        await self.wakeup.wait()
+                        continue
+                if self.queue and is_chunk(self.queue[0][0]):
+                    # A legacy client's stream data, in its place among the control output
+                    await self.send_chunk(self.queue.popleft()[0])
+                elif self.queue:
+                    # Hand every queued control message up to the next chunk over in one write
+                    batch = []
+                    while self.queue and not is_chunk(self.queue[0][0]):
+                        batch.append(self.queue.popleft())
+                    if self.compressor is None:
+                        self.writer.writelines([data for data, _, _ in batch])
+                    else:
+                        self.writer.writelines(self.compress_batch(batch))
+                else:
+                    # One frame from the channel whose turn it is, which then goes to the back
+                    channel, chunks = next(iter(self.channels.items()))
+                    del self.channels[channel]
+                    chunk = chunks.popleft()
+                    if chunks:
+                        self.channels[channel] = chunks
+                    await self.send_chunk(chunk)
+                await self.writer.drain()
+        except (OSError, RuntimeError):
+            # Connection lost, or the transport was closed under us
+            pass
+        finally:
+            self.close()
+
+    async def send_chunk(self, chunk):
+        try:
+            if isinstance(chunk, FileChunk):
+                if chunk.header:
+                    self.writer.write(chunk.header)
+                result = await send_file_range(self.writer, chunk.f, chunk.offset, chunk.count)
+            else:
+                self.writer.writelines(chunk.buffers)
+                result = None
+            if chunk.done is not None:
+                chunk.done.set_result(result)
+        except Exception as e:
+            if chunk.done is not None:
+                chunk.done.set_exception(e)
+            raise
+
+    def compress_batch(self, batch):
+        """Deflate each run of compressible frames that is big enough to be worth it"""
+        out, run = [], []
+        for data, _, compressible in batch + [(b"", False, False)]:
+            if compressible:
+                run.append(data)
+                continue
+            if run:
+                raw = b"".join(run)
+                if len(raw) >= COMPRESS_MIN_BYTES:
+                    packed = self.compressor.compress(raw) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+                    out.append(encode_frame(MSG_COMPRESSED, packed))
+                    metrics.inc('compress_in_bytes_total', len(raw))
+                    metrics.inc('compress_out_bytes_total', len(packed))
+                else:
+                    out.append(raw)
+                run = []
+            if data:
+                out.append(data)
+        return out
+
+    def close(self):
+        self.closed = True
+        pending = [chunk for chunks in self.channels.values() for chunk in chunks]
+        pending += [item for item, _, _ in self.queue if is_chunk(item)]
+        for chunk in pending:
+            if chunk.done is not None and not chunk.done.done():
+                chunk.done.set_exception(ConnectionError("Client connection closed"))
+        self.channels.clear()
+        self.queue.clear()
+        self.wakeup.set()
+        self.empty.set()
+
+    def stats(self):
+        return (f"{self.name}: depth={len(self.queue)} peak={self.peak_depth} dropped={self.dropped} "
+                f"streams={len(self.channels)}")
+
+class ChatHistory:
+    """The most recent broadcasts and their sequence numbers, bounded by count and bytes"""
+
+    def __init__(self, max_messages, max_bytes):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = collections.deque()  # (seq, payload)
+        self.size = 0
+        self.last_seq = 0
+        self.replay = None  # framed encoding of everything held, until the next append
+
+    def append(self, payload, seq=None):
+        """Record a broadcast, numbering it unless the bus already did; returns its sequence number"""
+        self.last_seq = self.last_seq + 1 if seq is None else seq
+        self.messages.append((self.last_seq, payload))
+        self.size += len(payload)
+        while self.messages and (len(self.messages) > self.max_messages or self.size > self.max_bytes):
+            self.size -= len(self.messages.popleft()[1])
+        self.replay = None
+        return self.last_seq
+
+    def encode(self, since=0):
+        """CHAT_MESSAGE frames for everything after `since`, ready to write in one go"""
+        if since > self.last_seq:
+            # Numbers from before a server restart mean nothing here
+            since = 0
+        if self.messages and since < self.messages[0][0]:
+            if self.replay is None:
+                self.replay = b"".join(encode_frame(MSG_CHAT_MESSAGE, payload, seq)
+                                       for seq, payload in self.messages)
+            return self.replay
+        return b"".join(encode_frame(MSG_CHAT_MESSAGE, payload, seq)
+                        for seq, payload in self.messages if seq > since)
+
+class BroadcastBatcher:
+    """Chat broadcasts for one room waiting to go out together"""
+
+    def __init__(self, room, window_ms, max_delay_ms, max_batch):
+        self.room = room
+        self.window = window_ms / 1000
+        self.max_delay = max_delay_ms / 1000
+        self.max_batch = max_batch
+        self.pending = []
+        self.deadline = None
+        self.timer = None
+        self.batches = 0
+        self.messages = 0
+
+    def add(self, payload):
+        if self.window <= 0:
+            self.send([payload])
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if not self.pending:
+            self.deadline = now + self.max_delay
+        self.pending.append(payload)
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = loop.call_at(min(now + self.window, self.deadline), self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        payloads, self.pending = self.pending, []
+        if payloads:
+            self.send(payloads)
+
+    def send(self, payloads):
+        self.batches += 1
+        self.messages += len(payloads)
+        if bus is not None:
+            # The hub numbers the batch and hands it to every worker, this one included
+            bus.publish_chat(self.room.name, payloads)
+        else:
+            self.room.deliver([(None, payload) for payload in payloads])
+
+    def stats(self):
+        average = self.messages / self.batches if self.batches else 0.0
+        return (f"room {self.room.name}: members={len(self.room.members)} broadcast batches={self.batches} "
+                f"messages={self.messages} avg_batch={average:.1f}")
+
+class Room:
+    """A chat room: its members, recent history and pending broadcasts
+
+    Rooms share nothing, so a broadcast only costs as much as the room it
+    goes to, however many people are connected elsewhere.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+        self.history = ChatHistory(CHAT_HISTORY_MESSAGES, CHAT_HISTORY_BYTES)
+        self.broadcaster = BroadcastBatcher(self, BROADCAST_WINDOW_MS, BROADCAST_MAX_DELAY_MS,
+                                            BROADCAST_MAX_BATCH)
+
+    def deliver(self, messages):
+        """Record (seq, payload) messages and queue them for every member, encoded once per wire format"""
+        started = time.perf_counter()
+        # Framed chat messages carry their history sequence number in the request id field
+        framed = b"".join(encode_frame(MSG_CHAT_MESSAGE, payload, self.history.append(payload, seq))
+                          for seq, payload in messages)
+        # Legacy clients split messages on their prefix, one per read, so they keep one write each
+        legacy = [encode_legacy(MSG_CHAT_MESSAGE, payload) for _, payload in messages]
+        for client in list(self.members):
+            if client.framed:
+                client.write(framed, droppable=True)
+            else:
+                for data in legacy:
+                    client.write(data, droppable=True)
+        metrics.inc('broadcast_messages_total', len(messages))
+        metrics.inc('broadcast_deliveries_total', len(messages) * len(self.members))
+        metrics.observe('broadcast_fanout_seconds', time.perf_counter() - started)
+
+def valid_room_name(name):
+    return 0 < len(name) <= MAX_ROOM_NAME and name.isprintable() and not any(c.isspace() for c in name)
+
+def enter_room(client, name):
+    """Add client to a room, creating it on first use; returns the Room"""
+    room = rooms.get(name)
+    if room is None:
+        room = rooms[name] = Room(name)
+    room.members.add(client)
+    client.room = room
+    return room
+
+def leave_room(client):
+    """Take client out of its room; returns the room it left"""
+    room, client.room = client.room, None
+    if room is not None:
+        room.members.discard(client)
+        if not room.members and room.name != DEFAULT_ROOM and rooms.get(room.name) is room:
+            del rooms[room.name]
+    return room
+
+def broadcast_message(room, sender_name, message):
+    """Send a message to everyone in a room, on every worker"""
+    room.broadcaster.add(f"{sender_name}: {message}".encode())
+
+def on_bus_chat(room_name, messages):
+    # Rooms nobody on this worker is in have no one to deliver to
+    room = rooms.get(room_name)
+    if room is not None:
+        room.deliver(messages)
+
+def on_bus_event(name):
+    global metadata_reload
+    if name == 'PLAYLISTS_CHANGED':
+        playlist_store.invalidate()
+    elif name == 'METADATA_CHANGED' and (metadata_reload is None or metadata_reload.done()):
+        metadata_reload = asyncio.ensure_future(reload_metadata())
+
+async def reload_metadata():
+    """Pick up the rows the indexing worker stored, coalescing its batches"""
+    await asyncio.sleep(METADATA_RELOAD_DELAY)
+    await metadata_index.load()
+
+async def read_join_line(reader):
+    """One newline-terminated join line, or None if it does not arrive within JOIN_LINE_TIMEOUT"""
+    try:
+        line = await asyncio.wait_for(reader.readuntil(b'\n'), JOIN_LINE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    except asyncio.IncompleteReadError as e:
+        line = e.partial
+    except asyncio.LimitOverrunError:
+        raise ProtocolError("Join line too long")
+    if len(line) > MAX_JOIN_LINE:
+        raise ProtocolError("Join line too long")
+    return line.decode().strip()
+
+async def read_join(reader):
+    """(JOIN_CHAT line, options line) from a new connection"""
+    join_line = await read_join_line(reader)
+    if join_line is None:
+        # A legacy client; whatever it sent is all there is
+        return (await reader.read(MAX_JOIN_LINE)).decode().strip(), ''
+    return join_line, await read_join_line(reader) or ''
+
+async def read_request(reader, client):
+    """Read one command; returns (text, request_id, flags) with empty text on EOF"""
+    if not client.framed:
+        return (await reader.read(1024)).decode().strip(), 0, 0
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError:
+        return '', 0, 0
+    version, msg_type, flags, request_id, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION or msg_type != MSG_COMMAND or length > MAX_PAYLOAD:
+        raise ProtocolError(f"Unexpected frame type={msg_type} version={version} length={length}")
+    payload = await reader.readexactly(length)
+    return payload.decode().strip(), request_id, flags
+
+async def copy_file_range(writer, f, offset, count):
+    """Fallback for transports without sendfile: readinto one reused buffer"""
+    buffer = bytearray(FALLBACK_BUFFER_SIZE)
+    view = memoryview(buffer)
+    transport = writer.transport
+    low, high = transport.get_write_buffer_limits()
+    # The transport may keep a reference to what we write, so wait for a full
+    # flush before the buffer is refilled
+    transport.set_write_buffer_limits(high=0)
+    sent = 0
+    try:
+        await run_blocking(f.seek, offset)
+        while sent < count:
+            n = await run_blocking(f.readinto, view[:min(len(buffer), count - sent)])
+            if not n:
+                break
+            writer.write(view[:n])
+            await writer.drain()
+            sent += n
+    finally:
+        transport.set_write_buffer_limits(high=high, low=low)
+    return sent
+
+async def send_file_range(writer, f, offset, count):
+    """Send count bytes of f starting at offset, zero-copy where the OS allows"""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.sendfile(writer.transport, f, offset, count, fallback=False)
+    except asyncio.SendfileNotAvailableError:
+        return await copy_file_range(writer, f, offset, count)
+
+def read_song(path):
+    """Read a whole file along with the size and mtime it had while being read"""
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        return f.read(), st.st_size, st.st_mtime_ns
+
+async def load_cached_song(path, st, play):
+    """(song bytes or None to stream from disk, whether they were already cached), loading hot songs"""
+    data = song_cache.get(path, st.st_size, st.st_mtime_ns)
+    if data is not None:
+        return data, True
+    # Only plays from the start count towards admission, not the other ranges of the same play
+    if play and song_cache.should_admit(path, st.st_size):
+        data, size, mtime_ns = await run_blocking(read_song, path)
+        if len(data) == size:
+            song_cache.put(path, size, mtime_ns, data)
+    return data, False
+
+def song_version(st):
+    """Tag clients cache songs under, from the file's size, mtime and inode so nothing is read for it"""
+    return f"{st.st_size:x}-{st.st_mtime_ns:x}-{st.st_ino:x}"
+
+async def stream_file(client, song, path, request_id, offset=0, length=0):
+    """Send STREAM_START and bytes [offset, offset + length) of a file; length 0 means to the end"""
+    st = await run_blocking(os.stat, path)
+    version = song_version(st)
+    data, cached = await load_cached_song(path, st, play=offset == 0)
+    f = None if data is not None else await run_blocking(open, path, 'rb')
+    try:
+        total = len(data) if data is not None else os.fstat(f.fileno()).st_size
+        offset = max(0, min(offset, total))
+        end = total if length <= 0 else min(total, offset + length)
+        client.send(MSG_STREAM_START, f"{song}\n{offset} {end - offset} {total} {version}".encode(), request_id)
+        # Legacy clients get raw bytes, so the range can go out in one call
+        chunk_size = SENDFILE_CHUNK_SIZE if client.framed else max(end - offset, 1)
+        while offset < end:
+            count = min(chunk_size, end - offset)
+            header = encode_header(MSG_STREAM_DATA, count, request_id) if client.framed else b""
+            if data is not None:
+                # Slices of the cached bytes go out without being copied
+                view = memoryview(data)[offset:offset + count]
+                await client.send_buffers(request_id, [header, view] if header else [view])
+                if cached:
+                    song_cache.record_served(count)
+            else:
+                sent = await client.send_file_chunk(request_id, f, offset, count, header)
+                if sent != count:
+                    raise ConnectionError(f"File {path} changed while streaming")
+            metrics.inc('stream_bytes_total', count)
+            offset += count
+    finally:
+        if f is not None:
+            await run_blocking(f.close)
+
+class Station:
+    """A playlist played in real time to every listener from one read of each song
 
-clients = {}  # Changed from set to dict to store client names
-clients_lock = threading.Lock()
+    The song is read in STATION_READ_SIZE blocks and sent out a STATION_TICK
+    slice at a time, at the byte rate its tags give, staying
+    STATION_LEAD_SECONDS ahead of real time. Every listener is queued the
+    same slice objects. The last lead's worth of slices is kept, so someone
+    who tunes in late starts where everyone else is listening, with the same
+    lead, instead of at the start of the song.
 
-os.makedirs(LIBRARY_DIR, exist_ok=True)
-os.makedirs(PLAYLIST_DIR, exist_ok=True)
+    Listeners get a STREAM_START for each song and one STREAM_END, all
+    under the request id of their TUNE.
+    """
 
-def list_files(directory):
-    return [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
+    def __init__(self, name):
+        self.name = name
+        self.listeners = {}  # ClientConnection -> request id of its TUNE
+        self.recent = collections.deque()  # (offset, slice) of the current song, about one lead's worth
+        self.recent_bytes = 0
+        self.song = None
+        self.total = 0
+        self.rate = STATION_DEFAULT_BITRATE * 125  # bytes per second of the current song
+        self.clock = 0.0  # loop time at which the audio sent so far will have played
+        self.task = None
 
-def broadcast_message(sender_name, message):
-    """Send a message to all connected clients"""
-    broadcast_data = f"{sender_name}: {message}".encode()
-    with clients_lock:
-        for client_conn, client_name in clients.items():
+    def add(self, client, request_id):
+        self.listeners[client] = request_id
+        client.station = self
+        if self.song is not None and self.recent:
+            self.start_stream(client, request_id, self.recent[0][0])
+            for _, piece in self.recent:
+                self.send_slice(client, request_id, piece)
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def remove(self, client):
+        """Stop sending to client, ending its stream; the station stops with its last listener"""
+        request_id = self.listeners.pop(client, None)
+        client.station = None
+        if request_id is not None:
+            client.drop_channel(request_id)
+            client.send(MSG_STREAM_END, request_id=request_id)
+        if not self.listeners:
+            self.stop()
+
+    def stop(self):
+        """Take the station off the air, ending every listener's stream"""
+        if stations.get(self.name) is self:
+            del stations[self.name]
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        listeners, self.listeners = self.listeners, {}
+        for client, request_id in listeners.items():
+            client.station = None
+            client.drop_channel(request_id)
+            client.send(MSG_STREAM_END, request_id=request_id)
+
+    def start_stream(self, client, request_id, offset):
+        # On the channel, so the previous song's last slices are not overtaken
+        payload = f"{self.song}\n{offset} {self.total - offset} {self.total}".encode()
+        client.enqueue_chunk(request_id, BufferChunk([encode_frame(MSG_STREAM_START, payload, request_id)]))
+
+    def send_slice(self, client, request_id, piece):
+        if client.channel_depth(request_id) > STATION_MAX_BACKLOG:
+            metrics.inc('station_skipped_bytes_total', len(piece))
+            return
+        client.enqueue_chunk(request_id, BufferChunk([encode_header(MSG_STREAM_DATA, len(piece), request_id), piece]))
+        metrics.inc('station_bytes_total', len(piece))
+
+    async def run(self):
+        try:
+            self.clock = asyncio.get_running_loop().time()
+            while True:
+                # Read the playlist again each time round, so edits are picked up
+                songs = await run_blocking(playlist_store.songs, self.name) or []
+                played = 0
+                for song in songs:
+                    played += await self.play(song)
+                if not played:
+                    break
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            print(f"Station {self.name} stopped: {e}")
+        self.task = None
+        self.stop()
+
+    async def play(self, song):
+        """Send one song to every listener at its own pace; returns False if it could not be opened"""
+        path = os.path.join(LIBRARY_DIR, song)
+        try:
+            f = await run_blocking(open, path, 'rb')
+        except OSError:
+            return False
+        loop = asyncio.get_running_loop()
+        try:
+            self.song, self.total = song, os.fstat(f.fileno()).st_size
+            self.rate = self.byte_rate(song, self.total)
+            self.recent.clear()
+            self.recent_bytes = 0
+            for client, request_id in list(self.listeners.items()):
+                self.start_stream(client, request_id, 0)
+            step = max(1, int(self.rate * STATION_TICK))
+            offset = 0
+            while True:
+                block = await run_blocking(f.read, STATION_READ_SIZE)
+                if not block:
+                    break
+                metrics.inc('station_read_bytes_total', len(block))
+                view = memoryview(block)
+                for start in range(0, len(block), step):
+                    piece = view[start:start + step]
+                    self.push(offset, piece)
+                    offset += len(piece)
+                    # Never more than one lead ahead, even after falling behind
+                    self.clock = max(self.clock, loop.time()) + len(piece) / self.rate
+                    delay = self.clock - STATION_LEAD_SECONDS - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+        finally:
+            await run_blocking(f.close)
+        return True
+
+    def push(self, offset, piece):
+        self.recent.append((offset, piece))
+        self.recent_bytes += len(piece)
+        lead = self.rate * STATION_LEAD_SECONDS
+        while self.recent_bytes - len(self.recent[0][1]) >= lead:
+            self.recent_bytes -= len(self.recent.popleft()[1])
+        for client, request_id in list(self.listeners.items()):
+            self.send_slice(client, request_id, piece)
+
+    def byte_rate(self, song, size):
+        record = metadata_index.records.get(song)
+        if record is not None and record.duration:
+            return max(1.0, size / record.duration)
+        if record is not None and record.bitrate:
+            return record.bitrate * 125
+        return STATION_DEFAULT_BITRATE * 125
+
+    def stats(self):
+        # Tab-separated, since playlist and song names may contain spaces
+        return f"{self.name}\t{len(self.listeners)}\t{self.song or ''}"
+
+def move_to_room(client, name, request_id=0):
+    """Switch rooms, then replay the new room's history; the reply comes first so the
+    client knows which room the replayed messages belong to"""
+    old_room = leave_room(client)
+    broadcast_message(old_room, "SERVER", f"{client.name} has left the room")
+    room = enter_room(client, name)
+    client.send(MSG_COMMAND_RESPONSE, f"Joined room {name}".encode(), request_id)
+    if client.framed:
+        client.write(room.history.encode())
+    broadcast_message(room, "SERVER", f"{client.name} has joined the room")
+
+async def process_request(client, request, request_id=0, flags=0):
+    client_name = client.name
+
+    def respond(payload):
+        client.send(MSG_COMMAND_RESPONSE, payload, request_id)
+
+    if request.startswith('CHAT'):
+        _, message = request.split(maxsplit=1)
+        broadcast_message(client.room, client_name, message)
+        client.send(MSG_MESSAGE_SENT, request_id=request_id)
+
+    elif request == 'LIST_LIBRARY_SONGS':
+        client.send_shared(MSG_COMMAND_RESPONSE, library_index.listing(), request_id)
+
+    elif request.startswith('LIST_LIBRARY_PAGE'):
+        # LIST_LIBRARY_PAGE <limit>, then optional CURSOR=<name>, OFFSET=<n>, PREFIX=<text> and
+        # CONTAINS=<text> lines; the reply is "PAGE <total> <offset>" followed by one name per line
+        first, *lines = request.split('\n')
+        options = {}
+        for line in lines:
+            key, _, value = line.partition('=')
+            options[key.strip().upper()] = value
+        try:
+            limit = max(0, min(int(first.split()[1]), LIBRARY_PAGE_MAX))
+            offset = int(options.get('OFFSET', 0))
+        except (IndexError, ValueError):
+            respond(b"Error: Usage LIST_LIBRARY_PAGE <limit>")
+            return
+        names, total, start = library_index.page(limit, options.get('CURSOR'), offset,
+                                                 options.get('PREFIX', ''), options.get('CONTAINS', ''))
+        respond('\n'.join([f"PAGE {total} {start}"] + names).encode())
+
+    elif request.startswith('SEARCH'):
+        # SEARCH <words>: best matches first, one line each as metadata.format_record writes it
+        query = request[len('SEARCH'):].strip()
+        respond('\n'.join(format_record(r) for r in metadata_index.search(query, SEARCH_LIMIT)).encode())
+
+    elif request == 'LIST_PLAYLISTS':
+        client.send_shared(MSG_COMMAND_RESPONSE, await run_blocking(playlist_store.listing), request_id)
+
+    elif request.startswith('LIST_SONGS_IN_PLAYLIST'):
+        _, name = request.split(maxsplit=1)
+        songs = await run_blocking(playlist_store.songs, name)
+        if songs is None:
+            respond(b"Error: Playlist not found")
+        else:
+            respond('\n'.join(songs).encode())
+
+    elif request.startswith('CREATE_PLAYLIST'):
+        _, name = request.split(maxsplit=1)
+        if await run_blocking(playlist_store.create, name):
+            respond(b"Playlist created")
+            broadcast_message(client.room, "SERVER", f"{client_name} created a new playlist: {name}")
+        else:
+            respond(b"Playlist already exists")
+
+    elif request.startswith('ADD_SONG_TO_PLAYLIST'):
+        _, pl, song = request.split(maxsplit=2)
+        song_exists = song in library_index or \
+            await run_blocking(os.path.isfile, os.path.join(LIBRARY_DIR, song))
+        if song_exists and await run_blocking(playlist_store.add_song, pl, song):
+            respond(b"Song added")
+            broadcast_message(client.room, "SERVER", f"{client_name} added {song} to playlist {pl}")
+        else:
+            respond(b"Error adding song")
+
+    elif request.startswith('REMOVE_SONG_FROM_PLAYLIST'):
+        _, pl, song = request.split(maxsplit=2)
+        if await run_blocking(playlist_store.remove_song, pl, song):
+            respond(b"Song removed")
+        else:
+            respond(b"Playlist not found")
+
+    elif request.startswith('DELETE_PLAYLIST'):
+        _, name = request.split(maxsplit=1)
+        if await run_blocking(playlist_store.delete, name):
+            respond(b"Playlist deleted")
+            broadcast_message(client.room, "SERVER", f"{client_name} deleted playlist {name}")
+        else:
+            respond(b"Error deleting playlist")
+
+    elif request.startswith('MERGE_PLAYLISTS'):
+        _, source, target = request.split(maxsplit=2)
+        if await run_blocking(playlist_store.merge, source, target):
+            respond(b"Playlists merged")
+            broadcast_message(client.room, "SERVER", f"{client_name} merged playlists {source} into {target}")
+        else:
+            respond(b"One or both playlists not found")
+
+    elif request.startswith('COMBINE_PLAYLISTS'):
+        # COMBINE_PLAYLISTS <p1> <p2> [new name]
+        parts = request.split(maxsplit=3)
+        p1, p2 = parts[1], parts[2]
+        combined_name = parts[3] if len(parts) > 3 else f"{p1}_{p2}_combined"
+        if await run_blocking(playlist_store.combine, p1, p2, combined_name):
+            respond(f"Combined into playlist: {combined_name}".encode())
+            broadcast_message(client.room, "SERVER", f"{client_name} created a combined playlist: {combined_name}")
+        else:
+            respond(b"One or both playlists not found")
+
+    elif request.startswith(STREAM_COMMANDS):
+        version = None
+        if request.startswith('STREAM_IF_CHANGED'):
+            # STREAM_IF_CHANGED <version> <song>: validate a client's cached copy
+            try:
+                _, version, song = request.split(maxsplit=2)
+            except ValueError:
+                respond(b"Error: Usage STREAM_IF_CHANGED <version> <song>")
+                return
+            offset, length = 0, 0
+        elif request.startswith('STREAM_RANGE'):
+            # STREAM_RANGE <offset> <length> <song>, used to resume and seek
             try:
-                client_conn.sendall(b"CHAT_MESSAGE\n" + broadcast_data)
-            except:
+                _, offset, length, song = request.split(maxsplit=3)
+                offset, length = int(offset), int(length)
+            except ValueError:
+                respond(b"Error: Usage STREAM_RANGE <offset> <length> <song>")
+                return
+        else:
+            _, song = request.split(maxsplit=1)
+            offset, length = 0, 0
+        path = os.path.join(LIBRARY_DIR, song)
+        if await run_blocking(os.path.exists, path):
+            if version is not None:
+                st = await run_blocking(os.stat, path)
+                if version == song_version(st):
+                    respond(b"NOT_MODIFIED")
+                    return
+            # Resumes, seeks, prefetches and replays from the client's cache are not news to the
+            # room, but a prefetched song is once the client asks for the rest of it to play
+            if flags & FLAG_QUIET:
+                if offset == 0:
+                    client.quiet_songs.add(song)
+            elif offset == 0 or song in client.quiet_songs:
+                client.quiet_songs.discard(song)
+                broadcast_message(client.room, "SERVER", f"{client_name} is now streaming: {song}")
+            try:
+                await stream_file(client, song, path, request_id, offset, length)
+            except ConnectionError:
                 pass
+            client.send(MSG_STREAM_END, request_id=request_id)
+        else:
+            respond(b"Error: Song not found")
+
+    elif request.startswith('HISTORY_SINCE'):
+        # HISTORY_SINCE <seq>: the chat messages a client missed, as CHAT_MESSAGE frames
+        try:
+            since = int(request.split()[1])
+        except (IndexError, ValueError):
+            respond(b"Error: Usage HISTORY_SINCE <seq>")
+            return
+        if client.framed:
+            client.write(client.room.history.encode(since))
+        respond(f"History up to {client.room.history.last_seq}".encode())
+
+    elif request.startswith('JOIN '):
+        # JOIN <room>: leave the current room for another one
+        name = request[len('JOIN '):].strip()
+        if not valid_room_name(name):
+            respond(b"Error: Invalid room name")
+        elif name == client.room.name:
+            respond(f"Already in room {name}".encode())
+        else:
+            move_to_room(client, name, request_id)
+
+    elif request == 'PART' or request.startswith('PART '):
+        # PART [room]: leave the current room and go back to the lobby
+        name = request[len('PART'):].strip() or client.room.name
+        if name != client.room.name:
+            respond(f"Error: Not in room {name}".encode())
+        elif name == DEFAULT_ROOM:
+            respond(b"Error: Already in the lobby")
+        else:
+            move_to_room(client, DEFAULT_ROOM, request_id)
+
+    elif request.startswith('TUNE '):
+        # TUNE <playlist>: listen to the playlist's station from where it is now. The reply
+        # is a STREAM_START per song and STREAM_DATA as it plays, until UNTUNE ends it.
+        name = request[len('TUNE '):].strip()
+        if not client.framed:
+            respond(b"Error: Stations need the framed protocol")
+            return
+        if client.station is not None:
+            client.station.remove(client)
+        station = stations.get(name)
+        if station is None:
+            songs = await run_blocking(playlist_store.songs, name)
+            if not songs:
+                respond(b"Error: Playlist not found" if songs is None else b"Error: Playlist is empty")
+                return
+            station = stations.setdefault(name, Station(name))
+        station.add(client, request_id)
+        broadcast_message(client.room, "SERVER", f"{client_name} tuned in to station {name}")
+
+    elif request == 'UNTUNE':
+        if client.station is None:
+            respond(b"Error: Not tuned in")
+        else:
+            name = client.station.name
+            client.station.remove(client)
+            respond(f"Tuned out of {name}".encode())
+
+    elif request == 'STATIONS':
+        # One line per station: its playlist, listener count and the song playing
+        respond('\n'.join(station.stats() for station in
+                          sorted(stations.values(), key=lambda s: s.name)).encode())
+
+    elif request == 'ROOMS':
+        respond('\n'.join(f"{room.name} {len(room.members)}" for room in
+                          sorted(rooms.values(), key=lambda r: r.name)).encode())
+
+    elif request == 'CACHE_STATS':
+        respond(song_cache.stats().encode())
+
+    elif request in ADMIN_COMMANDS and not client.admin:
+        respond(f"Error: {request} is only available to administrators".encode())
+
+    elif request == 'STATS':
+        lines = [metrics.render_text(), song_cache.stats()] + [room.broadcaster.stats() for room in rooms.values()]
+        respond('\n'.join(lines).encode())
+
+    elif request == 'QUEUE_STATS':
+        lines = [room.broadcaster.stats() for room in rooms.values()] + [c.stats() for c in clients.values()]
+        respond('\n'.join(lines).encode())
+
+    else:
+        respond(b"Invalid command")
+
+async def run_command(client, request, request_id, flags=0):
+    started = time.perf_counter()
+    await process_request(client, request, request_id, flags)
+    command = command_name(request, client)
+    metrics.inc('commands_total', label=command)
+    metrics.observe('command_seconds', time.perf_counter() - started, command)
 
-def handle_client(conn, addr):
+async def run_stream_command(client, request, request_id, flags):
+    try:
+        # Past MAX_CLIENT_STREAMS the request waits its turn here, not in the reader
+        async with client.stream_slots:
+            await run_command(client, request, request_id, flags)
+    except Exception as e:
+        print(f"Error streaming to {client.name}: {e}")
+        client.send(MSG_STREAM_END, request_id=request_id)
+
+def command_name(request, client):
+    name = request.split(maxsplit=1)[0] if request else ''
+    if name in KNOWN_COMMANDS or name in ADMIN_COMMANDS and client.admin:
+        return name
+    return 'OTHER'
+
+async def handle_metrics(reader, writer):
+    """Answer one HTTP request with the Prometheus text format, whatever the path"""
+    try:
+        while (await reader.readline()).strip():
+            pass
+        body = metrics.render_prometheus().encode()
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info('peername')
+    print(f"New connection from {addr}")
     client_name = None
-    
+
     try:
-        # First message should be the client's name
-        name_request = conn.recv(1024).decode().strip()
-        if name_request.startswith('JOIN_CHAT'):
-            _, client_name = name_request.split(maxsplit=1)
-            with clients_lock:
-                clients[conn] = client_name
-            
+        # First message should be the client's name, optionally followed by
+        # a line of KEY=VALUE options such as PROTO=1
+        join_line, option_line = await read_join(reader)
+        if join_line.startswith('JOIN_CHAT') and len(join_line.split(maxsplit=1)) == 2:
+            _, client_name = join_line.split(maxsplit=1)
+            options = parse_join_options(option_line)
+            version = negotiate_version(options)
+            client = ClientConnection(writer, client_name, framed=version > 0)
+            sock = writer.get_extra_info('socket')
+            if SOCKET_SEND_BUFFER and sock is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SEND_BUFFER)
+            clients[writer] = client
+            metrics.inc('connections_total')
+            # ROOM=<name> lets a reconnecting client land back where it was
+            room_name = options.get('ROOM', DEFAULT_ROOM)
+            room = enter_room(client, room_name if valid_room_name(room_name) else DEFAULT_ROOM)
+
             # First send the success response
-            conn.sendall(b"JOIN_SUCCESS")
-            
+            if client.framed:
+                reply = f"JOIN_SUCCESS PROTO={version}"
+                if options.get('COMPRESS') == 'zlib':
+                    reply += " COMPRESS=zlib"
+                client.write(f"{reply}\n".encode(), compressible=False)
+                if options.get('COMPRESS') == 'zlib':
+                    client.compressor = zlib.compressobj(COMPRESS_LEVEL)
+                # Then what was said before they arrived, or since SINCE=<seq> when reconnecting.
+                # Legacy clients read JOIN_SUCCESS as a whole recv, so they get no replay.
+                try:
+                    since = int(options.get('SINCE', 0))
+                except ValueError:
+                    since = 0
+                replay = room.history.encode(since)
+                if replay:
+                    client.write(replay)
+            else:
+                client.write(b"JOIN_SUCCESS")
+            await client.drain()
+
             # Then notify everyone about the new user
-            broadcast_message("SERVER", f"{client_name} has joined the chat")
+            broadcast_message(room, "SERVER", f"{client_name} has joined the chat")
         else:
-            conn.sendall(b"Error: First command must be JOIN_CHAT")
+            writer.write(b"Error: First command must be JOIN_CHAT")
+            await writer.drain()
             return
-        
+
         # Main client handling loop
         while True:
-            request = conn.recv(1024).decode().strip()
+            request, request_id, flags = await read_request(reader, client)
             if not request:
                 break
-                
-            print(f"[{addr}] [{client_name}] {request}")
-            
-            if request.startswith('CHAT'):
-                _, message = request.split(maxsplit=1)
-                broadcast_message(client_name, message)
-                conn.sendall(b"MESSAGE_SENT")
-                
-            elif request == 'LIST_LIBRARY_SONGS':
-                conn.sendall(b"COMMAND_RESPONSE\n" + '\n'.join(list_files(LIBRARY_DIR)).encode())
-
-            elif request == 'LIST_PLAYLISTS':
-                conn.sendall(b"COMMAND_RESPONSE\n" + '\n'.join(list_files(PLAYLIST_DIR)).encode())
-
-            elif request.startswith('LIST_SONGS_IN_PLAYLIST'):
-                _, name = request.split(maxsplit=1)
-                try:
-                    with open(os.path.join(PLAYLIST_DIR, name)) as f:
-                        conn.sendall(b"COMMAND_RESPONSE\n" + f.read().strip().encode())
-                except:
-                    conn.sendall(b"COMMAND_RESPONSE\nError: Playlist not found")
-
-            elif request.startswith('CREATE_PLAYLIST'):
-                _, name = request.split(maxsplit=1)
-                path = os.path.join(PLAYLIST_DIR, name)
-                if os.path.exists(path):
-                    conn.sendall(b"COMMAND_RESPONSE\nPlaylist already exists")
-                else:
-                    open(path, 'w').close()
-                    conn.sendall(b"COMMAND_RESPONSE\nPlaylist created")
-                    broadcast_message("SERVER", f"{client_name} created a new playlist: {name}")
-
-            elif request.startswith('ADD_SONG_TO_PLAYLIST'):
-                _, pl, song = request.split(maxsplit=2)
-                pl_path = os.path.join(PLAYLIST_DIR, pl)
-                song_path = os.path.join(LIBRARY_DIR, song)
-                if os.path.exists(pl_path) and os.path.exists(song_path):
-                    with open(pl_path, 'a') as f:
-                        f.write(song + '\n')
-                    conn.sendall(b"COMMAND_RESPONSE\nSong added")
-                    broadcast_message("SERVER", f"{client_name} added {song} to playlist {pl}")
-                else:
-                    conn.sendall(b"COMMAND_RESPONSE\nError adding song")
-
-            elif request.startswith('REMOVE_SONG_FROM_PLAYLIST'):
-                _, pl, song = request.split(maxsplit=2)
-                pl_path = os.path.join(PLAYLIST_DIR, pl)
-                if os.path.exists(pl_path):
-                    with open(pl_path, 'r') as f:
-                        lines = f.readlines()
-                    with open(pl_path, 'w') as f:
-                        f.writelines(line for line in lines if line.strip() != song)
-                    conn.sendall(b"COMMAND_RESPONSE\nSong removed")
-                else:
-                    conn.sendall(b"COMMAND_RESPONSE\nPlaylist not found")
 
-            elif request.startswith('DELETE_PLAYLIST'):
-                _, name = request.split(maxsplit=1)
-                path = os.path.join(PLAYLIST_DIR, name)
-                try:
-                    os.remove(path)
-                    conn.sendall(b"COMMAND_RESPONSE\nPlaylist deleted")
-                    broadcast_message("SERVER", f"{client_name} deleted playlist {name}")
-                except:
-                    conn.sendall(b"COMMAND_RESPONSE\nError deleting playlist")
-
-            elif request.startswith('MERGE_PLAYLISTS'):
-                _, source, target = request.split(maxsplit=2)
-                src_path = os.path.join(PLAYLIST_DIR, source)
-                tgt_path = os.path.join(PLAYLIST_DIR, target)
-                if os.path.exists(src_path) and os.path.exists(tgt_path):
-                    with open(src_path) as src:
-                        src_songs = src.read().strip().splitlines()
-                    with open(tgt_path, 'a') as tgt:
-                        for song in src_songs:
-                            tgt.write(song + '\n')
-                    conn.sendall(b"COMMAND_RESPONSE\nPlaylists merged")
-                    broadcast_message("SERVER", f"{client_name} merged playlists {source} into {target}")
-                else:
-                    conn.sendall(b"COMMAND_RESPONSE\nOne or both playlists not found")
-
-            elif request.startswith('COMBINE_PLAYLISTS'):
-                _, p1, p2 = request.split(maxsplit=2)
-                p1_path = os.path.join(PLAYLIST_DIR, p1)
-                p2_path = os.path.join(PLAYLIST_DIR, p2)
-                combined_name = f"{p1}_{p2}_combined"
-                combined_path = os.path.join(PLAYLIST_DIR, combined_name)
-
-                if os.path.exists(p1_path) and os.path.exists(p2_path):
-                    with open(p1_path) as f1, open(p2_path) as f2:
-                        combined_songs = set(f1.read().splitlines() + f2.read().splitlines())
-                    with open(combined_path, 'w') as f:
-                        for song in combined_songs:
-                            f.write(song + '\n')
-                    conn.sendall(f"COMMAND_RESPONSE\nCombined into playlist: {combined_name}".encode())
-                    broadcast_message("SERVER", f"{client_name} created a combined playlist: {combined_name}")
-                else:
-                    conn.sendall(b"COMMAND_RESPONSE\nOne or both playlists not found")
-
-            elif request.startswith('STREAM_SONG'):
-                _, song = request.split(maxsplit=1)
-                path = os.path.join(LIBRARY_DIR, song)
-                if os.path.exists(path):
-                    broadcast_message("SERVER", f"{client_name} is now streaming: {song}")
-                    conn.sendall(b"STREAM_START\n")
-                    
-                    with open(path, 'rb') as f:
-                        while True:
-                            data = f.read(1024)
-                            if not data:
-                                break
-                            try:
-                                conn.sendall(data)
-                            except:
-                                break
-                    
-                    conn.sendall(b"STREAM_END\n")
-                else:
-                    conn.sendall(b"COMMAND_RESPONSE\nError: Song not found")
+            print(f"[{addr}] [{client_name}] {request}")
 
-            elif request == 'LEAVE_CHAT':
+            if request == 'LEAVE_CHAT':
                 break
-                
+
+            if client.framed and request.startswith(STREAM_COMMANDS):
+                # Streams run alongside the client's other commands, each on its own channel
+                task = asyncio.ensure_future(run_stream_command(client, request, request_id, flags))
+                client.streams.add(task)
+                task.add_done_callback(client.streams.discard)
             else:
-                conn.sendall(b"COMMAND_RESPONSE\nInvalid command")
+                await run_command(client, request, request_id, flags)
+                await client.drain()
 
     except Exception as e:
         print(f"Error handling client {addr}: {e}")
     finally:
         # Clean up when client disconnects
-        with clients_lock:
-            if conn in clients:
-                leaving_name = clients[conn]
-                del clients[conn]
-                if client_name:
-                    broadcast_message("SERVER", f"{client_name} has left the chat")
-        
+        if writer in clients:
+            client = clients.pop(writer)
+            if client.station is not None:
+                client.station.remove(client)
+            for task in list(client.streams):
+                task.cancel()
+            client.close()
+            room = leave_room(client)
+            if client_name and room is not None:
+                broadcast_message(room, "SERVER", f"{client_name} has left the chat")
+
         try:
-            conn.close()
+            writer.close()
         except:
             pass
 
-def start_server():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
-        s.listen()
+def setup():
+    global disk_executor, library_index, playlist_store, metadata_index, song_cache
+    disk_executor = ThreadPoolExecutor(max_workers=DISK_WORKERS, thread_name_prefix="disk")
+    os.makedirs(LIBRARY_DIR, exist_ok=True)
+    library_index = LibraryIndex(LIBRARY_DIR, disk_executor)
+    playlist_store = PlaylistStore(PLAYLIST_DB)
+    metadata_index = MetadataIndex(METADATA_DB, library_index, disk_executor)
+    song_cache = SongCache(SONG_CACHE_BYTES, SONG_CACHE_MAX_FILE)
+
+async def serve(bus_sock=None, listen_sock=None, worker_index=0):
+    """Run the server; bus_sock and listen_sock are set when this is one of several workers"""
+    global bus
+    setup()
+    rooms.setdefault(DEFAULT_ROOM, Room(DEFAULT_ROOM))
+    await metadata_index.load()
+    if worker_index == 0:
+        # One process reads tags and stores them; the others reload them when told
+        library_index.on_change = metadata_index.request_sync
+    await library_index.start()
+    if worker_index == 0:
+        metadata_index.request_sync()
+    imported = await run_blocking(playlist_store.import_directory_once, PLAYLIST_DIR)
+    if imported:
+        print(f"Imported {imported} playlists from {PLAYLIST_DIR}/ into {PLAYLIST_DB}")
+    if bus_sock is not None:
+        bus = BusClient(bus_sock, on_bus_chat, on_bus_event)
+        await bus.connect()
+        loop = asyncio.get_running_loop()
+        # The other workers cache the playlist listing too
+        playlist_store.on_change = lambda: loop.call_soon_threadsafe(bus.publish_event, 'PLAYLISTS_CHANGED')
+        metadata_index.on_change = lambda: bus.publish_event('METADATA_CHANGED')
+    if listen_sock is not None:
+        server = await asyncio.start_server(handle_client, sock=listen_sock)
+    else:
+        server = await asyncio.start_server(handle_client, HOST, PORT, reuse_port=bus_sock is not None)
+    if METRICS_PORT:
+        await asyncio.start_server(handle_metrics, '127.0.0.1', METRICS_PORT + worker_index)
+        print(f"Metrics on http://127.0.0.1:{METRICS_PORT + worker_index}/metrics")
+    if bus is None:
         print(f"Chat and Music Streaming Server running on {HOST}:{PORT}")
-        while True:
-            conn, addr = s.accept()
-            print(f"New connection from {addr}")
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+        async with server:
+            await server.serve_forever()
+    else:
+        print(f"Worker {os.getpid()} serving on {HOST}:{PORT}")
+        async with server:
+            # A worker has nothing to do once the parent and its bus are gone
+            await bus.listen()
+
+def run_workers(count):
+    """Fork `count` workers sharing the port, linked by a bus relayed in this process"""
+    listen_sock = None
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        # Without SO_REUSEPORT the workers accept from one inherited socket instead
+        listen_sock = socket.create_server((HOST, PORT))
+    hub_socks, pids = [], []
+    for index in range(count):
+        hub_sock, worker_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            for sock in hub_socks + [hub_sock]:
+                sock.close()
+            try:
+                asyncio.run(serve(worker_sock, listen_sock, index))
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                print(f"Worker {os.getpid()} failed: {e}")
+            finally:
+                os._exit(0)
+        worker_sock.close()
+        hub_socks.append(hub_sock)
+        pids.append(pid)
+    print(f"Chat and Music Streaming Server running on {HOST}:{PORT} with {count} workers")
+    try:
+        asyncio.run(BusHub(hub_socks).run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+def start_server(workers=SERVER_WORKERS):
+    if workers > 1 and hasattr(os, 'fork'):
+        run_workers(workers)
+    else:
+        asyncio.run(serve())
 
 if __name__ == '__main__':
-    start_server()
+    parser = argparse.ArgumentParser(description="Chat and music streaming server")
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help="worker processes sharing the port")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="serve Prometheus metrics on this local port")
+    args = parser.parse_args()
+    PORT = args.port
+    METRICS_PORT = args.metrics_port
+    start_server(args.workers)
@@ -0,0 +1,74 @@
+"""Byte-budgeted in-memory cache for popular songs
+
+Whole files are kept in an LRU ordered by last use. An entry is only
+served while the file's size and mtime still match what was cached, so
+a song replaced on disk is never streamed stale. A file is admitted on
+its second play within the recent-play window, so one-off plays do not
+push out the songs everybody is listening to.
+"""
+import collections
+
+class SongCache:
+    def __init__(self, max_bytes, max_file_bytes, admit_after=2, history_size=1024):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self.admit_after = admit_after
+        self.history_size = history_size
+        self.entries = collections.OrderedDict()  # path -> (size, mtime_ns, data)
+        self.recent = collections.OrderedDict()  # path -> play count, for admission
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+    def get(self, path, size, mtime_ns):
+        """Cached bytes for path if still current, else None"""
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return entry[2]
+        if entry is not None:
+            self._remove(path)
+        self.misses += 1
+        return None
+
+    def should_admit(self, path, size):
+        """Count a play of path; True once it has been played often enough to cache"""
+        if size > self.max_file_bytes:
+            return False
+        count = self.recent.pop(path, 0) + 1
+        self.recent[path] = count
+        if len(self.recent) > self.history_size:
+            self.recent.popitem(last=False)
+        return count >= self.admit_after
+
+    def record_served(self, count):
+        """Count bytes sent from memory rather than read from disk"""
+        self.bytes_saved += count
+
+    def put(self, path, size, mtime_ns, data):
+        if len(data) > self.max_file_bytes:
+            return
+        if path in self.entries:
+            self._remove(path)
+        while self.size + len(data) > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+        self.entries[path] = (size, mtime_ns, data)
+        self.size += len(data)
+        self.recent.pop(path, None)
+
+    def _remove(self, path):
+        size, mtime_ns, data = self.entries.pop(path)
+        self.size -= len(data)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return (f"hits={self.hits} misses={self.misses} hit_rate={self.hit_rate() * 100:.1f}% "
+                f"bytes_saved={self.bytes_saved} evictions={self.evictions} "
+                f"entries={len(self.entries)} size={self.size}/{self.max_bytes}")
@@ -0,0 +1,235 @@
+"""List widgets for the Tk client that stay fast with very large catalogs
+
+A ListModel holds the rows in a plain Python list and can back any
+number of VirtualListViews at once, e.g. the library tab and the Add Song
+dialog. A view only puts the rows that fit on screen into its Listbox,
+and on a change it rewrites only the visible rows whose text differs, so
+replacing 100k rows costs about as much as replacing thirty.
+PagedListModel goes further and only holds the pages views have
+scrolled to, asking for each one as it first comes into view.
+"""
+import tkinter as tk
+from tkinter import font as tkfont
+from tkinter import ttk
+
+WHEEL_ROWS = 3  # rows scrolled per mouse wheel notch
+PLACEHOLDER = "Loading..."  # shown for rows whose page has not arrived yet
+
+class ListModel:
+    def __init__(self, items=()):
+        self.items = list(items)
+        self.listeners = []  # callables taking reset: True when row positions changed wholesale
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def rows(self, start, end):
+        return self.items[start:end]
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def set(self, items):
+        self.items = list(items)
+        self._changed(True)
+
+    def append(self, item):
+        self.items.append(item)
+        self._changed(False)
+
+    def remove_all(self, item):
+        """Drop every row equal to item"""
+        self.items = [x for x in self.items if x != item]
+        self._changed(True)
+
+    def _changed(self, reset):
+        for listener in list(self.listeners):
+            listener(reset)
+
+class PagedListModel(ListModel):
+    """Rows fetched a page at a time as views scroll to them
+
+    fetch(offset, limit) is called once for each page a view needs and
+    returns a token identifying the request (or None if it could not be
+    sent). The answer is passed to add_page with that token; answers to
+    requests made before the last reset are ignored.
+    """
+
+    def __init__(self, fetch, page_size):
+        super().__init__()
+        self.fetch = fetch
+        self.page_size = page_size
+        self.total = 0
+        self.pages = {}  # page number -> names
+        self.requested = {}  # page number -> token of the outstanding fetch
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, index):
+        page = self.pages.get(index // self.page_size)
+        if page is None or index % self.page_size >= len(page):
+            return PLACEHOLDER
+        return page[index % self.page_size]
+
+    def __iter__(self):
+        return (self[i] for i in range(self.total))
+
+    def rows(self, start, end):
+        end = min(end, self.total)
+        for number in range(start // self.page_size, (end - 1) // self.page_size + 1):
+            self._request(number)
+        return [self[i] for i in range(start, end)]
+
+    def _request(self, number):
+        if number not in self.pages and number not in self.requested:
+            token = self.fetch(number * self.page_size, self.page_size)
+            if token is not None:
+                self.requested[number] = token
+
+    def reset(self):
+        """Drop every page, e.g. when the filter changes, and fetch the first one again"""
+        self.total = 0
+        self.pages.clear()
+        self.requested.clear()
+        self._request(0)
+        self._changed(True)
+
+    def add_page(self, token, total, offset, names):
+        number = offset // self.page_size
+        if self.requested.get(number) != token:
+            return
+        del self.requested[number]
+        self.pages[number] = names
+        self.total = total
+        self._changed(False)
+
+    def set(self, items):
+        """Hold a complete list, e.g. the songs in the download cache while offline"""
+        items = list(items)
+        self.requested.clear()
+        self.pages = {i // self.page_size: items[i:i + self.page_size]
+                      for i in range(0, len(items), self.page_size)}
+        self.total = len(items)
+        self._changed(True)
+
+class VirtualListView(ttk.Frame):
+    """Single-selection list over a ListModel with a Listbox-like interface
+
+    curselection(), get() and size() use model indexes, so code written for
+    a tk.Listbox keeps working. bind() attaches to the inner Listbox.
+    """
+
+    def __init__(self, parent, model, **listbox_options):
+        super().__init__(parent)
+        self.model = model
+        self.top = 0  # model index of the first visible row
+        self.selected = None  # model index of the selected row
+        self.rendered = []  # text of the rows currently in the Listbox
+        self.row_height = None
+        self.listbox = tk.Listbox(self, exportselection=False, selectmode=tk.BROWSE, **listbox_options)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.listbox.bind("<Configure>", lambda event: self.render())
+        self.listbox.bind("<<ListboxSelect>>", self.on_select)
+        self.listbox.bind("<MouseWheel>", lambda event: self.scroll(-WHEEL_ROWS if event.delta > 0 else WHEEL_ROWS))
+        self.listbox.bind("<Button-4>", lambda event: self.scroll(-WHEEL_ROWS))
+        self.listbox.bind("<Button-5>", lambda event: self.scroll(WHEEL_ROWS))
+        self.listbox.bind("<Up>", lambda event: self.move_selection(-1))
+        self.listbox.bind("<Down>", lambda event: self.move_selection(1))
+        ttk.Frame.bind(self, "<Destroy>", lambda event: self.model.unsubscribe(self.on_model_changed))
+        model.subscribe(self.on_model_changed)
+        self.render()
+
+    # Listbox-like interface
+    def curselection(self):
+        if self.selected is not None and self.selected < len(self.model):
+            return (self.selected,)
+        return ()
+
+    def get(self, index):
+        return self.model[index]
+
+    def size(self):
+        return len(self.model)
+
+    def bind(self, sequence=None, func=None, add=None):
+        # Added after the view's own handlers, which keep self.selected current
+        return self.listbox.bind(sequence, func, "+")
+
+    def visible_rows(self):
+        if self.row_height is None:
+            linespace = tkfont.Font(font=self.listbox.cget("font")).metrics("linespace")
+            self.row_height = linespace + 1 + 2 * int(self.listbox.cget("selectborderwidth"))
+        return max(1, self.listbox.winfo_height() // self.row_height)
+
+    def render(self):
+        rows = self.visible_rows()
+        total = len(self.model)
+        self.top = max(0, min(self.top, total - rows))
+        wanted = self.model.rows(self.top, self.top + rows)
+        for i, text in enumerate(wanted):
+            if i >= len(self.rendered):
+                self.listbox.insert(tk.END, text)
+            elif self.rendered[i] != text:
+                self.listbox.delete(i)
+                self.listbox.insert(i, text)
+        if len(self.rendered) > len(wanted):
+            self.listbox.delete(len(wanted), tk.END)
+        self.rendered = wanted
+        self.listbox.selection_clear(0, tk.END)
+        if self.selected is not None and self.top <= self.selected < self.top + len(wanted):
+            self.listbox.selection_set(self.selected - self.top)
+        self.listbox.yview_moveto(0)
+        if total > rows:
+            self.scrollbar.set(self.top / total, (self.top + rows) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def on_model_changed(self, reset):
+        if reset:
+            self.selected = None
+        self.render()
+
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == tk.MOVETO:
+            self.top = int(float(amount) * len(self.model))
+            self.render()
+        else:
+            rows = self.visible_rows() if unit == tk.PAGES else 1
+            self.scroll(int(amount) * rows)
+
+    def scroll(self, rows):
+        self.top += rows
+        self.render()
+        return "break"
+
+    def on_select(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.selected = self.top + selection[0]
+
+    def move_selection(self, step):
+        if not len(self.model):
+            return "break"
+        current = self.selected if self.selected is not None else self.top - step
+        self.selected = max(0, min(len(self.model) - 1, current + step))
+        rows = self.visible_rows()
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + rows:
+            self.top = self.selected - rows + 1
+        self.render()
+        self.listbox.event_generate("<<ListboxSelect>>")
+        return "break"